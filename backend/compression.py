@@ -0,0 +1,160 @@
+"""
+Middleware ASGI de compresión para respuestas JSON.
+
+- Negocia brotli (si el paquete está instalado) o gzip según Accept-Encoding.
+- Solo comprime respuestas completas de al menos COMPRESSION_MIN_BYTES con
+  un content-type comprimible; las respuestas en streaming (NDJSON, SSE)
+  pasan sin cambios para no retrasar los eventos.
+- Omite las rutas binarias (PDFs, imágenes, páginas y miniaturas), que ya
+  vienen comprimidas.
+- compression_metrics() expone respuestas, bytes, ratio y tiempo de
+  compresión por codificación.
+"""
+import gzip
+import os
+import re
+import time
+from collections import deque
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional: sin él solo se negocia gzip
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+
+# Rutas cuyo contenido es binario (ya comprimido) o se envía por streaming
+SKIP_PATHS = re.compile(r"/(view|download|thumbnail|events)$|/pages/\d+$|/pdfs/[^/]+/documents/[^/]+$")
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "application/x-ndjson")
+
+
+class _CompressionMetrics:
+    def __init__(self):
+        self.skipped = 0
+        self.encodings = {}
+
+    def record(self, encoding: str, original: int, compressed: int, seconds: float):
+        stats = self.encodings.setdefault(encoding, {
+            "responses": 0, "bytes_in": 0, "bytes_out": 0, "times": deque(maxlen=500)
+        })
+        stats["responses"] += 1
+        stats["bytes_in"] += original
+        stats["bytes_out"] += compressed
+        stats["times"].append(seconds)
+
+    def snapshot(self) -> dict:
+        def percentile(values, pct):
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))] * 1000, 3) if ordered else None
+
+        return {
+            "min_bytes": COMPRESSION_MIN_BYTES,
+            "brotli_available": brotli is not None,
+            "uncompressed_responses": self.skipped,
+            "encodings": {
+                name: {
+                    "responses": stats["responses"],
+                    "bytes_in": stats["bytes_in"],
+                    "bytes_out": stats["bytes_out"],
+                    "ratio": round(stats["bytes_in"] / stats["bytes_out"], 2) if stats["bytes_out"] else None,
+                    "time_ms_p50": percentile(stats["times"], 0.5),
+                    "time_ms_p95": percentile(stats["times"], 0.95),
+                }
+                for name, stats in self.encodings.items()
+            }
+        }
+
+
+_metrics = _CompressionMetrics()
+
+
+def compression_metrics() -> dict:
+    return _metrics.snapshot()
+
+
+def negotiate_encoding(accept_encoding: str):
+    """Codificación a usar según Accept-Encoding: "br", "gzip" o None (respeta q=0)."""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or SKIP_PATHS.search(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        encoding = negotiate_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            response_headers = dict(start_message.get("headers") or [])
+            content_type = response_headers.get(b"content-type", b"").decode("latin-1")
+            if (message.get("more_body")
+                    or len(body) < COMPRESSION_MIN_BYTES
+                    or b"content-encoding" in response_headers
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                # Streaming, respuesta pequeña o ya codificada: se envía tal cual
+                passthrough = True
+                _metrics.skipped += 1
+                await send(start_message)
+                await send(message)
+                return
+
+            started = time.perf_counter()
+            compressed = compress(body, encoding)
+            _metrics.record(encoding, len(body), len(compressed), time.perf_counter() - started)
+
+            new_headers = [(name, value) for name, value in start_message.get("headers") or []
+                           if name.lower() not in (b"content-length", b"etag")]
+            vary = response_headers.get(b"vary")
+            new_headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+            new_headers += [(b"content-encoding", encoding.encode()), (b"content-length", str(len(compressed)).encode())]
+            # Un ETag fuerte identifica los bytes enviados: se vuelve débil al comprimir
+            if b"etag" in response_headers:
+                etag = response_headers[b"etag"]
+                new_headers.append((b"etag", etag if etag.startswith(b"W/") else b"W/" + etag))
+            await send({**start_message, "headers": new_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,721 @@
+"""
+Correlación local de documentos (sin LLM): método básico, suma de facturas
+y clusters por múltiples criterios.
+
+Este módulo no depende de FastAPI ni de MongoDB para poder usarse tanto
+desde server.py como desde pruebas y benchmarks.
+"""
+import math
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import date, datetime, time, timezone
+from itertools import combinations
+from typing import Dict, List, Optional
+
+# Tolerancia para considerar dos valores como "el mismo pago" (±5%)
+VALOR_TOLERANCIA = 0.05
+
+# Suma de facturas: tolerancia sobre el valor del pago y límites de búsqueda
+SUMA_TOLERANCIA = 0.01
+SUMA_MAX_FACTURAS = 6        # Máximo de facturas en una misma suma
+SUMA_MAX_CANDIDATAS = 24     # Facturas por bloque; con más, el caso se deja al LLM
+
+# Tipos de documento cuyo valor es el total pagado
+TIPOS_PAGO = ("comprobante_egreso", "cuenta_por_pagar")
+
+# Razones sociales que no distinguen a un tercero de otro
+TERCERO_STOPWORDS = {"SAS", "LTDA", "SA"}
+
+
+def normalize_nit(nit) -> str:
+    """Limpia un NIT quitando guiones, puntos y espacios en los extremos."""
+    return (nit or '').replace('-', '').replace('.', '').strip()
+
+
+def normalize_tercero(tercero) -> str:
+    """Mayúsculas y un solo espacio entre palabras."""
+    return ' '.join((tercero or '').upper().split())
+
+
+def tercero_tokens(tercero) -> frozenset:
+    """
+    Palabras significativas (más de 3 letras) del nombre de un tercero.
+    Se quitan signos de puntuación y razones sociales ("S.A.S.", "LTDA", "S.A.").
+    """
+    tokens = set()
+    for word in normalize_tercero(tercero).split():
+        word = word.strip('.,;:()"\'').replace('.', '')
+        if len(word) > 3 and word not in TERCERO_STOPWORDS:
+            tokens.add(word)
+    return frozenset(tokens)
+
+
+def tercero_trigrams(tercero) -> frozenset:
+    """Trigramas de caracteres del tercero normalizado (para coincidencias parciales)."""
+    norm = normalize_tercero(tercero)
+    return frozenset(norm[i:i + 3] for i in range(len(norm) - 2))
+
+
+def tercero_substrings(tercero, min_length: int = 3) -> List[str]:
+    """Todas las subcadenas del tercero normalizado con al menos min_length caracteres."""
+    norm = normalize_tercero(tercero)
+    return sorted({
+        norm[i:j]
+        for i in range(len(norm))
+        for j in range(i + min_length, len(norm) + 1)
+    })
+
+
+def tercero_index_fields(tercero) -> Dict:
+    """
+    Campos del índice invertido de terceros que se guardan junto al documento.
+    MongoDB los indexa como multikey (token -> documentos, trigrama -> documentos).
+    """
+    return {
+        "tercero_norm": normalize_tercero(tercero) or None,
+        "tercero_tokens": sorted(tercero_tokens(tercero)),
+        "tercero_trigrams": sorted(tercero_trigrams(tercero)),
+    }
+
+
+def valor_bucket(valor):
+    """Valor redondeado a centenas (llave del paso "mismo NIT y mismo valor")."""
+    return round(valor, -2) if valor else None
+
+
+def parse_fecha(value) -> Optional[date]:
+    """Fecha YYYY-MM-DD extraída por la IA; None si no se puede leer."""
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def correlation_keys(fields: Dict) -> Dict:
+    """
+    Llaves de correlación precalculadas para los campos presentes en fields
+    (nit, tercero, valor, fecha). Se guardan e indexan junto al documento para
+    no normalizar en cada sugerencia ni re-análisis.
+    """
+    keys = {}
+    if 'nit' in fields:
+        keys['nit_norm'] = normalize_nit(fields['nit']) or None
+    if 'tercero' in fields:
+        keys.update(tercero_index_fields(fields['tercero']))
+    if 'valor' in fields:
+        keys['valor_bucket'] = valor_bucket(fields['valor'])
+    if 'fecha' in fields:
+        fecha = parse_fecha(fields['fecha'])
+        keys['fecha_dt'] = datetime.combine(fecha, time.min, tzinfo=timezone.utc) if fecha else None
+    return keys
+
+
+def _doc_nit(doc: Dict) -> str:
+    if 'nit_norm' in doc:
+        return doc['nit_norm'] or ''
+    return normalize_nit(doc.get('nit'))
+
+
+def _doc_tokens(doc: Dict) -> frozenset:
+    if 'tercero_tokens' in doc:
+        return frozenset(doc['tercero_tokens'] or ())
+    return tercero_tokens(doc.get('tercero'))
+
+
+def _doc_fecha(doc: Dict) -> Optional[date]:
+    if doc.get('fecha_dt'):
+        return doc['fecha_dt'].date()
+    return parse_fecha(doc.get('fecha'))
+
+
+class _FreeSlots:
+    """
+    Posiciones libres de un arreglo ordenado.
+    Permite saltar en O(α(n)) las posiciones ya asignadas a un grupo.
+    """
+
+    def __init__(self, size: int):
+        self._next = list(range(size + 1))
+
+    def find(self, pos: int) -> int:
+        root = pos
+        while self._next[root] != root:
+            root = self._next[root]
+        while self._next[pos] != root:
+            self._next[pos], pos = root, self._next[pos]
+        return root
+
+    def remove(self, pos: int):
+        self._next[pos] = pos + 1
+
+
+def _group(documents: List[Dict], **fields) -> Dict:
+    return {
+        "tercero": fields.pop("tercero"),
+        "nit": fields.pop("nit"),
+        "valor": fields.pop("valor"),
+        "num_documentos": len(documents),
+        "tipos_documentos": list(set(d.get('tipo_documento', '') for d in documents)),
+        "document_ids": [d['id'] for d in documents],
+        **fields
+    }
+
+
+def _correlate_by_nit(documents: List[Dict], processed_ids: set) -> List[Dict]:
+    """PASO 1: mismo NIT y mismo valor redondeado a centenas (alta confianza)."""
+    correlations = []
+
+    by_nit = {}
+    for doc in documents:
+        nit = _doc_nit(doc)
+        if len(nit) >= 6:
+            by_nit.setdefault(nit, []).append(doc)
+
+    for nit, docs_nit in by_nit.items():
+        if len(docs_nit) < 2:
+            continue
+
+        sub_by_valor = {}
+        for doc in docs_nit:
+            if doc['id'] in processed_ids:
+                continue
+            valor = doc.get('valor', 0)
+            valor_key = round(valor, -2) if valor else 0
+            sub_by_valor.setdefault(valor_key, []).append(doc)
+
+        for valor_key, grupo in sub_by_valor.items():
+            if len(grupo) < 2:
+                continue
+            for d in grupo:
+                processed_ids.add(d['id'])
+
+            correlations.append(_group(
+                grupo,
+                tercero=grupo[0].get('tercero', ''),
+                nit=nit,
+                valor=valor_key,
+                tipo_correlacion="mismo_nit",
+                confianza="alta",
+                razon_correlacion=f"Mismo NIT: {nit}"
+            ))
+
+    return correlations
+
+
+def _correlate_by_valor(documents: List[Dict], processed_ids: set) -> List[Dict]:
+    """
+    PASO 2: valor similar (±5%).
+
+    Recorre los documentos en el orden original igual que la versión
+    cuadrática, pero busca candidatos con búsqueda binaria sobre los valores
+    ordenados y salta los ya agrupados, así que el costo total es O(n log n).
+    """
+    correlations = []
+
+    # Los valores NaN nunca cumplen la tolerancia, se excluyen del índice
+    valued = sorted(
+        (doc['valor'], idx) for idx, doc in enumerate(documents)
+        if doc.get('valor') and doc['valor'] == doc['valor']
+    )
+    valores = [v for v, _ in valued]
+    order = [idx for _, idx in valued]
+    position = {idx: pos for pos, idx in enumerate(order)}
+
+    free = _FreeSlots(len(order))
+    for pos, idx in enumerate(order):
+        if documents[idx]['id'] in processed_ids:
+            free.remove(pos)
+
+    for idx, doc in enumerate(documents):
+        if doc['id'] in processed_ids:
+            continue
+
+        valor = doc.get('valor')
+        if not valor:
+            continue
+
+        if valor > 0:
+            # Ventana un poco más amplia; el criterio exacto se vuelve a evaluar
+            margin = valor * (VALOR_TOLERANCIA + 1e-9)
+            start = bisect_left(valores, valor - margin)
+            end = bisect_right(valores, valor + margin)
+        else:
+            # Con valor negativo la comparación original acepta cualquier otro
+            start, end = 0, len(valores)
+
+        matched = []
+        pos = free.find(start)
+        while pos < end:
+            other_idx = order[pos]
+            if other_idx != idx and abs(valor - valores[pos]) / valor <= VALOR_TOLERANCIA:
+                matched.append(other_idx)
+                processed_ids.add(documents[other_idx]['id'])
+                free.remove(pos)
+            pos = free.find(pos + 1)
+
+        if not matched:
+            continue
+
+        matching = [doc] + [documents[i] for i in sorted(matched)]
+        processed_ids.add(doc['id'])
+        if idx in position:
+            free.remove(position[idx])
+
+        correlations.append(_group(
+            matching,
+            tercero=(doc.get('tercero') or '').upper(),
+            nit=doc.get('nit', ''),
+            valor=valor,
+            tipo_correlacion="valor_exacto",
+            confianza="alta" if len(matching) >= 3 else "media",
+            razon_correlacion=f"Valor similar: ${valor:,.2f}"
+        ))
+
+    return correlations
+
+
+def _correlate_by_tercero(documents: List[Dict], processed_ids: set) -> List[Dict]:
+    """
+    PASO 3: tercero similar (al menos una palabra significativa en común,
+    sin contar razones sociales como SAS o LTDA).
+
+    Usa un índice invertido palabra -> posiciones. Todo candidato que aparece
+    en la lista de una palabra del documento actual queda agrupado, así que
+    cada lista se vacía después de recorrerla.
+    """
+    correlations = []
+
+    remaining = [d for d in documents if d['id'] not in processed_ids and d.get('tercero')]
+    words = [_doc_tokens(d) for d in remaining]
+
+    postings = {}
+    for pos, doc_words in enumerate(words):
+        for word in doc_words:
+            postings.setdefault(word, []).append(pos)
+
+    for pos, doc in enumerate(remaining):
+        if doc['id'] in processed_ids or not words[pos]:
+            continue
+
+        matched = set()
+        for word in words[pos]:
+            for other_pos in postings[word]:
+                if other_pos != pos and remaining[other_pos]['id'] not in processed_ids:
+                    matched.add(other_pos)
+            postings[word] = [pos]
+
+        if not matched:
+            continue
+
+        for other_pos in matched:
+            processed_ids.add(remaining[other_pos]['id'])
+        processed_ids.add(doc['id'])
+
+        tercero = doc['tercero'].upper()
+        matching = [doc] + [remaining[p] for p in sorted(matched)]
+        correlations.append(_group(
+            matching,
+            tercero=tercero,
+            nit=doc.get('nit', ''),
+            valor=doc.get('valor', 0),
+            tipo_correlacion="mismo_tercero",
+            confianza="media",
+            razon_correlacion=f"Tercero similar: {tercero[:30]}"
+        ))
+
+    return correlations
+
+
+def _half_sums(valores: List[int], offset: int, max_size: int) -> List[tuple]:
+    """
+    Sumas de todos los subconjuntos de hasta max_size elementos de una mitad.
+    Devuelve, por tamaño, una lista ordenada de (suma, índices).
+    """
+    by_size = []
+    for size in range(max_size + 1):
+        sums = sorted(
+            (sum(valores[i] for i in combo), tuple(i + offset for i in combo))
+            for combo in combinations(range(len(valores)), size)
+        )
+        by_size.append((sums, [s for s, _ in sums]))
+    return by_size
+
+
+def find_subset_sum(valores: List[float], target: float, tolerance: float = SUMA_TOLERANCIA,
+                    max_size: int = SUMA_MAX_FACTURAS, min_size: int = 2) -> Optional[List[int]]:
+    """
+    Busca el subconjunto más pequeño de valores cuya suma esté a ±tolerance del objetivo.
+
+    Meet-in-the-middle sobre centavos enteros: se enumeran las sumas de cada
+    mitad por tamaño y, para cada suma de la izquierda, se busca con bisección
+    la suma de la derecha más cercana a lo que falta. Con 24 valores y hasta 6
+    elementos son unas 2.500 sumas por mitad. Devuelve los índices o None.
+    """
+    cents = [round(v * 100) for v in valores]
+    target_cents = round(target * 100)
+    max_error = abs(target_cents) * tolerance
+    middle = len(cents) // 2
+
+    left = _half_sums(cents[:middle], 0, min(max_size, middle))
+    right = _half_sums(cents[middle:], middle, min(max_size, len(cents) - middle))
+
+    best = None
+    for left_size, (left_sums, _) in enumerate(left):
+        for right_size in range(max(0, min_size - left_size), len(right)):
+            size = left_size + right_size
+            if size > max_size or (best and size > best[0]):
+                break
+            right_sums, right_keys = right[right_size]
+            for left_sum, left_idx in left_sums:
+                missing = target_cents - left_sum
+                pos = bisect_left(right_keys, missing)
+                for candidate in (pos - 1, pos):
+                    if 0 <= candidate < len(right_keys):
+                        error = abs(missing - right_keys[candidate])
+                        if error <= max_error and (best is None or (size, error) < best[:2]):
+                            best = (size, error, left_idx + right_sums[candidate][1])
+
+    return sorted(best[2]) if best else None
+
+
+def _block_key(doc: Dict) -> str:
+    nit = _doc_nit(doc)
+    if len(nit) >= 6:
+        return f"nit:{nit}"
+    tercero = normalize_tercero(doc.get('tercero'))
+    return f"tercero:{tercero}" if tercero else ""
+
+
+def find_suma_facturas_groups(documents: List[Dict], processed_ids: Optional[set] = None,
+                              tolerance: float = SUMA_TOLERANCIA,
+                              max_facturas: int = SUMA_MAX_FACTURAS) -> List[Dict]:
+    """
+    Caso "suma de facturas": varias facturas del mismo NIT (o tercero) cuyo
+    total coincide con un comprobante de egreso o una cuenta por pagar.
+
+    El grupo incluye todos los documentos de pago del bloque con ese valor
+    (CE, CXP y soporte de pago) y las facturas encontradas. Si el bloque tiene
+    más de SUMA_MAX_CANDIDATAS facturas posibles no se intenta: es ambiguo y
+    se deja para el LLM.
+    """
+    if processed_ids is None:
+        processed_ids = set()
+
+    blocks = {}
+    for doc in documents:
+        key = _block_key(doc)
+        if key and doc['id'] not in processed_ids and (doc.get('valor') or 0) > 0:
+            blocks.setdefault(key, []).append(doc)
+
+    correlations = []
+    for docs_block in blocks.values():
+        targets = sorted(
+            (d for d in docs_block if d.get('tipo_documento') in TIPOS_PAGO),
+            key=lambda d: -d['valor']
+        )
+        for target in targets:
+            if target['id'] in processed_ids:
+                continue
+            valor = target['valor']
+
+            facturas = [
+                d for d in docs_block
+                if d.get('tipo_documento') == "factura" and d['id'] not in processed_ids
+                and d['valor'] <= valor * (1 + tolerance)
+            ]
+            if len(facturas) < 2 or len(facturas) > SUMA_MAX_CANDIDATAS:
+                continue
+
+            subset = find_subset_sum([d['valor'] for d in facturas], valor, tolerance, max_facturas)
+            if not subset:
+                continue
+
+            pagos = [
+                d for d in docs_block
+                if d.get('tipo_documento') != "factura" and d['id'] not in processed_ids
+                and abs(d['valor'] - valor) <= valor * tolerance
+            ]
+            grupo = pagos + [facturas[i] for i in subset]
+            for d in grupo:
+                processed_ids.add(d['id'])
+
+            total = sum(facturas[i]['valor'] for i in subset)
+            correlations.append(_group(
+                grupo,
+                tercero=target.get('tercero') or '',
+                nit=target.get('nit') or '',
+                valor=valor,
+                tipo_correlacion="suma_facturas",
+                confianza="alta",
+                razon_correlacion=f"{len(subset)} facturas suman ${total:,.2f} (pago de ${valor:,.2f})"
+            ))
+
+    return correlations
+
+
+def correlate_documents_basic(documents: List[Dict], sumas: bool = True) -> List[Dict]:
+    """
+    Correlación básica mejorada con múltiples criterios.
+    Se usa como fallback si Claude falla.
+
+    Con sumas=True primero se buscan facturas que sumen el valor de un pago
+    del mismo tercero (ver find_suma_facturas_groups).
+    """
+    if not documents:
+        return []
+
+    processed_ids = set()
+
+    correlations = find_suma_facturas_groups(documents, processed_ids) if sumas else []
+    correlations += _correlate_by_nit(documents, processed_ids)
+    correlations += _correlate_by_valor(documents, processed_ids)
+    correlations += _correlate_by_tercero(documents, processed_ids)
+
+    return correlations
+
+
+# Motor de clusters: pesos por criterio y umbral para unir dos documentos
+PESOS_CORRELACION = {
+    "nit": 3,
+    "valor_exacto": 3,       # ±1%
+    "valor_similar": 2,      # ±5%
+    "referencia": 4,         # misma referencia bancaria
+    "numero_documento": 4,
+    "tercero": 1,            # criterio de apoyo: palabra significativa en común
+    "fecha": 1,              # criterio de apoyo: ±30 días
+}
+UMBRAL_CLUSTER = 4
+MAX_CLUSTER = 8
+VECINOS_VALOR = 8            # vecinos por valor que se comparan con cada documento
+MAX_BLOQUE = 40              # bloques más grandes se encadenan por valor en lugar de todos contra todos
+DIAS_FECHA = 30
+
+
+class UnionFind:
+    """Conjuntos disjuntos con unión por tamaño y compresión de caminos."""
+
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, item: int) -> int:
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a: int, b: int, max_size: Optional[int] = None) -> bool:
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if max_size is not None and self.size[a] + self.size[b] > max_size:
+            return False
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return True
+
+
+def _normalize_ref(value) -> str:
+    ref = ''.join(ch for ch in str(value or '').upper() if ch.isalnum())
+    return ref if len(ref) >= 4 else ''
+
+
+def _block_pairs(members: List[int], valores: List[float]):
+    """Pares de un bloque: todos contra todos si es pequeño, si no vecinos por valor."""
+    if len(members) <= MAX_BLOQUE:
+        return combinations(members, 2)
+    ordered = sorted(members, key=lambda i: valores[i])
+    return (
+        (ordered[p], ordered[q])
+        for p in range(len(ordered))
+        for q in range(p + 1, min(p + 1 + VECINOS_VALOR, len(ordered)))
+    )
+
+
+def correlate_documents_clusters(documents: List[Dict], max_cluster: int = MAX_CLUSTER,
+                                 umbral: int = UMBRAL_CLUSTER) -> List[Dict]:
+    """
+    Correlación por clusters con varios criterios a la vez.
+
+    1. Genera pares candidatos desde índices (NIT, referencia bancaria,
+       número de documento y vecinos por valor), nunca todos contra todos.
+    2. Cada par suma los pesos de los criterios que cumple; tercero y fecha
+       solo refuerzan pares ya encontrados.
+    3. Une los pares con peso >= umbral en orden de peso descendente
+       (union-find), sin dejar que un cluster pase de max_cluster documentos.
+
+    El resultado no depende del orden de entrada y mantiene el formato de
+    suggested_batches. Costo O(n log n) con los límites de bloque y vecinos.
+    """
+    if not documents:
+        return []
+
+    # Desempate estable e independiente del orden de llegada
+    docs = sorted(documents, key=lambda d: d['id'])
+    n = len(docs)
+    valores = [d.get('valor') or 0 for d in docs]
+    nits = [_doc_nit(d) for d in docs]
+
+    edges = {}
+
+    def add(i, j, criterio):
+        key = (i, j) if i < j else (j, i)
+        edges.setdefault(key, set()).add(criterio)
+
+    # Índices por NIT, referencia bancaria y número de documento
+    for criterio, keys in (
+        ("nit", [nit if len(nit) >= 6 else '' for nit in nits]),
+        ("referencia", [_normalize_ref(d.get('referencia_bancaria')) for d in docs]),
+        ("numero_documento", [_normalize_ref(d.get('numero_documento')) for d in docs]),
+    ):
+        blocks = {}
+        for i, key in enumerate(keys):
+            if key:
+                blocks.setdefault(key, []).append(i)
+        for members in blocks.values():
+            for i, j in _block_pairs(members, valores):
+                add(i, j, criterio)
+
+    # Barrido por valor: cada documento contra sus vecinos dentro del ±5%
+    by_valor = sorted((v, i) for i, v in enumerate(valores) if v > 0)
+    for p, (valor, i) in enumerate(by_valor):
+        for valor_j, j in by_valor[p + 1:p + 1 + VECINOS_VALOR]:
+            diff = (valor_j - valor) / valor_j
+            if diff > VALOR_TOLERANCIA:
+                break
+            add(i, j, "valor_exacto" if diff <= 0.01 else "valor_similar")
+
+    # Pesos (con criterios de apoyo) y aristas que superan el umbral
+    tokens = [_doc_tokens(d) for d in docs]
+    fechas = [_doc_fecha(d) for d in docs]
+    weighted = []
+    for (i, j), criterios in edges.items():
+        if tokens[i] & tokens[j]:
+            criterios.add("tercero")
+        if fechas[i] and fechas[j] and abs((fechas[i] - fechas[j]).days) <= DIAS_FECHA:
+            criterios.add("fecha")
+        weight = sum(PESOS_CORRELACION[c] for c in criterios)
+        if weight >= umbral:
+            weighted.append((-weight, i, j))
+    weighted.sort()
+
+    # Clusters: las aristas más fuertes primero, sin superar max_cluster
+    uf = UnionFind(n)
+    accepted = [(-neg_weight, i, j) for neg_weight, i, j in weighted if uf.union(i, j, max_cluster)]
+
+    members_by_root = {}
+    for i in range(n):
+        members_by_root.setdefault(uf.find(i), []).append(i)
+    edges_by_root = {}
+    for weight, i, j in accepted:
+        edges_by_root.setdefault(uf.find(i), []).append((weight, edges[(i, j)]))
+
+    correlations = []
+    for root, members in members_by_root.items():
+        if len(members) < 2:
+            continue
+        grupo = [docs[i] for i in members]
+        criterios = set().union(*(c for _, c in edges_by_root[root]))
+        max_weight = max(w for w, _ in edges_by_root[root])
+
+        if "nit" in criterios:
+            tipo = "mismo_nit"
+        elif criterios & {"valor_exacto", "valor_similar"}:
+            tipo = "valor_exacto"
+        else:
+            tipo = "referencia"
+
+        nit_counts = Counter(nits[i] for i in members if nits[i])
+        tercero_counts = Counter(normalize_tercero(d.get('tercero')) for d in grupo if d.get('tercero'))
+        correlations.append(_group(
+            grupo,
+            tercero=tercero_counts.most_common(1)[0][0] if tercero_counts else '',
+            nit=nit_counts.most_common(1)[0][0] if nit_counts else '',
+            valor=max(valores[i] for i in members),
+            tipo_correlacion=tipo,
+            confianza="alta" if max_weight >= 6 else "media",
+            razon_correlacion="Coinciden: " + ", ".join(sorted(criterios))
+        ))
+
+    # Los grupos más grandes y de mayor valor primero
+    correlations.sort(key=lambda c: (-c['num_documentos'], -(c['valor'] or 0), c['document_ids']))
+    return correlations
+
+
+# Primera pasada en MongoDB: ventanas geométricas de valor para $bucket, de 1 a 1e12.
+# Dos valores a ±5% (medido sobre cualquiera de los dos) quedan en la misma
+# ventana o en ventanas contiguas.
+VENTANA_VALOR_RATIO = 1 / (1 - VALOR_TOLERANCIA)
+VENTANA_VALOR_LIMITES = [0] + [
+    VENTANA_VALOR_RATIO ** k for k in range(math.ceil(math.log(1e12, VENTANA_VALOR_RATIO)) + 1)
+]
+
+
+def correlation_candidates_pipeline(match: Dict, collection: str = "documents") -> List[Dict]:
+    """
+    Pipeline de agregación que agrupa en el servidor los documentos sin lote
+    por NIT + valor redondeado, NIT (o tercero), referencia, número de
+    documento y ventanas de valor (±5%). Devuelve un documento por grupo con
+    posibles correlaciones ({"criterio", "ids"}), sin $facet: cada grupo es
+    un documento del cursor y ninguno junta los ids de todos los criterios.
+    """
+    def grouped(criterio: str, key) -> List[Dict]:
+        return [
+            {"$match": match},
+            {"$group": {"_id": key, "ids": {"$push": "$id"}, "n": {"$sum": 1}}},
+            {"$match": {"_id": {"$nin": [None, ""]}, "n": {"$gte": 2}}},
+            {"$project": {"_id": 0, "criterio": criterio, "ids": 1}},
+        ]
+
+    # Ventanas de valor: cada ventana se repite en los pares (pos - 1, pos) y
+    # (pos, pos + 1); un par con 2+ documentos es una ventana con 2+ o dos
+    # ventanas contiguas no vacías. Los ids solo salen de esos pares.
+    pos = {"$indexOfArray": [VENTANA_VALOR_LIMITES, "$_id"]}
+    por_valor = [
+        {"$match": match},
+        {"$match": {"valor": {"$gt": 0}}},
+        {"$bucket": {
+            "groupBy": "$valor",
+            "boundaries": VENTANA_VALOR_LIMITES,
+            "default": "fuera_de_rango",
+            "output": {"ids": {"$push": "$id"}},
+        }},
+        {"$project": {"ids": 1, "pares": {"$cond": [
+            {"$eq": ["$_id", "fuera_de_rango"]},
+            ["fuera_de_rango"],
+            [{"$subtract": [pos, 1]}, pos],
+        ]}}},
+        {"$unwind": "$pares"},
+        {"$group": {"_id": "$pares", "ventanas": {"$push": "$ids"}}},
+        {"$project": {"ids": {"$reduce": {
+            "input": "$ventanas", "initialValue": [], "in": {"$concatArrays": ["$$value", "$$this"]}
+        }}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+        {"$project": {"_id": 0, "criterio": "por_valor", "ids": 1}},
+    ]
+
+    nit_valido = {"$cond": [{"$gte": [{"$strLenCP": {"$ifNull": ["$nit_norm", ""]}}, 6]}, "$nit_norm", None]}
+    branches = [
+        grouped("por_nit_valor", {"$cond": [
+            {"$eq": [nit_valido, None]}, None, {"nit": nit_valido, "valor": "$valor_bucket"}
+        ]}),
+        # Bloque del tercero (suma de facturas y clusters por NIT)
+        grouped("por_bloque", {"$ifNull": [nit_valido, "$tercero_norm"]}),
+        grouped("por_referencia", "$referencia_bancaria"),
+        grouped("por_numero", "$numero_documento"),
+        por_valor,
+    ]
+    return branches[0] + [
+        {"$unionWith": {"coll": collection, "pipeline": branch}} for branch in branches[1:]
+    ]
+
+
+def candidate_ids_from_groups(groups: List[Dict]) -> set:
+    """Ids que pueden correlacionarse según los grupos del pipeline de candidatos."""
+    return {doc_id for grupo in groups for doc_id in grupo['ids']}
@@ -0,0 +1,223 @@
+"""
+Eventos para GET /events (Server-Sent Events), compartidos entre procesos.
+
+- EventLog.append() guarda los eventos en la colección capped "events" de
+  Mongo con un id creciente (contador en "counters"), desde cualquier
+  proceso: workers de uvicorn, listeners de pymongo o tareas de fondo.
+- relay_events() sigue esa colección con un cursor tailable en cada proceso
+  del servidor y entrega los eventos al EventBus local, que los reparte a
+  sus suscriptores SSE. Así un cliente recibe las escrituras de todos los
+  workers, no solo las del que atiende su conexión.
+- El EventBus conserva los últimos EVENT_HISTORY eventos para que un cliente
+  que se reconecta con Last-Event-ID reciba lo que se perdió.
+- events_from_command() traduce los comandos de escritura de Mongo en
+  eventos de documentos, lotes y PDFs (transiciones de estado, altas y
+  bajas), sin instrumentar cada update del servidor.
+- Cada cliente se suscribe por temas (EVENT_TOPICS); resync llega siempre.
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import CursorType, ReturnDocument
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+EVENT_HISTORY = int(os.environ.get('EVENT_HISTORY', 500))
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+EVENT_LOG_COLLECTION = "events"
+EVENT_LOG_BYTES = int(os.environ.get('EVENT_LOG_MB', 16)) * 1024 * 1024
+# Al reabrir el cursor se relee este margen de ids: dos procesos pueden insertar fuera de orden
+RELAY_OVERLAP = 100
+
+# Tema de suscripción -> prefijo de sus eventos
+EVENT_TOPICS = {"documents": "document.", "batches": "batch.", "pdfs": "pdf.", "jobs": "job."}
+
+# Colección -> prefijo de los eventos y campos que se copian de los documentos insertados
+EVENT_COLLECTIONS = {
+    "documents": ("document", ("id", "filename", "tipo_documento", "status", "batch_id", "parent_document_id")),
+    "batches": ("batch", ("id", "status", "documentos", "pdf_generado_id")),
+    "consolidated_pdfs": ("pdf", ("id", "batch_id", "filename", "file_size", "page_count", "lazy")),
+}
+
+
+class EventLog:
+    """Escritura síncrona (pymongo) de eventos en la colección capped compartida."""
+    def __init__(self, db):
+        self.db = db
+
+    def append(self, events: List[Tuple[str, Dict[str, Any]]]):
+        if not events:
+            return
+        try:
+            counter = self.db.counters.find_one_and_update(
+                {"_id": EVENT_LOG_COLLECTION},
+                {"$inc": {"seq": len(events)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            first = counter["seq"] - len(events) + 1
+            now = datetime.now(timezone.utc)
+            self.db[EVENT_LOG_COLLECTION].insert_many([
+                {"_id": first + offset, "type": event_type, "data": data, "at": now}
+                for offset, (event_type, data) in enumerate(events)
+            ])
+        except PyMongoError as e:
+            logging.error(f"No se pudieron publicar {len(events)} eventos: {e}")
+
+
+async def ensure_event_log(db):
+    """Crea la colección capped de eventos si no existe (db es de Motor)."""
+    try:
+        await db.create_collection(EVENT_LOG_COLLECTION, capped=True, size=EVENT_LOG_BYTES)
+    except CollectionInvalid:
+        pass
+
+
+def _event_from_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": doc["_id"], "type": doc["type"], "data": doc.get("data") or {}}
+
+
+async def relay_events(db, bus: "EventBus", poll_seconds: float = 1.0):
+    """
+    Tarea de fondo de cada proceso: carga los últimos eventos del registro y
+    luego lo sigue con un cursor tailable, entregando cada evento a bus.
+    """
+    collection = db[EVENT_LOG_COLLECTION]
+    recent = await collection.find().sort("$natural", -1).limit(EVENT_HISTORY).to_list(None)
+    for doc in reversed(recent):
+        bus.deliver(_event_from_doc(doc))
+    last_id = max((doc["_id"] for doc in recent), default=0)
+
+    while True:
+        try:
+            cursor = collection.find(
+                {"_id": {"$gt": max(0, last_id - RELAY_OVERLAP)}}, cursor_type=CursorType.TAILABLE_AWAIT
+            )
+            while cursor.alive:
+                async for doc in cursor:
+                    bus.deliver(_event_from_doc(doc))
+                    last_id = max(last_id, doc["_id"])
+        except PyMongoError as e:
+            logging.warning(f"Error siguiendo el registro de eventos: {e}")
+        # El cursor muere si la colección está vacía o se reinicia la conexión
+        await asyncio.sleep(poll_seconds)
+
+
+class EventBus:
+    """Reparto local (en este proceso) de los eventos del registro a los suscriptores SSE."""
+    def __init__(self):
+        self._subscribers: List[asyncio.Queue] = []
+        self._history = deque(maxlen=EVENT_HISTORY)
+        self._history_ids = set()
+
+    def deliver(self, event: Dict[str, Any]):
+        # El relay relee un margen al reabrir el cursor: un evento ya entregado se ignora
+        if event["id"] in self._history_ids:
+            return
+        if len(self._history) == self._history.maxlen:
+            self._history_ids.discard(self._history[0]["id"])
+        self._history.append(event)
+        self._history_ids.add(event["id"])
+        for queue in list(self._subscribers):
+            # Cada suscriptor por separado: un error en uno no impide entregar a los demás
+            try:
+                if queue.full():
+                    # Cliente lento: se vacía su cola y solo recibe resync (debe recargar los listados)
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait({"id": event["id"], "type": "resync", "data": {}})
+                else:
+                    queue.put_nowait(event)
+            except (asyncio.QueueFull, asyncio.QueueEmpty):
+                logging.warning(f"No se pudo entregar el evento {event['id']} a un suscriptor")
+
+    def subscribe(self, last_event_id: Optional[int] = None) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        if last_event_id is not None:
+            missed = [event for event in self._history if event["id"] > last_event_id]
+            if self._history and min(self._history_ids) > last_event_id + 1:
+                # El historial ya no alcanza: el cliente debe recargar los listados
+                queue.put_nowait({"id": max(self._history_ids), "type": "resync", "data": {}})
+            else:
+                for event in missed[-EVENT_QUEUE_SIZE:]:
+                    queue.put_nowait(event)
+        self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+
+def parse_topics(topics: Optional[str]) -> frozenset:
+    """Temas de ?topics= (separados por comas); sin valor, todos. ValueError si alguno no existe."""
+    requested = {name.strip() for name in (topics or "").split(",") if name.strip()}
+    unknown = requested - set(EVENT_TOPICS)
+    if unknown:
+        raise ValueError(f"Temas desconocidos: {', '.join(sorted(unknown))}")
+    return frozenset(requested or EVENT_TOPICS)
+
+
+def event_in_topics(event: Dict[str, Any], topics: frozenset) -> bool:
+    return event["type"] == "resync" or any(event["type"].startswith(EVENT_TOPICS[topic]) for topic in topics)
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    """Evento en el formato de text/event-stream."""
+    data = json.dumps(event["data"], default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value))
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+def _ids_from_filter(query: Dict[str, Any]) -> Optional[List[str]]:
+    """ids afectados si el filtro es por id (valor o $in); None si es otro filtro."""
+    value = query.get("id")
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict) and isinstance(value.get("$in"), list):
+        return [item for item in value["$in"] if isinstance(item, str)]
+    return None
+
+
+def events_from_command(command_name: str, command: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Eventos (tipo, datos) de un comando de escritura sobre una colección de
+    EVENT_COLLECTIONS. Los filtros que no son por id producen un evento
+    "<prefijo>.changed" sin ids: el cliente recarga ese listado (con ETag).
+    """
+    collection = command.get(command_name)
+    if collection not in EVENT_COLLECTIONS:
+        return
+    prefix, fields = EVENT_COLLECTIONS[collection]
+
+    if command_name == "insert":
+        for doc in command.get("documents", []):
+            yield f"{prefix}.created", {field: doc.get(field) for field in fields if field in doc}
+    elif command_name == "update":
+        for update in command.get("updates", []):
+            ids = _ids_from_filter(update.get("q", {}))
+            changes = update.get("u", {})
+            changed = changes.get("$set", {}) if isinstance(changes, dict) else {}
+            data = {"ids": ids, "fields": sorted(set(changed) | set(changes.get("$unset", {}) if isinstance(changes, dict) else ()))}
+            if "status" in changed:
+                yield f"{prefix}.status", {**data, "status": changed["status"]}
+            else:
+                yield f"{prefix}.changed" if ids is None else f"{prefix}.updated", data
+    elif command_name == "delete":
+        for delete in command.get("deletes", []):
+            ids = _ids_from_filter(delete.get("q", {}))
+            yield (f"{prefix}.deleted", {"ids": ids}) if ids is not None else (f"{prefix}.changed", {"ids": None})
+    elif command_name in ("findAndModify", "findandmodify"):
+        ids = _ids_from_filter(command.get("query", {}))
+        changed = (command.get("update") or {}).get("$set", {}) if isinstance(command.get("update"), dict) else {}
+        if "status" in changed:
+            yield f"{prefix}.status", {"ids": ids, "status": changed["status"]}
+        else:
+            yield f"{prefix}.updated" if ids is not None else f"{prefix}.changed", {"ids": ids, "fields": sorted(changed)}
@@ -0,0 +1,406 @@
+"""
+Operaciones de PDF e imágenes que consumen CPU.
+
+Son funciones puras (bytes -> resultado) para poder ejecutarlas en el pool
+de procesos de workers.py sin bloquear el event loop de FastAPI.
+"""
+import hashlib
+import io
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from PyPDF2.generic import (
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+def is_pdf(filename: str, mime_type: str) -> bool:
+    return (filename or '').lower().endswith('.pdf') or 'pdf' in (mime_type or '').lower()
+
+
+def is_image(filename: str, mime_type: str) -> bool:
+    return (filename or '').lower().endswith(IMAGE_EXTENSIONS) or 'image' in (mime_type or '').lower()
+
+
+def validate_file(file_data: bytes, filename: str, mime_type: str) -> Optional[str]:
+    """
+    Verifica que un archivo subido se pueda leer.
+    Devuelve None si es válido o el mensaje de error para el usuario.
+    """
+    if not file_data:
+        return "Archivo vacío o corrupto"
+
+    if is_pdf(filename, mime_type):
+        try:
+            reader = PdfReader(io.BytesIO(file_data))
+            if len(reader.pages) == 0:
+                raise ValueError("PDF sin páginas")
+        except Exception as e:
+            return f"PDF inválido: {str(e)}"
+
+    elif is_image(filename, mime_type):
+        try:
+            img = Image.open(io.BytesIO(file_data))
+            img.verify()
+        except Exception as e:
+            return f"Imagen inválida: {str(e)}"
+
+    return None
+
+
+def count_pages(pdf_data: bytes) -> int:
+    """Número de páginas de un PDF."""
+    return len(PdfReader(io.BytesIO(pdf_data)).pages)
+
+
+# Páginas revisadas para decidir si un PDF tiene capa de texto
+TEXT_LAYER_PAGES = 3
+
+
+def extract_file_metadata(file_data: bytes, filename: str, mime_type: str) -> Dict[str, Any]:
+    """
+    Metadatos de un archivo subido, calculados una sola vez al cargarlo:
+    sha256, page_count, encrypted, has_text_layer, width/height (puntos en
+    PDF, píxeles en imágenes), dpi y validation_error (resultado de validate_file).
+    """
+    info = {
+        "sha256": hashlib.sha256(file_data or b"").hexdigest(),
+        "page_count": None,
+        "encrypted": False,
+        "has_text_layer": False,
+        "width": None,
+        "height": None,
+        "dpi": None,
+        "validation_error": validate_file(file_data, filename, mime_type),
+    }
+    if info["validation_error"]:
+        return info
+
+    if is_pdf(filename, mime_type):
+        reader = PdfReader(io.BytesIO(file_data))
+        info["encrypted"] = reader.is_encrypted
+        if reader.is_encrypted:
+            try:
+                reader.decrypt("")
+            except Exception:
+                return info
+        info["page_count"] = len(reader.pages)
+        if reader.pages:
+            box = reader.pages[0].mediabox
+            info["width"], info["height"] = round(float(box.width), 2), round(float(box.height), 2)
+        for page in list(reader.pages)[:TEXT_LAYER_PAGES]:
+            try:
+                if (page.extract_text() or "").strip():
+                    info["has_text_layer"] = True
+                    break
+            except Exception:
+                continue
+
+    elif is_image(filename, mime_type):
+        img = Image.open(io.BytesIO(file_data))
+        info["page_count"] = 1
+        info["width"], info["height"] = img.size
+        dpi = img.info.get("dpi")
+        if dpi:
+            info["dpi"] = round(float(dpi[0]))
+
+    return info
+
+
+def split_pdf_to_pages(pdf_data: bytes) -> List[bytes]:
+    """Divide un PDF en páginas individuales, cada una como bytes de PDF"""
+    pages = []
+    try:
+        reader = PdfReader(io.BytesIO(pdf_data))
+        for page_num in range(len(reader.pages)):
+            writer = PdfWriter()
+            writer.add_page(reader.pages[page_num])
+            
+            page_buffer = io.BytesIO()
+            writer.write(page_buffer)
+            page_buffer.seek(0)
+            pages.append(page_buffer.read())
+    except Exception as e:
+        logging.error(f"Error splitting PDF: {str(e)}")
+    return pages
+
+
+def extract_page(pdf_data: bytes, page_number: int) -> bytes:
+    """Genera un PDF con solo la página page_number (1-based) del PDF original."""
+    reader = PdfReader(io.BytesIO(pdf_data))
+    writer = PdfWriter()
+    writer.add_page(reader.pages[page_number - 1])
+    page_buffer = io.BytesIO()
+    writer.write(page_buffer)
+    return page_buffer.getvalue()
+
+
+class ReaderCache:
+    """
+    Un PdfReader por blob dentro de una misma unión: las páginas virtuales de
+    un mismo documento padre comparten el objeto bytes y se parsean una vez.
+    """
+    def __init__(self):
+        self._readers = {}
+
+    def get(self, file_data: bytes) -> PdfReader:
+        key = id(file_data)
+        if key not in self._readers:
+            self._readers[key] = (file_data, PdfReader(io.BytesIO(file_data)))
+        return self._readers[key][1]
+
+    def release(self, file_data: bytes):
+        """Descarta el lector de un blob: el writer ya tiene copia de las páginas que se agregaron."""
+        self._readers.pop(id(file_data), None)
+
+
+# Conversión de imágenes a PDF: resolución objetivo de los escaneos, lado
+# máximo en píxeles cuando la imagen no declara DPI y calidad al recomprimir
+IMAGE_TARGET_DPI = int(os.environ.get('IMAGE_TARGET_DPI', 200))
+IMAGE_MAX_SIDE_PX = int(os.environ.get('IMAGE_MAX_SIDE_PX', 3508))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+
+# Orientación EXIF -> rotación de la página (/Rotate, en sentido horario)
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ROTATIONS = {1: 0, 3: 180, 6: 90, 8: 270}
+
+JPEG_COLOR_SPACES = {'RGB': '/DeviceRGB', 'L': '/DeviceGray'}
+
+
+def _image_dpi(img: Image.Image) -> Optional[float]:
+    dpi = img.info.get('dpi')
+    if dpi and dpi[0] and float(dpi[0]) > 1:
+        return float(dpi[0])
+    return None
+
+
+def _downsample_factor(img: Image.Image) -> float:
+    """Escala (< 1) para llevar la imagen a IMAGE_TARGET_DPI o a IMAGE_MAX_SIDE_PX; 1 si no hace falta."""
+    dpi = _image_dpi(img)
+    if dpi:
+        return min(1.0, IMAGE_TARGET_DPI / dpi)
+    return min(1.0, IMAGE_MAX_SIDE_PX / max(img.size))
+
+
+def _add_jpeg_page(pdf_writer: PdfWriter, jpeg_data: bytes, width_px: int, height_px: int,
+                   mode: str, page_width: float, page_height: float, rotate: int = 0):
+    """Agrega una página con el stream JPEG embebido tal cual (DCTDecode), sin decodificarlo."""
+    image = EncodedStreamObject()
+    image._data = jpeg_data
+    image.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Image'),
+        NameObject('/Width'): NumberObject(width_px),
+        NameObject('/Height'): NumberObject(height_px),
+        NameObject('/ColorSpace'): NameObject(JPEG_COLOR_SPACES[mode]),
+        NameObject('/BitsPerComponent'): NumberObject(8),
+        NameObject('/Filter'): NameObject('/DCTDecode'),
+    })
+    content = DecodedStreamObject()
+    content.set_data(f"q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q".encode())
+    
+    page = PageObject.create_blank_page(width=page_width, height=page_height)
+    page[NameObject('/Resources')] = DictionaryObject({
+        NameObject('/XObject'): DictionaryObject({NameObject('/Im0'): pdf_writer._add_object(image)})
+    })
+    page[NameObject('/Contents')] = pdf_writer._add_object(content)
+    if rotate:
+        page[NameObject('/Rotate')] = NumberObject(rotate)
+    pdf_writer.add_page(page)
+
+
+def add_image_page(pdf_writer: PdfWriter, file_data: bytes):
+    """
+    Agrega una imagen como página del PDF.
+    
+    - JPEG RGB/gris con orientación EXIF simple: se embebe el archivo original
+      (sin recomprimir) y la orientación se aplica con /Rotate.
+    - Escaneos por encima de IMAGE_TARGET_DPI (o de IMAGE_MAX_SIDE_PX si no
+      declaran DPI): se reducen y se embeben como JPEG.
+    - Otros formatos: conversión con PIL, como antes.
+    
+    El tamaño de la página respeta el DPI declarado (72 si no lo tiene).
+    """
+    img = Image.open(io.BytesIO(file_data))
+    dpi = _image_dpi(img) or 72.0
+    page_width, page_height = img.size[0] * 72.0 / dpi, img.size[1] * 72.0 / dpi
+    orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    factor = _downsample_factor(img)
+    
+    if img.format == 'JPEG' and img.mode in JPEG_COLOR_SPACES and orientation in EXIF_ROTATIONS and factor == 1.0:
+        # La página se dibuja con la orientación almacenada y /Rotate la gira al mostrarla
+        _add_jpeg_page(pdf_writer, file_data, img.size[0], img.size[1], img.mode,
+                       page_width, page_height, EXIF_ROTATIONS[orientation])
+        return
+    
+    # Aplicar la orientación EXIF a los píxeles antes de reducir o convertir
+    img = ImageOps.exif_transpose(img)
+    page_width, page_height = img.size[0] * 72.0 / dpi, img.size[1] * 72.0 / dpi
+    
+    if factor < 1.0:
+        size = (max(1, round(img.size[0] * factor)), max(1, round(img.size[1] * factor)))
+        img = img.convert('L' if img.mode in ('L', 'LA', '1') else 'RGB').resize(size, Image.LANCZOS)
+        jpeg_buffer = io.BytesIO()
+        img.save(jpeg_buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        _add_jpeg_page(pdf_writer, jpeg_buffer.getvalue(), img.size[0], img.size[1], img.mode, page_width, page_height)
+        return
+    
+    # Convertir imagen a RGB si es necesario
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='PDF', resolution=dpi)
+    for pdf_page in PdfReader(io.BytesIO(img_buffer.getvalue())).pages:
+        pdf_writer.add_page(pdf_page)
+
+
+# Miniaturas: lado mayor en píxeles, formato y calidad
+THUMBNAIL_MAX_PX = int(os.environ.get('THUMBNAIL_MAX_PX', 320))
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_MIME_TYPE = 'image/webp'
+THUMBNAIL_QUALITY = 70
+
+
+def _render_pdf_page(pdf_data: bytes, page_number: int) -> Optional[Image.Image]:
+    """
+    Imagen de una página de un PDF: con pdf2image (poppler) si está instalado;
+    si no, la imagen embebida más grande de la página (los escaneos son una
+    sola imagen por página). None si la página no tiene imágenes.
+    """
+    try:
+        from pdf2image import convert_from_bytes
+        images = convert_from_bytes(pdf_data, first_page=page_number, last_page=page_number,
+                                    size=(THUMBNAIL_MAX_PX * 2, None))
+        if images:
+            return images[0]
+    except Exception as e:
+        logging.debug(f"pdf2image no disponible para la miniatura: {e}")
+    
+    page = PdfReader(io.BytesIO(pdf_data)).pages[page_number - 1]
+    embedded = [image.data for image in page.images]
+    if not embedded:
+        return None
+    img = Image.open(io.BytesIO(max(embedded, key=len)))
+    img.draft('RGB', (THUMBNAIL_MAX_PX, THUMBNAIL_MAX_PX))
+    rotation = page.get('/Rotate', 0) % 360
+    return img.rotate(-rotation, expand=True) if rotation else img
+
+
+def render_thumbnail(file_data: bytes, filename: str, mime_type: str,
+                     page_number: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Miniatura WebP de la primera página (o de page_number) de un PDF, o de una
+    imagen. Devuelve {"data", "mime_type", "width", "height"}, o None si no
+    se pudo dibujar la página.
+    """
+    if is_image(filename, mime_type):
+        img = Image.open(io.BytesIO(file_data))
+        # JPEG: se decodifica ya reducido (1/2, 1/4 o 1/8); draft solo sirve antes de cargar los píxeles
+        img.draft('RGB', (THUMBNAIL_MAX_PX, THUMBNAIL_MAX_PX))
+        img = ImageOps.exif_transpose(img)
+    else:
+        img = _render_pdf_page(file_data, page_number or 1)
+        if img is None:
+            return None
+    
+    img = img.convert('RGB') if img.mode not in ('RGB', 'L') else img
+    img.thumbnail((THUMBNAIL_MAX_PX, THUMBNAIL_MAX_PX), Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return {"data": buffer.getvalue(), "mime_type": THUMBNAIL_MIME_TYPE, "width": img.size[0], "height": img.size[1]}
+
+
+def add_source_pages(pdf_writer: PdfWriter, readers: ReaderCache, mime_type: str,
+                     file_data: bytes, page_number: Optional[int] = None) -> int:
+    """
+    Agrega un documento al writer y devuelve cuántas páginas aportó. Los PDF
+    aportan todas sus páginas, o solo page_number si es una página virtual
+    (file_data es entonces el PDF padre), y las imágenes se convierten a PDF.
+    """
+    # Si es PDF, agregar sus páginas directamente desde el lector del blob
+    if mime_type == 'application/pdf':
+        pdf_reader = readers.get(file_data)
+        pages = [pdf_reader.pages[page_number - 1]] if page_number else pdf_reader.pages
+    # Si es imagen, agregarla directamente como página
+    elif 'image' in mime_type:
+        add_image_page(pdf_writer, file_data)
+        return 1
+    else:
+        return 0
+    
+    added = 0
+    for pdf_page in pages:
+        pdf_writer.add_page(pdf_page)
+        added += 1
+    return added
+
+
+def _image_key(image: StreamObject) -> bytes:
+    """Huella de una imagen: su diccionario y sus datos tal como se escriben."""
+    buffer = io.BytesIO()
+    image.write_to_stream(buffer, None)
+    return hashlib.sha256(buffer.getvalue()).digest()
+
+
+def _dedup_resource_images(resources, seen: Dict[bytes, IndirectObject], merged: set, visited: set):
+    """
+    Apunta las imágenes repetidas de un diccionario /Resources a la primera
+    con el mismo contenido. Entra en los Form XObjects, que tienen sus propios
+    /Resources. merged acumula los objetos que dejaron de usarse.
+    """
+    resources = resources.get_object() if resources is not None else None
+    if not isinstance(resources, DictionaryObject) or '/XObject' not in resources:
+        return
+    xobjects = resources['/XObject'].get_object()
+    for name in list(xobjects.keys()):
+        reference = xobjects.raw_get(name)
+        if not isinstance(reference, IndirectObject) or reference.idnum in visited:
+            continue
+        xobject = reference.get_object()
+        if xobject.get('/Subtype') == '/Form':
+            visited.add(reference.idnum)
+            _dedup_resource_images(xobject.get('/Resources'), seen, merged, visited)
+            continue
+        if xobject.get('/Subtype') != '/Image':
+            continue
+        canonical = seen.setdefault(_image_key(xobject), reference)
+        if canonical.idnum != reference.idnum:
+            xobjects[NameObject(name)] = canonical
+            merged.add(reference.idnum)
+
+
+def optimize_pdf_writer(pdf_writer: PdfWriter) -> Tuple[PdfWriter, int]:
+    """
+    Optimiza un PdfWriter antes de escribirlo:
+    - comprime (FlateDecode) los content streams de cada página;
+    - deduplica las imágenes (XObject /Image) que alcanzan los /Resources de
+      las páginas, p. ej. el logo que se repite en cada comprobante: los
+      nombres de recurso pasan a apuntar a una sola copia.
+    PyPDF2 escribe todos los objetos del writer, usados o no, así que las
+    páginas se copian a un writer nuevo (add_page solo copia lo que las
+    páginas alcanzan; los datos de los streams no se duplican). El writer
+    nuevo no tiene marcadores. Devuelve ese writer y cuántas imágenes se
+    eliminaron.
+    """
+    seen: Dict[bytes, IndirectObject] = {}
+    merged: set = set()
+    visited: set = set()
+    for page in pdf_writer.pages:
+        page.compress_content_streams()
+        _dedup_resource_images(page.get('/Resources'), seen, merged, visited)
+    
+    optimized = PdfWriter()
+    for page in pdf_writer.pages:
+        optimized.add_page(page)
+    return optimized, len(merged)
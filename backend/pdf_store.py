@@ -0,0 +1,283 @@
+"""
+Escritura de PDFs consolidados directamente en GridFS.
+
+write_consolidated_pdf se ejecuta en el pool de procesos (workers.py) con un
+cliente pymongo síncrono propio de cada worker: lee los documentos fuente de
+Mongo uno por uno y escribe el PDF por chunks en GridFS, sin enviarlo de
+vuelta al proceso del servidor. El PdfWriter sí tiene en memoria una copia
+de todas las páginas hasta escribirlo: el lector de cada fuente se libera
+apenas se agregan sus páginas y max_bytes limita lo que se carga.
+
+Cada PDF guarda su composición (documento, huella, rango de páginas y
+posición en bytes) y un marcador por documento; al regenerarlo solo se
+procesan los documentos reemplazados o agregados, y extract_section
+recorta la sección de un documento sin volver a leer las fuentes.
+"""
+import hashlib
+import io
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from gridfs import GridFSBucket
+from pymongo import MongoClient
+from PyPDF2 import PdfReader, PdfWriter
+
+from pdf_ops import ReaderCache, add_source_pages, optimize_pdf_writer
+from versioning import VERSIONED_COLLECTIONS, CollectionVersions, version_store
+
+_db = None
+
+
+def get_sync_db():
+    """
+    Conexión síncrona a Mongo del proceso actual (se crea en el worker). Sus
+    escrituras también incrementan collection_versions (ETags de los listados).
+    """
+    global _db
+    if _db is None:
+        versions = CollectionVersions(collections=VERSIONED_COLLECTIONS)
+        versions.bind(version_store(os.environ['MONGO_URL'], os.environ['DB_NAME']))
+        _db = MongoClient(os.environ['MONGO_URL'], event_listeners=[versions])[os.environ['DB_NAME']]
+    return _db
+
+
+class ConsolidationTooLarge(Exception):
+    """Los documentos cargados para un PDF superan el tope de memoria (max_bytes)."""
+
+
+class _NullSink:
+    def write(self, data: bytes):
+        pass
+
+
+class _CountingStream:
+    """
+    Adaptador de GridIn para PdfWriter: GridIn no implementa tell(), que
+    PyPDF2 usa para la tabla xref, así que se cuentan los bytes escritos.
+    """
+    def __init__(self, grid_in):
+        self._grid_in = grid_in
+        self.position = 0
+
+    def write(self, data: bytes) -> int:
+        self._grid_in.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+
+def source_fingerprint(file_data: bytes, page_number: Optional[int] = None) -> str:
+    """Huella de un documento dentro de un PDF consolidado: sha256 del blob (+ página si es virtual)."""
+    digest = hashlib.sha256(file_data).hexdigest()
+    return f"{digest}#p{page_number}" if page_number else digest
+
+
+class SourceLoader:
+    """
+    Carga cada documento al momento de agregarlo al PDF. Las páginas virtuales
+    devuelven el PDF padre (leído una sola vez) y su número de página.
+    """
+    PROJECTION = {"_id": 0, "filename": 1, "mime_type": 1, "file_data": 1, "parent_document_id": 1, "page_number": 1}
+
+    def __init__(self, db):
+        self.db = db
+        self.parents: Dict[str, Optional[bytes]] = {}
+
+    def load(self, doc_id: str) -> Optional[Tuple]:
+        doc = self.db.documents.find_one({"id": doc_id}, self.PROJECTION)
+        if not doc:
+            return None
+        if doc.get('file_data'):
+            return doc['filename'], doc.get('mime_type', ''), doc['file_data'], None
+        if doc.get('parent_document_id') and doc.get('page_number'):
+            parent_id = doc['parent_document_id']
+            if parent_id not in self.parents:
+                parent = self.db.documents.find_one({"id": parent_id}, {"_id": 0, "file_data": 1})
+                self.parents[parent_id] = (parent or {}).get('file_data')
+            if self.parents[parent_id]:
+                return doc['filename'], "application/pdf", self.parents[parent_id], doc['page_number']
+        return None
+
+
+def consolidate(db, items: List[Dict[str, Any]], previous_reader: Optional[PdfReader] = None,
+                previous_composition: Optional[List[Dict[str, Any]]] = None,
+                max_bytes: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Motor de consolidación. items es la lista ordenada de {"doc_id", "fingerprint",
+    "title"} (fingerprint puede ser None si no se conoce; title es el texto del
+    marcador del documento, por defecto su nombre de archivo). Los documentos cuya huella
+    coincide con la composición del PDF anterior copian su rango de páginas
+    desde previous_reader; los demás se cargan y procesan.
+    Las páginas se copian al writer documento por documento y el lector de
+    cada archivo se descarta en seguida (los PDF padre de páginas virtuales
+    se conservan, otras páginas pueden usarlos). Si los archivos cargados
+    suman más de max_bytes se lanza ConsolidationTooLarge.
+    Devuelve el writer, la nueva composición, los fallidos ({"doc_id",
+    "filename", "reason"}) y cuántos se reutilizaron.
+    """
+    previous = {}
+    if previous_reader is not None:
+        previous = {entry['fingerprint']: entry for entry in (previous_composition or []) if entry.get('fingerprint')}
+    
+    writer = PdfWriter()
+    readers = ReaderCache()
+    loader = SourceLoader(db)
+    composition = []
+    failed = []
+    reused = 0
+    loaded_bytes = 0
+    loaded_parents = set()
+    
+    for item in items:
+        start_page = len(writer.pages)
+        fingerprint = item.get('fingerprint')
+        
+        title = item.get('title')
+        
+        if fingerprint in previous:
+            entry = previous[fingerprint]
+            for index in range(entry['start_page'], entry['start_page'] + entry['page_count']):
+                writer.add_page(previous_reader.pages[index])
+            reused += 1
+        else:
+            source = loader.load(item['doc_id'])
+            if not source:
+                failed.append({"doc_id": item['doc_id'], "filename": None, "reason": "Documento sin contenido o no encontrado"})
+                continue
+            filename, mime_type, file_data, page_number = source
+            # Un PDF padre cuenta una sola vez (SourceLoader lo conserva para sus demás páginas)
+            if not page_number or id(file_data) not in loaded_parents:
+                if page_number:
+                    loaded_parents.add(id(file_data))
+                loaded_bytes += len(file_data)
+                if max_bytes and loaded_bytes > max_bytes:
+                    raise ConsolidationTooLarge(
+                        f"Los documentos del PDF superan {max_bytes // (1024 * 1024)}MB en memoria"
+                    )
+            fingerprint = source_fingerprint(file_data, page_number)
+            title = title or filename
+            try:
+                add_source_pages(writer, readers, mime_type, file_data, page_number)
+            except Exception as e:
+                logging.error(f"Error adding document {filename} to PDF: {str(e)}")
+                failed.append({"doc_id": item['doc_id'], "filename": filename, "reason": str(e)})
+                continue
+            finally:
+                if not page_number:
+                    readers.release(file_data)
+        
+        composition.append({
+            "doc_id": item['doc_id'],
+            "fingerprint": fingerprint,
+            "title": title or item['doc_id'],
+            "start_page": start_page,
+            "page_count": len(writer.pages) - start_page
+        })
+    
+    add_document_outline(writer, composition)
+    return {"writer": writer, "composition": composition, "failed": failed, "reused": reused}
+
+
+def add_document_outline(writer: PdfWriter, composition: List[Dict[str, Any]]):
+    """Un marcador (outline) por documento que apunta a su primera página."""
+    for entry in composition:
+        if entry['page_count'] > 0:
+            writer.add_outline_item(entry['title'], entry['start_page'])
+
+
+def object_offsets(written: PdfReader) -> Dict[int, int]:
+    """Posición en el archivo de cada objeto (idnum -> byte), según la tabla xref del PDF escrito."""
+    return dict(written.xref.get(0, {}))
+
+
+def record_byte_ranges(writer: PdfWriter, composition: List[Dict[str, Any]], object_offsets: Dict[int, int]):
+    """
+    Agrega a cada entrada de la composición byte_range: posición en el archivo
+    del primer y del último objeto página del documento (ver object_offsets).
+    """
+    for entry in composition:
+        offsets = [
+            object_offsets.get(writer.pages[index].indirect_reference.idnum)
+            for index in range(entry['start_page'], entry['start_page'] + entry['page_count'])
+        ]
+        offsets = [offset for offset in offsets if offset is not None]
+        entry['byte_range'] = [min(offsets), max(offsets)] if offsets else None
+
+
+def write_consolidated_pdf(items: List[Dict[str, Any]], filename: str, metadata: Dict[str, Any],
+                           previous_gridfs_id: Optional[str] = None,
+                           previous_composition: Optional[List[Dict[str, Any]]] = None,
+                           optimize: bool = False, max_bytes: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Consolida items (ver consolidate, con su tope max_bytes) y guarda el PDF en GridFS. Si se indica el
+    PDF anterior del lote, sus rangos de páginas sin cambios se copian de él.
+    Con optimize se deduplican las imágenes repetidas y se comprimen los content streams
+    (ver pdf_ops.optimize_pdf_writer), midiendo el tamaño antes y después.
+    Devuelve gridfs_id, file_size, page_count, composition, failed, reused
+    y, si se optimizó, original_size y objects_deduplicated.
+    """
+    db = get_sync_db()
+    bucket = GridFSBucket(db)
+    
+    previous_reader = None
+    if previous_gridfs_id and previous_composition:
+        try:
+            # GridOut es de solo lectura y admite seek: PdfReader lee los chunks bajo demanda
+            previous_reader = PdfReader(bucket.open_download_stream(ObjectId(previous_gridfs_id)))
+        except Exception as e:
+            logging.warning(f"No se pudo abrir el PDF anterior {previous_gridfs_id}: {e}")
+    
+    result = consolidate(db, items, previous_reader, previous_composition, max_bytes)
+    writer = result.pop('writer')
+    
+    if optimize:
+        # Tamaño sin optimizar: se serializa una vez sin guardar los bytes
+        measure = _CountingStream(_NullSink())
+        writer.write(measure)
+        result['original_size'] = measure.position
+        writer, result['objects_deduplicated'] = optimize_pdf_writer(writer)
+        # El writer optimizado es nuevo: se le agregan otra vez los marcadores
+        add_document_outline(writer, result['composition'])
+    
+    grid_in = bucket.open_upload_stream(filename, metadata=metadata)
+    stream = _CountingStream(grid_in)
+    try:
+        writer.write(stream)
+    except Exception:
+        grid_in.abort()
+        raise
+    grid_in.close()
+    # Las posiciones salen de la xref del archivo guardado (GridOut admite seek: solo se lee el final)
+    written = PdfReader(bucket.open_download_stream(grid_in._id))
+    record_byte_ranges(writer, result['composition'], object_offsets(written))
+    
+    return {
+        **result,
+        "gridfs_id": str(grid_in._id),
+        "file_size": stream.position,
+        "page_count": len(writer.pages)
+    }
+
+
+def extract_section(gridfs_id: Optional[str], start_page: int, page_count: int,
+                    pdf_data: Optional[bytes] = None) -> bytes:
+    """
+    Recorta las páginas [start_page, start_page + page_count) de un PDF
+    consolidado (en GridFS o, en registros antiguos, pdf_data) a un PDF nuevo.
+    """
+    if gridfs_id:
+        # GridOut admite seek: solo se leen los chunks de las páginas pedidas
+        source = GridFSBucket(get_sync_db()).open_download_stream(ObjectId(gridfs_id))
+    else:
+        source = io.BytesIO(pdf_data)
+    reader = PdfReader(source)
+    writer = PdfWriter()
+    for index in range(start_page, start_page + page_count):
+        writer.add_page(reader.pages[index])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
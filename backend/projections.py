@@ -0,0 +1,51 @@
+"""
+Proyecciones de Mongo para los endpoints de listado.
+
+Los listados devuelven solo los campos que muestran las tablas del frontend
+(sin analisis_completo, claves de correlación ni composición de PDFs). El
+parámetro fields= agrega campos de detalle a la proyección base:
+fields=analisis_completo,concepto o fields=* para el documento completo.
+"""
+from typing import Dict, Iterable, Optional
+
+DOCUMENT_LIST_FIELDS = (
+    "id", "filename", "tipo_documento", "status", "batch_id", "mime_type", "file_size",
+    "uploaded_at", "created_at", "parent_document_id", "page_number", "replaced_at",
+    "tercero", "nit", "valor", "fecha", "numero_documento", "thumbnail_key", "file_info.page_count",
+)
+
+BATCH_LIST_FIELDS = (
+    "id", "created_by", "created_at", "status", "documentos", "pdf_generado_id",
+    "requiere_revision", "mensaje_revision", "needs_regeneration", "optimize_pdf", "lazy_pdf",
+)
+
+PDF_LIST_FIELDS = (
+    "id", "batch_id", "filename", "created_at", "created_by", "file_size", "page_count",
+    "lazy", "optimized", "original_size",
+)
+
+# Campos binarios o internos que nunca se devuelven en un listado
+FORBIDDEN_FIELDS = {"_id", "file_data", "pdf_data"}
+
+
+def list_projection(base: Iterable[str], fields: Optional[str] = None) -> Dict[str, int]:
+    """
+    Proyección de base más los campos de fields (separados por comas; admite
+    rutas con punto). Con fields=* se devuelve todo salvo FORBIDDEN_FIELDS.
+    Lanza ValueError si se pide un campo no permitido.
+    """
+    requested = [name.strip() for name in (fields or "").split(",") if name.strip()]
+    if "*" in requested:
+        return {"_id": 0, **{name: 0 for name in sorted(FORBIDDEN_FIELDS - {"_id"})}}
+
+    for name in requested:
+        if name.startswith("$") or name.split(".")[0] in FORBIDDEN_FIELDS:
+            raise ValueError(f"Campo no permitido: {name}")
+
+    # Un campo padre incluye a sus subcampos (Mongo rechaza "a" y "a.b" a la vez)
+    paths = sorted(set(base) | set(requested), key=len)
+    selected = []
+    for path in paths:
+        if not any(path.startswith(parent + ".") for parent in selected):
+            selected.append(path)
+    return {"_id": 0, **{path: 1 for path in selected}}
@@ -1,24 +1,68 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, status, Header
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, status, Header, Query, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from cachetools import LRUCache
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uuid
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
 from emergentintegrations.llm.chat import LlmChat, UserMessage, FileContentWithMimeType
 import io
-from PyPDF2 import PdfReader, PdfWriter, PdfMerger
-from PIL import Image
 import json
 import tempfile
 import re
+import hashlib
+import secrets
+from contextlib import contextmanager
+
+from pdf_ops import (
+    THUMBNAIL_MAX_PX,
+    count_pages,
+    extract_file_metadata,
+    extract_page,
+    is_image,
+    render_thumbnail,
+    split_pdf_to_pages,
+    validate_file,
+)
+from compression import CompressionMiddleware, compression_metrics
+from events import (
+    EventBus,
+    EventLog,
+    ensure_event_log,
+    event_in_topics,
+    events_from_command,
+    format_sse,
+    parse_topics,
+    relay_events,
+)
+from versioning import VERSIONED_COLLECTIONS, VERSIONS_COLLECTION, CollectionVersions, collection_etag, etag_matches
+from pdf_store import ConsolidationTooLarge, extract_section, write_consolidated_pdf
+from projections import BATCH_LIST_FIELDS, DOCUMENT_LIST_FIELDS, PDF_LIST_FIELDS, list_projection
+from workers import PDF_WORKERS, PoolTaskError, pool_metrics, run_in_pool, shutdown_pool, warm_pool
+from correlation import (
+    candidate_ids_from_groups,
+    correlate_documents_basic,
+    correlate_documents_clusters,
+    correlation_candidates_pipeline,
+    correlation_keys,
+    find_suma_facturas_groups,
+    normalize_tercero,
+    tercero_substrings,
+    tercero_tokens,
+    tercero_trigrams,
+)
 
 ROOT_DIR = Path(__file__).parent
 
@@ -63,10 +107,35 @@ def generate_pdf_filename_from_batch(docs: list) -> str:
 
 load_dotenv(ROOT_DIR / '.env')
 
+# Cliente síncrono de los listeners de pymongo (no deben usar el cliente que los invoca):
+# contadores de versión y registro de eventos, compartidos por todos los procesos
+listener_db = MongoClient(os.environ['MONGO_URL'])[os.environ['DB_NAME']]
+
+# Eventos para GET /events: las escrituras confirmadas en documents, batches y
+# consolidated_pdfs se guardan como cambios de estado, altas y bajas en el registro
+# compartido (event_log); cada proceso los reparte a sus clientes SSE (event_bus)
+event_log = EventLog(listener_db)
+event_bus = EventBus()
+
+def publish_write_events(command_name: str, command: Dict[str, Any]):
+    events = list(events_from_command(command_name, command))
+    if not events:
+        return None
+    return lambda: event_log.append(events)
+
+async def publish_event(event_type: str, data: Dict[str, Any]):
+    """Publica un evento (p. ej. progreso de un trabajo) en el registro compartido."""
+    await asyncio.to_thread(event_log.append, [(event_type, data)])
+
+# Versión por colección (se incrementa en Mongo en cada escritura) para los ETags de los listados
+collection_versions = CollectionVersions(on_write=publish_write_events, collections=VERSIONED_COLLECTIONS)
+collection_versions.bind(listener_db[VERSIONS_COLLECTION])
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[collection_versions])
 db = client[os.environ['DB_NAME']]
+fs_bucket = AsyncIOMotorGridFSBucket(db)
 
 # JWT Configuration
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
@@ -76,7 +145,8 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 480
 # Emergent LLM Key
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
 
-app = FastAPI()
+# orjson serializa las respuestas JSON (datetime incluido) mucho más rápido que json
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 # Models
@@ -153,6 +223,8 @@ class DocumentBatch(BaseModel):
     pdf_generado_id: Optional[str] = None
     requiere_revision: bool = False
     mensaje_revision: Optional[str] = None
+    optimize_pdf: bool = False  # Deduplicar objetos y comprimir el PDF consolidado
+    lazy_pdf: bool = False  # Guardar solo la composición y generar el PDF en la primera descarga
 
 class ConsolidatedPDF(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -162,6 +234,20 @@ class ConsolidatedPDF(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str
     file_size: int
+    page_count: Optional[int] = None
+    # Modo diferido: solo la composición; el PDF se genera (y cachea) al descargarlo
+    lazy: bool = False
+    composition_hash: Optional[str] = None
+    # Optimización opcional (por lote): tamaño antes de deduplicar/comprimir
+    optimized: bool = False
+    original_size: Optional[int] = None
+    objects_deduplicated: Optional[int] = None
+
+class BulkPdfRequest(BaseModel):
+    """Generación masiva: lista de lotes o filtro por estado (p. ej. todos los en_proceso)."""
+    batch_ids: Optional[List[str]] = None
+    status: Optional[str] = None
+    optimize: Optional[bool] = None
 
 class AuditLog(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -218,6 +304,722 @@ async def log_action(user: User, action: str, details: str):
     doc['timestamp'] = doc['timestamp'].isoformat()
     await db.audit_logs.insert_one(doc)
 
+def with_correlation_keys(update_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Agrega las llaves de correlación (nit_norm, tercero_*, valor_bucket, fecha_dt) de los campos escritos."""
+    update_data.update(correlation_keys(update_data))
+    return update_data
+
+# Documentos re-analizados a la vez en reanalyze_group
+REANALYZE_CONCURRENCY = 4
+
+# Archivos validados a la vez (y en memoria) en la validación masiva
+VALIDATION_CONCURRENCY = int(os.environ.get('VALIDATION_CONCURRENCY', 8))
+
+# Versión de las llaves de correlación; subirla obliga a recalcularlas en todos los documentos
+CORRELATION_KEYS_VERSION = 1
+
+async def backfill_correlation_keys(batch_size: int = 500):
+    """Migración en segundo plano: calcula las llaves de correlación de documentos existentes."""
+    query = {"correlation_keys_version": {"$ne": CORRELATION_KEYS_VERSION}}
+    projection = {"_id": 0, "id": 1, "nit": 1, "tercero": 1, "valor": 1, "fecha": 1}
+    total = 0
+    try:
+        while True:
+            docs = await db.documents.find(query, projection).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            await db.documents.bulk_write([
+                UpdateOne({"id": doc['id']}, {"$set": {
+                    **correlation_keys({field: doc.get(field) for field in ("nit", "tercero", "valor", "fecha")}),
+                    "correlation_keys_version": CORRELATION_KEYS_VERSION
+                }})
+                for doc in docs
+            ], ordered=False)
+            total += len(docs)
+        if total:
+            logging.info(f"Llaves de correlación calculadas para {total} documentos")
+    except Exception as e:
+        logging.error(f"Error en migración de llaves de correlación: {str(e)}")
+
+# Versión de file_info; subirla obliga a recalcular los metadatos de archivo
+FILE_INFO_VERSION = 1
+
+async def index_file_metadata(query: Dict[str, Any], batch_size: int = 50) -> int:
+    """
+    Calcula file_info (página, sha256, dimensiones, cifrado, capa de texto y
+    resultado de validación) en el pool de procesos para los documentos de
+    query que aún no lo tienen. Se usa en segundo plano tras la carga y
+    como migración al arrancar.
+    """
+    pending_query = {**query, "file_data": {"$exists": True}, "file_info.version": {"$ne": FILE_INFO_VERSION}}
+    projection = {"_id": 0, "id": 1, "filename": 1, "mime_type": 1, "file_data": 1}
+    semaphore = asyncio.Semaphore(VALIDATION_CONCURRENCY)
+    total = 0
+    
+    async def extract_one(doc):
+        async with semaphore:
+            try:
+                info = await run_in_pool(extract_file_metadata, doc['file_data'], doc.get('filename', ''), doc.get('mime_type', ''))
+            except Exception as e:
+                logging.warning(f"No se pudieron extraer metadatos de {doc.get('filename')}: {e}")
+                info = {"error": str(e)}
+        info["version"] = FILE_INFO_VERSION
+        return UpdateOne({"id": doc['id']}, {"$set": {"file_info": info}})
+    
+    try:
+        while True:
+            docs = await db.documents.find(pending_query, projection).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            operations = await asyncio.gather(*(extract_one(doc) for doc in docs))
+            await db.documents.bulk_write(list(operations), ordered=False)
+            total += len(docs)
+    except Exception as e:
+        logging.error(f"Error extrayendo metadatos de archivos: {str(e)}")
+    return total
+
+# Tareas en segundo plano: el event loop solo guarda referencias débiles, así que se
+# conservan aquí hasta que terminan (si no, el recolector podría cancelarlas a mitad)
+background_tasks: Set[asyncio.Task] = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Lanza coro como tarea en segundo plano y conserva su referencia hasta que termine."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def schedule_file_metadata(doc_ids: List[str]):
+    """Extrae los metadatos y la miniatura de los documentos recién cargados sin demorar la respuesta."""
+    if doc_ids:
+        spawn_background(index_file_metadata_and_thumbnails({"id": {"$in": doc_ids}}))
+
+async def index_file_metadata_and_thumbnails(query: Dict[str, Any]):
+    """La miniatura se indexa por la huella de file_info, así que va después de los metadatos."""
+    await index_file_metadata(query)
+    await index_thumbnails(query)
+
+def thumbnail_key(fingerprint: str) -> str:
+    """Clave de la miniatura: depende solo del contenido (y del tamaño configurado)."""
+    return hashlib.sha256(f"{fingerprint}@{THUMBNAIL_MAX_PX}".encode()).hexdigest()[:32]
+
+async def prune_thumbnails(keys: List[Any]):
+    """
+    Elimina las miniaturas de keys que ya ningún documento usa (se comparten por
+    contenido). Si una se borra mientras otro documento la vuelve a tomar,
+    thumbnail_response la regenera en la siguiente petición.
+    """
+    keys = [key for key in set(keys) if key]
+    if not keys:
+        return
+    in_use = await db.documents.distinct("thumbnail_key", {"thumbnail_key": {"$in": keys}})
+    orphaned = set(keys) - set(in_use)
+    if orphaned:
+        await db.thumbnails.delete_many({"key": {"$in": list(orphaned)}})
+
+async def delete_documents(query: Dict[str, Any]):
+    """Elimina los documentos de query y las miniaturas que quedan sin usar."""
+    keys = await db.documents.distinct("thumbnail_key", query)
+    result = await db.documents.delete_many(query)
+    await prune_thumbnails(keys)
+    return result
+
+async def index_thumbnails(query: Dict[str, Any], batch_size: int = 20, max_documents: Optional[int] = None) -> int:
+    """
+    Genera en el pool de procesos las miniaturas de los documentos de query
+    que aún no tienen thumbnail_key (como mucho max_documents). Las miniaturas
+    se guardan en la colección thumbnails por contenido: documentos con el
+    mismo archivo comparten una. Si la página no se puede dibujar,
+    thumbnail_key queda en False.
+    """
+    pending_query = {"$and": [query, {"thumbnail_key": None, "status": {"$ne": "dividido"}}]}
+    projection = {
+        "_id": 0, "id": 1, "filename": 1, "mime_type": 1, "file_info.sha256": 1,
+        "parent_document_id": 1, "page_number": 1, "file_data": 1
+    }
+    semaphore = asyncio.Semaphore(VALIDATION_CONCURRENCY)
+    skipped = set()
+    total = 0
+    
+    async def index_one(doc):
+        items = await consolidation_items([doc])
+        fingerprint = items[0]['fingerprint']
+        if not fingerprint:
+            # Aún sin file_info: se intenta de nuevo cuando se extraigan los metadatos
+            skipped.add(doc['id'])
+            return
+        key = thumbnail_key(fingerprint)
+        
+        if not await db.thumbnails.find_one({"key": key}, {"_id": 1}):
+            if is_virtual_page(doc):
+                parent = await db.documents.find_one({"id": doc['parent_document_id']}, {"_id": 0, "file_data": 1})
+                source = ((parent or {}).get('file_data'), "padre.pdf", "application/pdf", doc['page_number'])
+            else:
+                source = (doc.get('file_data'), doc.get('filename', ''), doc.get('mime_type', ''), None)
+            
+            async with semaphore:
+                try:
+                    thumbnail = await run_in_pool(render_thumbnail, *source) if source[0] else None
+                except Exception as e:
+                    logging.warning(f"No se pudo generar la miniatura de {doc.get('filename')}: {e}")
+                    thumbnail = None
+            if not thumbnail:
+                await db.documents.update_one({"id": doc['id']}, {"$set": {"thumbnail_key": False}})
+                return
+            await db.thumbnails.update_one(
+                {"key": key},
+                {"$setOnInsert": {**thumbnail, "key": key, "created_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+        await db.documents.update_one({"id": doc['id']}, {"$set": {"thumbnail_key": key}})
+    
+    try:
+        while max_documents is None or total < max_documents:
+            limit = batch_size if max_documents is None else min(batch_size, max_documents - total)
+            # $and conserva el filtro del llamador (por ejemplo por id) junto con los omitidos
+            docs = await db.documents.find(
+                {"$and": [pending_query, {"id": {"$nin": list(skipped)}}]}, projection
+            ).limit(limit).to_list(limit)
+            if not docs:
+                break
+            await asyncio.gather(*(index_one(doc) for doc in docs))
+            total += len(docs)
+    except Exception as e:
+        logging.error(f"Error generando miniaturas: {str(e)}")
+    return total
+
+def stored_validation_error(doc: Dict[str, Any]):
+    """
+    Resultado de validación calculado al cargar el archivo: None si es válido,
+    el mensaje de error si no, o False si aún no hay metadatos.
+    """
+    info = doc.get('file_info') or {}
+    if info.get('version') != FILE_INFO_VERSION or 'validation_error' not in info:
+        return False
+    return info['validation_error']
+
+# Caché LRU (por tamaño en bytes) de las páginas ya extraídas: las virtuales
+# por (documento padre, página) y las de /documents/{id}/pages/{n} por (sha256, página)
+PAGE_CACHE_MB = int(os.environ.get('PAGE_CACHE_MB', 64))
+page_cache = LRUCache(maxsize=PAGE_CACHE_MB * 1024 * 1024, getsizeof=len)
+
+def is_virtual_page(doc: Dict[str, Any]) -> bool:
+    """Página de un PDF dividido que referencia al documento padre en vez de guardar sus bytes."""
+    return bool(doc.get('parent_document_id') and doc.get('page_number') and not doc.get('file_data'))
+
+async def load_document_bytes(doc: Dict[str, Any]) -> Optional[bytes]:
+    """
+    Devuelve el contenido de un documento. Las páginas virtuales se generan
+    desde el PDF padre en el pool de procesos y quedan en page_cache.
+    """
+    if doc.get('file_data'):
+        return doc['file_data']
+    if not is_virtual_page(doc):
+        return None
+    
+    key = (doc['parent_document_id'], doc['page_number'])
+    page_data = page_cache.get(key)
+    if page_data is not None:
+        return page_data
+    
+    parent = await db.documents.find_one({"id": doc['parent_document_id']}, {"_id": 0, "file_data": 1})
+    if not parent or not parent.get('file_data'):
+        logging.error(f"Documento padre {doc['parent_document_id']} de la página {doc.get('id')} no encontrado")
+        return None
+    
+    page_data = await run_in_pool(extract_page, parent['file_data'], doc['page_number'])
+    if len(page_data) <= page_cache.maxsize:
+        page_cache[key] = page_data
+    return page_data
+
+async def document_file_info(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    file_info de un documento (doc puede venir sin file_data). Si aún no se
+    calculó se extrae en el pool y se guarda. Las páginas virtuales son de una página.
+    """
+    info = doc.get('file_info') or {}
+    if info.get('version') == FILE_INFO_VERSION and not info.get('error'):
+        return info
+    if is_virtual_page(doc):
+        return {"page_count": 1}
+    
+    stored = await db.documents.find_one({"id": doc['id']}, {"_id": 0, "file_data": 1})
+    if not stored or not stored.get('file_data'):
+        return info
+    info = await run_in_pool(extract_file_metadata, stored['file_data'], doc.get('filename', ''), doc.get('mime_type', ''))
+    info["version"] = FILE_INFO_VERSION
+    await db.documents.update_one({"id": doc['id']}, {"$set": {"file_info": info}})
+    return info
+
+async def load_document_page(doc: Dict[str, Any], page_number: int) -> Optional[bytes]:
+    """
+    Una página de un documento como PDF de una página (las imágenes y las
+    páginas virtuales se devuelven completas como página 1). Las páginas
+    extraídas quedan en page_cache por (sha256, página): el archivo solo se
+    lee de Mongo si la página no está en caché.
+    """
+    if is_virtual_page(doc) or is_image(doc.get('filename', ''), doc.get('mime_type', '')):
+        full = await db.documents.find_one({"id": doc['id']}, {"_id": 0})
+        return await load_document_bytes(full) if full else None
+    
+    info = await document_file_info(doc)
+    key = (info.get('sha256'), page_number)
+    page_data = page_cache.get(key) if info.get('sha256') else None
+    if page_data is not None:
+        return page_data
+    
+    stored = await db.documents.find_one({"id": doc['id']}, {"_id": 0, "file_data": 1})
+    if not stored or not stored.get('file_data'):
+        return None
+    page_data = await run_in_pool(extract_page, stored['file_data'], page_number)
+    if info.get('sha256') and len(page_data) <= page_cache.maxsize:
+        page_cache[key] = page_data
+    return page_data
+
+# Tope de memoria de una consolidación: suma de los archivos fuente. Se verifica antes de
+# enviar el lote al pool y el worker lo vuelve a aplicar a lo que carga (ConsolidationTooLarge)
+CONSOLIDATION_MAX_MB = int(os.environ.get('CONSOLIDATION_MAX_MB', 512))
+
+async def run_consolidation(*args) -> Dict[str, Any]:
+    """write_consolidated_pdf en el pool con el tope CONSOLIDATION_MAX_MB; si se supera, 413."""
+    try:
+        return await run_in_pool(write_consolidated_pdf, *args, CONSOLIDATION_MAX_MB * 1024 * 1024)
+    except ConsolidationTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+def check_consolidation_size(docs: List[Dict[str, Any]]):
+    """Rechaza lotes cuyos archivos fuente superan CONSOLIDATION_MAX_MB (el worker los tiene abiertos a la vez)."""
+    total_size = sum(doc.get('file_size') or 0 for doc in docs)
+    if total_size > CONSOLIDATION_MAX_MB * 1024 * 1024:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Los documentos del lote suman {total_size // (1024 * 1024)}MB; el máximo para consolidar es {CONSOLIDATION_MAX_MB}MB"
+        )
+
+async def consolidation_items(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Documentos del lote en orden con su huella (sha256 de file_info; en páginas
+    virtuales, la del PDF padre + número de página) y el título de su marcador
+    en el PDF. La huella es None si aún no se conoce: el worker la calcula al
+    cargar el archivo.
+    """
+    parent_ids = list({doc['parent_document_id'] for doc in docs if is_virtual_page(doc)})
+    parent_hashes = {}
+    if parent_ids:
+        async for parent in db.documents.find({"id": {"$in": parent_ids}}, {"_id": 0, "id": 1, "file_info.sha256": 1}):
+            parent_hashes[parent['id']] = (parent.get('file_info') or {}).get('sha256')
+    
+    items = []
+    for doc in docs:
+        if is_virtual_page(doc):
+            parent_hash = parent_hashes.get(doc['parent_document_id'])
+            fingerprint = f"{parent_hash}#p{doc['page_number']}" if parent_hash else None
+        else:
+            fingerprint = (doc.get('file_info') or {}).get('sha256')
+        tipo = (doc.get('tipo_documento') or 'documento').replace('_', ' ').capitalize()
+        items.append({"doc_id": doc['id'], "fingerprint": fingerprint, "title": f"{tipo}: {doc['filename']}"})
+    return items
+
+# Modo diferido por defecto para lotes sin lazy_pdf y tope de la caché de PDFs diferidos ya generados
+CONSOLIDATION_LAZY_DEFAULT = os.environ.get('CONSOLIDATION_LAZY_DEFAULT', 'false').lower() == 'true'
+LAZY_PDF_CACHE_MB = int(os.environ.get('LAZY_PDF_CACHE_MB', 1024))
+# Un PDF diferido accedido hace menos de esto no se desaloja (descargas en curso en cualquier instancia)
+LAZY_PDF_EVICT_GRACE_SECONDS = int(os.environ.get('LAZY_PDF_EVICT_GRACE_SECONDS', 600))
+
+# Generaciones diferidas en curso: descargas simultáneas del mismo PDF esperan la misma
+lazy_pdf_builds: Dict[str, asyncio.Future] = {}
+# Lecturas en curso por PDF en este proceso: evict_lazy_pdfs no los toca
+lazy_pdf_leases: Dict[str, int] = {}
+
+@contextmanager
+def lazy_pdf_lease(pdf_id: str):
+    """Protege el archivo de un PDF del desalojo mientras se lee o se envía."""
+    lazy_pdf_leases[pdf_id] = lazy_pdf_leases.get(pdf_id, 0) + 1
+    try:
+        yield
+    finally:
+        lazy_pdf_leases[pdf_id] -= 1
+        if not lazy_pdf_leases[pdf_id]:
+            del lazy_pdf_leases[pdf_id]
+
+def composition_hash(items: List[Dict[str, Any]]) -> str:
+    """Hash de la composición ordenada (documento + huella) de un PDF consolidado."""
+    payload = "\n".join(f"{item['doc_id']}:{item.get('fingerprint') or ''}" for item in items)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+async def ensure_pdf_built(pdf: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Devuelve el registro de un PDF diferido con su archivo en GridFS,
+    generándolo desde la composición si no está en la caché. Actualiza
+    last_accessed_at para el desalojo LRU.
+    """
+    now = datetime.now(timezone.utc)
+    if pdf.get('gridfs_id'):
+        await db.consolidated_pdfs.update_one({"id": pdf['id']}, {"$set": {"last_accessed_at": now}})
+        return pdf
+    
+    if pdf['id'] in lazy_pdf_builds:
+        return await asyncio.shield(lazy_pdf_builds[pdf['id']])
+    
+    future = asyncio.get_running_loop().create_future()
+    lazy_pdf_builds[pdf['id']] = future
+    try:
+        batch = await db.batches.find_one({"id": pdf['batch_id']}, {"_id": 0, "optimize_pdf": 1}) or {}
+        # La composición fija el orden y los documentos: la misma composición produce el mismo PDF
+        result = await run_consolidation(
+            [
+                {"doc_id": item['doc_id'], "fingerprint": item.get('fingerprint'), "title": item.get('title')}
+                for item in pdf['composition']
+            ],
+            pdf['filename'],
+            {"batch_id": pdf['batch_id'], "lazy": True},
+            None,
+            None,
+            bool(batch.get('optimize_pdf'))
+        )
+        update = {
+            "gridfs_id": result['gridfs_id'],
+            "file_size": result['file_size'],
+            "page_count": result['page_count'],
+            "composition": result['composition'],
+            "original_size": result.get('original_size'),
+            "objects_deduplicated": result.get('objects_deduplicated'),
+            "built_at": now,
+            "last_accessed_at": now
+        }
+        known = all(item.get('fingerprint') for item in pdf['composition'])
+        if known and composition_hash(result['composition']) != pdf.get('composition_hash'):
+            logging.warning(f"Los documentos del PDF {pdf['id']} cambiaron desde que se registró su composición")
+        await db.consolidated_pdfs.update_one({"id": pdf['id']}, {"$set": update})
+        built = {**pdf, **update}
+        future.set_result(built)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        lazy_pdf_builds.pop(pdf['id'], None)
+    
+    await evict_lazy_pdfs(keep_id=pdf['id'])
+    return built
+
+async def evict_lazy_pdfs(keep_id: Optional[str] = None):
+    """
+    Mantiene los PDFs diferidos ya generados por debajo de LAZY_PDF_CACHE_MB:
+    elimina de GridFS los de acceso más antiguo. Su composición se conserva
+    y se vuelven a generar en la siguiente descarga. No se desalojan los que
+    se están leyendo (lazy_pdf_lease) ni los accedidos en los últimos
+    LAZY_PDF_EVICT_GRACE_SECONDS, aunque la caché quede por encima del tope.
+    """
+    query = {"lazy": True, "gridfs_id": {"$ne": None}}
+    totals = await db.consolidated_pdfs.aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "total": {"$sum": "$file_size"}}}
+    ]).to_list(1)
+    total = totals[0]['total'] if totals else 0
+    limit = LAZY_PDF_CACHE_MB * 1024 * 1024
+    if total <= limit:
+        return
+    
+    grace_cutoff = datetime.now(timezone.utc) - timedelta(seconds=LAZY_PDF_EVICT_GRACE_SECONDS)
+    cursor = db.consolidated_pdfs.find(
+        {
+            **query,
+            "id": {"$nin": [keep_id, *lazy_pdf_leases]},
+            "$or": [{"last_accessed_at": None}, {"last_accessed_at": {"$lt": grace_cutoff}}]
+        },
+        {"_id": 0, "id": 1, "gridfs_id": 1, "file_size": 1}
+    ).sort("last_accessed_at", 1)
+    async for pdf in cursor:
+        if total <= limit:
+            break
+        try:
+            await fs_bucket.delete(ObjectId(pdf['gridfs_id']))
+        except Exception as e:
+            logging.warning(f"No se pudo eliminar el archivo GridFS {pdf['gridfs_id']}: {e}")
+        await db.consolidated_pdfs.update_one(
+            {"id": pdf['id'], "gridfs_id": pdf['gridfs_id']}, {"$set": {"gridfs_id": None}}
+        )
+        total -= pdf.get('file_size') or 0
+
+async def consolidate_batch(batch: Dict[str, Any], user: User, previous_pdf: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Motor único de consolidación de un lote (generar y regenerar). Ordena los
+    documentos, escribe el PDF en GridFS desde el pool de procesos y guarda el
+    registro con su composición. Con previous_pdf se reutilizan los rangos de
+    páginas de los documentos sin cambios. Si el lote tiene optimize_pdf, el
+    PDF se deduplica y comprime y el registro guarda el tamaño original.
+    Devuelve el registro guardado más failed y reused.
+    """
+    batch_id = batch['id']
+    
+    # Generar consecutivo automático
+    current_year = datetime.now(timezone.utc).year
+    count = await db.consolidated_pdfs.count_documents({}) + 1
+    consecutive_number = f"{current_year}-{count:04d}"  # Ej: 2025-0001
+    
+    # Obtener documentos del lote (sin contenido: el worker los carga uno a uno)
+    docs = await db.documents.find(
+        {"id": {"$in": batch['documentos']}},
+        {"_id": 0, "file_data": 0}
+    ).to_list(1000)
+    
+    # Ordenar documentos según el orden especificado:
+    # 1. Comprobante de Egreso
+    # 2. Cuenta Por Pagar  
+    # 3. Soporte de Pago
+    # 4. Factura (si existe)
+    order = [
+        DocumentType.COMPROBANTE_EGRESO,
+        DocumentType.CUENTA_POR_PAGAR,
+        DocumentType.SOPORTE_PAGO,
+        DocumentType.FACTURA
+    ]
+    sorted_docs = sorted(docs, key=lambda d: order.index(d['tipo_documento']) if d['tipo_documento'] in order else 999)
+    
+    check_consolidation_size(sorted_docs)
+    
+    # Generar nombre del PDF basado en el comprobante de egreso
+    pdf_filename = generate_pdf_filename_from_batch(sorted_docs)
+    if not pdf_filename:
+        # Fallback a consecutivo si no hay comprobante de egreso válido
+        pdf_filename = f"Documentos_Consolidados_{consecutive_number}.pdf"
+    
+    items = await consolidation_items(sorted_docs)
+    lazy = bool(batch.get('lazy_pdf', CONSOLIDATION_LAZY_DEFAULT))
+    
+    if lazy:
+        # Solo la composición: el PDF se arma en la primera descarga (ensure_pdf_built)
+        result = {"file_size": 0, "page_count": None, "gridfs_id": None, "composition": items, "failed": [], "reused": 0}
+    else:
+        previous_pdf = previous_pdf or {}
+        result = await run_consolidation(
+            items,
+            pdf_filename,
+            {"batch_id": batch_id},
+            previous_pdf.get('gridfs_id'),
+            previous_pdf.get('composition'),
+            bool(batch.get('optimize_pdf'))
+        )
+    
+    consolidated = ConsolidatedPDF(
+        batch_id=batch_id,
+        filename=pdf_filename,
+        created_by=user.id,
+        file_size=result['file_size'],
+        page_count=result['page_count'],
+        lazy=lazy,
+        composition_hash=composition_hash(items),
+        optimized=bool(batch.get('optimize_pdf')),
+        original_size=result.get('original_size'),
+        objects_deduplicated=result.get('objects_deduplicated')
+    )
+    
+    consolidated_dict = consolidated.model_dump()
+    consolidated_dict['created_at'] = consolidated_dict['created_at'].isoformat()
+    consolidated_dict['gridfs_id'] = result['gridfs_id']
+    consolidated_dict['composition'] = result['composition']
+    
+    await db.consolidated_pdfs.insert_one(consolidated_dict)
+    consolidated_dict.pop('_id', None)
+    
+    return {**consolidated_dict, "failed": result['failed'], "reused": result['reused']}
+
+async def delete_consolidated_pdf_record(pdf_id: str):
+    """Elimina el registro del PDF consolidado y su archivo en GridFS."""
+    pdf = await db.consolidated_pdfs.find_one({"id": pdf_id}, {"_id": 0, "gridfs_id": 1})
+    if pdf and pdf.get('gridfs_id'):
+        try:
+            await fs_bucket.delete(ObjectId(pdf['gridfs_id']))
+        except Exception as e:
+            logging.warning(f"No se pudo eliminar el archivo GridFS {pdf['gridfs_id']}: {e}")
+    await db.consolidated_pdfs.delete_one({"id": pdf_id})
+
+async def generate_pdf_for_batch(batch: Dict[str, Any], user: User) -> Dict[str, Any]:
+    """
+    Genera (o regenera, reutilizando las páginas sin cambios) el PDF de un lote
+    y actualiza el lote. El PDF anterior se elimina después de copiar de él
+    las páginas sin cambios.
+    
+    El lote se reclama con regenerating_at mientras se genera, así la
+    generación manual, la masiva y la automática nunca procesan el mismo lote
+    a la vez. Lanza 409 si el lote ya se está generando.
+    """
+    now = datetime.now(timezone.utc)
+    claimed = await db.batches.find_one_and_update(
+        {
+            "id": batch['id'],
+            "$or": [
+                {"regenerating_at": None},
+                {"regenerating_at": {"$lte": now - timedelta(seconds=REGENERATION_STALE_SECONDS)}}
+            ]
+        },
+        {"$set": {"regenerating_at": now}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not claimed:
+        raise HTTPException(status_code=409, detail="El PDF de este lote ya se está generando")
+    
+    # Se usa el lote recién leído: el PDF anterior pudo cambiar mientras se esperaba
+    batch = {**batch, **claimed}
+    try:
+        previous_pdf = None
+        if batch.get('pdf_generado_id'):
+            previous_pdf = await db.consolidated_pdfs.find_one(
+                {"id": batch['pdf_generado_id']}, {"_id": 0, "id": 1, "gridfs_id": 1, "composition": 1}
+            )
+        
+        consolidated = await consolidate_batch(batch, user, previous_pdf)
+        
+        if batch.get('pdf_generado_id'):
+            await delete_consolidated_pdf_record(batch['pdf_generado_id'])
+        
+        await db.batches.update_one(
+            {"id": batch['id']},
+            {"$set": {"pdf_generado_id": consolidated['id'], "status": DocumentStatus.TERMINADO}}
+        )
+        # Solo se limpia la marca si no hubo otro cambio mientras se generaba el PDF
+        await db.batches.update_one(
+            {"id": batch['id'], "needs_regeneration_at": batch.get('needs_regeneration_at')},
+            {"$set": {"needs_regeneration": False}, "$unset": {"needs_regeneration_at": ""}}
+        )
+        return consolidated
+    finally:
+        await db.batches.update_one(
+            {"id": batch['id'], "regenerating_at": now}, {"$unset": {"regenerating_at": ""}}
+        )
+
+# Regeneración automática: espera REGENERATION_DEBOUNCE_SECONDS sin cambios en el
+# lote antes de regenerar (agrupa ediciones seguidas) y revisa cada REGENERATION_POLL_SECONDS
+REGENERATION_DEBOUNCE_SECONDS = int(os.environ.get('REGENERATION_DEBOUNCE_SECONDS', 30))
+REGENERATION_POLL_SECONDS = int(os.environ.get('REGENERATION_POLL_SECONDS', 10))
+# Una generación que no terminó en este tiempo (p. ej. el proceso se reinició) se puede retomar;
+# también es la espera antes de reintentar una regeneración automática que falló
+REGENERATION_STALE_SECONDS = 15 * 60
+
+SYSTEM_USER = User.model_construct(id="sistema", email="sistema@docflow", nombre="Regeneración automática", role=UserRole.ADMIN)
+
+async def regenerate_flagged_batches() -> int:
+    """
+    Regenera los lotes con needs_regeneration cuyo último cambio tiene más de
+    REGENERATION_DEBOUNCE_SECONDS y que ya tenían PDF. generate_pdf_for_batch
+    reclama cada lote, así no choca con otra instancia ni con una generación
+    manual. Devuelve cuántos lotes se regeneraron.
+    """
+    regenerated = 0
+    while True:
+        now = datetime.now(timezone.utc)
+        batch = await db.batches.find_one(
+            {
+                "needs_regeneration": True,
+                "pdf_generado_id": {"$ne": None},
+                "$and": [
+                    {"$or": [
+                        {"needs_regeneration_at": {"$lte": now - timedelta(seconds=REGENERATION_DEBOUNCE_SECONDS)}},
+                        {"needs_regeneration_at": None}
+                    ]},
+                    {"$or": [
+                        {"regenerating_at": None},
+                        {"regenerating_at": {"$lte": now - timedelta(seconds=REGENERATION_STALE_SECONDS)}}
+                    ]},
+                    {"$or": [
+                        {"regeneration_failed_at": None},
+                        {"regeneration_failed_at": {"$lte": now - timedelta(seconds=REGENERATION_STALE_SECONDS)}}
+                    ]}
+                ]
+            },
+            {"_id": 0},
+            sort=[("needs_regeneration_at", 1)]
+        )
+        if not batch:
+            return regenerated
+        
+        try:
+            await generate_pdf_for_batch(batch, SYSTEM_USER)
+            await log_action(SYSTEM_USER, "AUTO_REGENERATE_PDF", f"Regenerado automáticamente el PDF del lote {batch['id']}")
+            regenerated += 1
+        except Exception as e:
+            if isinstance(e, HTTPException) and e.status_code == 409:
+                # Otra generación lo reclamó entre la búsqueda y el reclamo: ya no aparece en la búsqueda
+                continue
+            logging.error(f"Error regenerando automáticamente el lote {batch['id']}: {str(e)}")
+            # Se reintenta tras REGENERATION_STALE_SECONDS
+            await db.batches.update_one(
+                {"id": batch['id']},
+                {"$set": {"regeneration_error": str(e), "regeneration_failed_at": now}}
+            )
+            continue
+        await db.batches.update_one({"id": batch['id']}, {"$unset": {"regeneration_error": "", "regeneration_failed_at": ""}})
+
+async def regeneration_sweeper():
+    """Tarea de fondo: revisa periódicamente los lotes marcados para regenerar."""
+    while True:
+        try:
+            await regenerate_flagged_batches()
+        except Exception as e:
+            logging.error(f"Error en la regeneración automática de lotes: {str(e)}")
+        await asyncio.sleep(REGENERATION_POLL_SECONDS)
+
+async def materialize_split_pages(parent_ids: List[str]):
+    """
+    Copia los bytes de las páginas virtuales de estos documentos padre antes de
+    eliminarlos o reemplazarlos, para que las páginas sigan teniendo contenido.
+    """
+    children = await db.documents.find(
+        {"parent_document_id": {"$in": parent_ids}, "file_data": {"$exists": False}},
+        {"_id": 0, "id": 1, "parent_document_id": 1, "page_number": 1}
+    ).to_list(None)
+    if not children:
+        return
+    
+    operations = []
+    for child in children:
+        page_data = await load_document_bytes(child)
+        if page_data:
+            operations.append(UpdateOne({"id": child['id']}, {"$set": {"file_data": page_data}}))
+        page_cache.pop((child['parent_document_id'], child['page_number']), None)
+    if operations:
+        await db.documents.bulk_write(operations, ordered=False)
+
+async def compact_split_pages(batch_size: int = 100):
+    """
+    Migración en segundo plano: las páginas divididas antes de las páginas
+    virtuales guardan una copia de sus bytes; se eliminan si el padre aún
+    tiene el PDF original y ninguno de los dos fue reemplazado.
+    """
+    query = {
+        "parent_document_id": {"$exists": True},
+        "page_number": {"$exists": True},
+        "file_data": {"$exists": True},
+        "replaced_at": {"$exists": False}
+    }
+    total = 0
+    skipped = set()
+    try:
+        while True:
+            children = await db.documents.find(
+                {**query, "id": {"$nin": list(skipped)}},
+                {"_id": 0, "id": 1, "parent_document_id": 1}
+            ).limit(batch_size).to_list(batch_size)
+            if not children:
+                break
+            parent_ids = list({child['parent_document_id'] for child in children})
+            parents = await db.documents.find(
+                {"id": {"$in": parent_ids}, "file_data": {"$exists": True}, "replaced_at": {"$exists": False}},
+                {"_id": 0, "id": 1}
+            ).to_list(None)
+            valid_parents = {parent['id'] for parent in parents}
+            
+            compactable = [child['id'] for child in children if child['parent_document_id'] in valid_parents]
+            skipped.update(child['id'] for child in children if child['parent_document_id'] not in valid_parents)
+            if compactable:
+                await db.documents.update_many({"id": {"$in": compactable}}, {"$unset": {"file_data": ""}})
+                total += len(compactable)
+        if total:
+            logging.info(f"Páginas divididas convertidas a páginas virtuales: {total}")
+    except Exception as e:
+        logging.error(f"Error en migración de páginas virtuales: {str(e)}")
+
 async def analyze_document_with_gpt(file_path: str, mime_type: str) -> Dict[str, Any]:
     """Analiza un documento usando Gemini para extraer información y correlacionar.
     IMPORTANTE: FileContentWithMimeType solo funciona con Gemini provider."""
@@ -399,23 +1201,6 @@ Si no es un documento válido, solo incluye:
         logging.error(f"Error analyzing page {page_num}: {str(e)}")
         return {"es_documento_valido": False, "page_number": page_num, "error": str(e)}
 
-def split_pdf_to_pages(pdf_data: bytes) -> List[bytes]:
-    """Divide un PDF en páginas individuales, cada una como bytes de PDF"""
-    pages = []
-    try:
-        reader = PdfReader(io.BytesIO(pdf_data))
-        for page_num in range(len(reader.pages)):
-            writer = PdfWriter()
-            writer.add_page(reader.pages[page_num])
-            
-            page_buffer = io.BytesIO()
-            writer.write(page_buffer)
-            page_buffer.seek(0)
-            pages.append(page_buffer.read())
-    except Exception as e:
-        logging.error(f"Error splitting PDF: {str(e)}")
-    return pages
-
 async def correlate_documents_with_claude(documents: List[Dict]) -> List[Dict]:
     """
     Usa Claude Sonnet 4.5 para correlación inteligente de documentos.
@@ -556,151 +1341,6 @@ Responde SOLO con este JSON (sin explicaciones ni texto adicional):
         logging.error(f"Error en correlación con Claude: {str(e)}")
         return []
 
-# Función de correlación básica mejorada (fallback)
-def correlate_documents_basic(documents: List[Dict]) -> List[Dict]:
-    """
-    Correlación básica mejorada con múltiples criterios.
-    Se usa como fallback si Claude falla.
-    """
-    if not documents:
-        return []
-    
-    correlations = []
-    processed_ids = set()
-    
-    # Indexar por NIT para búsqueda rápida
-    by_nit = {}
-    for doc in documents:
-        nit = doc.get('nit', '').replace('-', '').replace('.', '').strip()
-        if nit and len(nit) >= 6:
-            if nit not in by_nit:
-                by_nit[nit] = []
-            by_nit[nit].append(doc)
-    
-    # Indexar por valor (redondeado)
-    by_valor = {}
-    for doc in documents:
-        valor = doc.get('valor')
-        if valor:
-            valor_key = round(valor, -2)  # Redondear a centenas
-            if valor_key not in by_valor:
-                by_valor[valor_key] = []
-            by_valor[valor_key].append(doc)
-    
-    # PASO 1: Correlacionar por NIT (alta confianza)
-    for nit, docs_nit in by_nit.items():
-        if len(docs_nit) >= 2:
-            # Agrupar por valor dentro del mismo NIT
-            sub_by_valor = {}
-            for doc in docs_nit:
-                if doc['id'] in processed_ids:
-                    continue
-                valor = doc.get('valor', 0)
-                valor_key = round(valor, -2) if valor else 0
-                if valor_key not in sub_by_valor:
-                    sub_by_valor[valor_key] = []
-                sub_by_valor[valor_key].append(doc)
-            
-            for valor_key, grupo in sub_by_valor.items():
-                if len(grupo) >= 2:
-                    for d in grupo:
-                        processed_ids.add(d['id'])
-                    
-                    correlations.append({
-                        "tercero": grupo[0].get('tercero', ''),
-                        "nit": nit,
-                        "valor": valor_key,
-                        "num_documentos": len(grupo),
-                        "tipos_documentos": list(set(d.get('tipo_documento', '') for d in grupo)),
-                        "document_ids": [d['id'] for d in grupo],
-                        "tipo_correlacion": "mismo_nit",
-                        "confianza": "alta",
-                        "razon_correlacion": f"Mismo NIT: {nit}"
-                    })
-    
-    # PASO 2: Correlacionar por valor exacto (±5%)
-    for doc in documents:
-        if doc['id'] in processed_ids:
-            continue
-        
-        valor = doc.get('valor')
-        tercero = doc.get('tercero', '').upper()
-        
-        if not valor:
-            continue
-        
-        matching = [doc]
-        
-        for other in documents:
-            if other['id'] == doc['id'] or other['id'] in processed_ids:
-                continue
-            
-            other_valor = other.get('valor')
-            if not other_valor:
-                continue
-            
-            # Tolerancia del 5%
-            if abs(valor - other_valor) / valor <= 0.05:
-                matching.append(other)
-                processed_ids.add(other['id'])
-        
-        if len(matching) >= 2:
-            processed_ids.add(doc['id'])
-            correlations.append({
-                "tercero": tercero,
-                "nit": doc.get('nit', ''),
-                "valor": valor,
-                "num_documentos": len(matching),
-                "tipos_documentos": list(set(d.get('tipo_documento', '') for d in matching)),
-                "document_ids": [d['id'] for d in matching],
-                "tipo_correlacion": "valor_exacto",
-                "confianza": "alta" if len(matching) >= 3 else "media",
-                "razon_correlacion": f"Valor similar: ${valor:,.2f}"
-            })
-    
-    # PASO 3: Correlacionar por tercero similar (palabras en común)
-    remaining = [d for d in documents if d['id'] not in processed_ids and d.get('tercero')]
-    
-    for doc in remaining:
-        if doc['id'] in processed_ids:
-            continue
-        
-        tercero = doc.get('tercero', '').upper()
-        tercero_words = set(w for w in tercero.split() if len(w) > 3)
-        
-        if not tercero_words:
-            continue
-        
-        matching = [doc]
-        
-        for other in remaining:
-            if other['id'] == doc['id'] or other['id'] in processed_ids:
-                continue
-            
-            other_tercero = other.get('tercero', '').upper()
-            other_words = set(w for w in other_tercero.split() if len(w) > 3)
-            
-            # Al menos 1 palabra significativa en común
-            if len(tercero_words & other_words) >= 1:
-                matching.append(other)
-                processed_ids.add(other['id'])
-        
-        if len(matching) >= 2:
-            processed_ids.add(doc['id'])
-            correlations.append({
-                "tercero": tercero,
-                "nit": doc.get('nit', ''),
-                "valor": doc.get('valor', 0),
-                "num_documentos": len(matching),
-                "tipos_documentos": list(set(d.get('tipo_documento', '') for d in matching)),
-                "document_ids": [d['id'] for d in matching],
-                "tipo_correlacion": "mismo_tercero",
-                "confianza": "media",
-                "razon_correlacion": f"Tercero similar: {tercero[:30]}"
-            })
-    
-    return correlations
-
 # Auth Endpoints
 @api_router.post("/auth/register", response_model=User)
 async def register(user_data: UserCreate, authorization: str = Header(None)):
@@ -835,6 +1475,9 @@ async def upload_documents(
         except:
             pass
     
+    # Página, hash, dimensiones y capa de texto se calculan en segundo plano
+    schedule_file_metadata([d['id'] for d in uploaded_docs])
+    
     await log_action(user, "UPLOAD_DOCUMENTS", f"Subidos {len(uploaded_docs)} documentos tipo {tipo_documento}, {len(duplicates)} duplicados omitidos")
     
     return {
@@ -844,17 +1487,69 @@ async def upload_documents(
         "duplicate_files": duplicates
     }
 
+def list_fields(base, fields: Optional[str]) -> Dict[str, int]:
+    """Proyección de un listado con los campos extra de fields= (400 si se pide un campo no permitido)."""
+    try:
+        return list_projection(base, fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def list_etag(collections: List[str], *parts) -> str:
+    """ETag de un listado con las versiones de collection_versions (compartidas por todos los procesos)."""
+    docs = await db[VERSIONS_COLLECTION].find({"_id": {"$in": collections}}).to_list(None)
+    return collection_etag(collections, {doc['_id']: doc for doc in docs}, *parts)
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """
+    304 si el cliente ya tiene la versión actual (If-None-Match). El ETag se
+    calcula antes de leer: una escritura durante la lectura cambia la versión.
+    """
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
+
+def versioned_json(content: Dict[str, Any], etag: str) -> ORJSONResponse:
+    """Respuesta de listado con su ETag; no-cache obliga al navegador a revalidar con If-None-Match."""
+    return ORJSONResponse(content, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+# Límite de ids= en /documents/list: con más cambios el cliente recarga el listado completo (con ETag)
+DOCUMENT_LIST_MAX_IDS = 100
+
 @api_router.get("/documents/list")
-async def list_documents(authorization: str = Header(None), status: Optional[str] = None):
+async def list_documents(
+    request: Request,
+    authorization: str = Header(None),
+    status: Optional[str] = None,
+    fields: Optional[str] = None,
+    ids: Optional[str] = None
+):
+    """
+    Listado liviano de documentos; fields= agrega campos de detalle (p. ej.
+    analisis_completo) e ids= (separados por comas, hasta DOCUMENT_LIST_MAX_IDS)
+    limita el listado a esos documentos, para actualizar solo las filas que
+    cambiaron según /events.
+    """
     user = await get_current_user(authorization)
     
+    id_list = [doc_id.strip() for doc_id in (ids or "").split(',') if doc_id.strip()]
+    if len(id_list) > DOCUMENT_LIST_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {DOCUMENT_LIST_MAX_IDS} ids por consulta")
+    
+    etag = await list_etag(["documents"], "documents/list", status, fields, ids)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
     query = {}
     if status:
         query['status'] = status
+    if id_list:
+        query['id'] = {"$in": id_list}
     
-    docs = await db.documents.find(query, {"_id": 0, "file_data": 0}).to_list(1000)
+    docs = await db.documents.find(query, list_fields(DOCUMENT_LIST_FIELDS, fields)).to_list(1000)
     
-    return {"documents": docs}
+    # Respuesta directa: los documentos de Mongo ya son serializables por orjson
+    return versioned_json({"documents": docs}, etag)
 
 @api_router.get("/documents/{doc_id}/view")
 async def view_document(doc_id: str, authorization: str = Header(None)):
@@ -865,7 +1560,8 @@ async def view_document(doc_id: str, authorization: str = Header(None)):
     if not doc:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
     
-    if not doc.get('file_data'):
+    file_data = await load_document_bytes(doc)
+    if not file_data:
         raise HTTPException(status_code=404, detail="El documento no tiene contenido")
     
     # Determinar content type
@@ -873,14 +1569,115 @@ async def view_document(doc_id: str, authorization: str = Header(None)):
     filename = doc.get('filename', 'documento')
     
     return StreamingResponse(
-        io.BytesIO(doc['file_data']),
+        io.BytesIO(file_data),
+        media_type=content_type,
+        headers={
+            "Content-Disposition": f"inline; filename={filename}",
+            "Content-Length": str(len(file_data))
+        }
+    )
+
+@api_router.get("/documents/{doc_id}/pages")
+async def get_document_pages(doc_id: str, authorization: str = Header(None)):
+    """Número de páginas y metadatos del archivo, para paginar documentos grandes sin descargarlos completos"""
+    user = await get_current_user(authorization)
+    
+    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0, "file_data": 0})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    
+    info = await document_file_info(doc)
+    
+    return {
+        "document_id": doc_id,
+        "filename": doc.get('filename'),
+        "mime_type": doc.get('mime_type'),
+        "file_size": doc.get('file_size'),
+        "page_count": info.get('page_count'),
+        "width": info.get('width'),
+        "height": info.get('height'),
+        "dpi": info.get('dpi'),
+        "encrypted": info.get('encrypted'),
+        "has_text_layer": info.get('has_text_layer'),
+        "sha256": info.get('sha256')
+    }
+
+@api_router.get("/documents/{doc_id}/pages/{page_number}")
+async def view_document_page(doc_id: str, page_number: int, authorization: str = Header(None)):
+    """Obtiene una sola página del documento (PDF de una página; las imágenes se devuelven completas)"""
+    user = await get_current_user(authorization)
+    
+    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0, "file_data": 0})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    
+    info = await document_file_info(doc)
+    page_count = info.get('page_count') or 1
+    if page_number < 1 or page_number > page_count:
+        raise HTTPException(status_code=404, detail=f"Página fuera de rango (el documento tiene {page_count} páginas)")
+    
+    try:
+        page_data = await load_document_page(doc, page_number)
+    except PoolTaskError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"No se pudo extraer la página: {str(e)}")
+    if not page_data:
+        raise HTTPException(status_code=404, detail="El documento no tiene contenido")
+    
+    paged = not (is_virtual_page(doc) or is_image(doc.get('filename', ''), doc.get('mime_type', '')))
+    content_type = "application/pdf" if paged else doc.get('mime_type', 'application/pdf')
+    filename = doc.get('filename', 'documento')
+    if paged:
+        filename = f"{filename.rsplit('.', 1)[0]}_p{page_number}.pdf"
+    
+    return StreamingResponse(
+        io.BytesIO(page_data),
         media_type=content_type,
         headers={
             "Content-Disposition": f"inline; filename={filename}",
-            "Content-Length": str(len(doc['file_data']))
+            "Content-Length": str(len(page_data)),
+            "X-Page-Count": str(page_count)
         }
     )
 
+async def thumbnail_response(doc: Dict[str, Any], version: Optional[str], request: Request) -> Response:
+    """
+    Miniatura de doc. Con ?v= igual a su thumbnail_key la URL identifica el
+    contenido y se cachea como inmutable; sin v se revalida con ETag.
+    """
+    if doc.get('thumbnail_key') is None:
+        # Solo este documento: nunca se procesa el resto de pendientes dentro del GET
+        await index_thumbnails({"id": doc['id']}, max_documents=1)
+        doc = await db.documents.find_one({"id": doc['id']}, {"_id": 0, "thumbnail_key": 1}) or {}
+    key = doc.get('thumbnail_key')
+    if not key:
+        raise HTTPException(status_code=404, detail="Miniatura no disponible")
+    
+    etag = f'"{key}"'
+    cache_control = "private, max-age=31536000, immutable" if version == key else "private, no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    
+    thumbnail = await db.thumbnails.find_one({"key": key}, {"_id": 0, "data": 1, "mime_type": 1})
+    if not thumbnail:
+        # Miniatura borrada: se regenera en la próxima solicitud
+        await db.documents.update_one({"id": doc['id']}, {"$set": {"thumbnail_key": None}})
+        raise HTTPException(status_code=404, detail="Miniatura no disponible")
+    return Response(content=thumbnail['data'], media_type=thumbnail['mime_type'], headers=headers)
+
+@api_router.get("/documents/{doc_id}/thumbnail")
+async def get_document_thumbnail(doc_id: str, request: Request, v: Optional[str] = None, authorization: str = Header(None)):
+    """Miniatura (WebP) de la primera página o imagen del documento"""
+    user = await get_current_user(authorization)
+    
+    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0, "id": 1, "thumbnail_key": 1})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    
+    return await thumbnail_response(doc, v, request)
+
 @api_router.post("/documents/{doc_id}/validate")
 async def validate_document(doc_id: str, authorization: str = Header(None)):
     """Valida que un documento se haya subido correctamente y está listo para analizar"""
@@ -894,84 +1691,149 @@ async def validate_document(doc_id: str, authorization: str = Header(None)):
     await db.documents.update_one({"id": doc_id}, {"$set": {"status": DocumentStatus.VALIDANDO}})
     
     try:
-        file_data = doc.get('file_data')
-        if not file_data or len(file_data) == 0:
-            raise HTTPException(status_code=400, detail="Archivo vacío o corrupto")
-        
-        filename = doc.get('filename', '').lower()
-        mime_type = doc.get('mime_type', '').lower()
-        
-        # Validar según tipo de archivo
-        if filename.endswith('.pdf') or 'pdf' in mime_type:
-            # Validar PDF
-            try:
-                reader = PdfReader(io.BytesIO(file_data))
-                num_pages = len(reader.pages)
-                if num_pages == 0:
-                    raise ValueError("PDF sin páginas")
-            except Exception as e:
-                await db.documents.update_one({"id": doc_id}, {"$set": {"status": DocumentStatus.REVISION}})
-                raise HTTPException(status_code=400, detail=f"PDF inválido: {str(e)}")
-        
-        elif filename.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')) or 'image' in mime_type:
-            # Validar imagen
-            try:
-                from PIL import Image
-                img = Image.open(io.BytesIO(file_data))
-                img.verify()
-            except Exception as e:
-                await db.documents.update_one({"id": doc_id}, {"$set": {"status": DocumentStatus.REVISION}})
-                raise HTTPException(status_code=400, detail=f"Imagen inválida: {str(e)}")
-        
-        # Si pasó las validaciones, marcar como validado
-        await db.documents.update_one({"id": doc_id}, {"$set": {"status": DocumentStatus.VALIDADO}})
-        
-        await log_action(user, "VALIDATE_DOCUMENT", f"Documento {doc['filename']} validado")
-        
-        return {"success": True, "status": "validado", "message": "Documento validado correctamente"}
-    
-    except HTTPException:
-        raise
+        # Validar según tipo de archivo (PdfReader / Image.verify en el pool de procesos)
+        error = stored_validation_error(doc)
+        if error is False:
+            file_data = await load_document_bytes(doc)
+            error = await run_in_pool(validate_file, file_data, doc.get('filename', ''), doc.get('mime_type', ''))
     except Exception as e:
+        error = f"Error al validar: {str(e)}"
+    
+    if error:
         await db.documents.update_one({"id": doc_id}, {"$set": {"status": DocumentStatus.REVISION}})
-        raise HTTPException(status_code=400, detail=f"Error al validar: {str(e)}")
-
-@api_router.post("/documents/validate-folder/{tipo_documento}")
-async def validate_folder(tipo_documento: str, authorization: str = Header(None)):
-    """Valida todos los documentos de una carpeta/tipo"""
-    user = await get_current_user(authorization)
+        raise HTTPException(status_code=400, detail=error)
     
-    # Obtener documentos no validados de esta carpeta
-    docs = await db.documents.find({
-        "tipo_documento": tipo_documento,
-        "status": DocumentStatus.CARGADO
-    }, {"_id": 0, "id": 1, "filename": 1}).to_list(1000)
+    # Si pasó las validaciones, marcar como validado
+    await db.documents.update_one({"id": doc_id}, {"$set": {"status": DocumentStatus.VALIDADO}})
     
-    if not docs:
-        return {"success": True, "validated": 0, "message": "No hay documentos pendientes de validar"}
+    await log_action(user, "VALIDATE_DOCUMENT", f"Documento {doc['filename']} validado")
+    
+    return {"success": True, "status": "validado", "message": "Documento validado correctamente"}
+
+async def bulk_validate_documents(query: Dict[str, Any], on_progress=None) -> Dict[str, Any]:
+    """
+    Valida en paralelo (pool de procesos) todos los documentos que cumplen query.
+    
+    Los documentos con file_info ya tienen el resultado de validación calculado
+    al cargarlos; los demás se leen completos y solo VALIDATION_CONCURRENCY
+    archivos están en memoria a la vez. Los cambios de estado se escriben al
+    final con un único bulk_write. on_progress(evento) recibe un dict por documento.
+    """
+    total = await db.documents.count_documents(query)
+    cursor = db.documents.find(
+        query, {"_id": 0, "id": 1, "filename": 1, "mime_type": 1, "file_info": 1, "parent_document_id": 1, "page_number": 1}
+    ).batch_size(100)
     
-    validated = 0
+    semaphore = asyncio.Semaphore(VALIDATION_CONCURRENCY)
+    operations = []
     errors = []
+    tasks = set()
     
-    for doc in docs:
+    async def validate_one(doc):
         try:
-            # Llamar a la validación individual
-            await validate_document(doc['id'], authorization)
-            validated += 1
-        except HTTPException as e:
-            errors.append({"filename": doc['filename'], "error": e.detail})
+            error = stored_validation_error(doc)
+            if error is False:
+                full_doc = await db.documents.find_one({"id": doc['id']}, {"_id": 0, "file_data": 1})
+                file_data = await load_document_bytes({**doc, **(full_doc or {})})
+                error = await run_in_pool(validate_file, file_data, doc.get('filename', ''), doc.get('mime_type', ''))
         except Exception as e:
-            errors.append({"filename": doc['filename'], "error": str(e)})
+            error = f"Error al validar: {str(e)}"
+        finally:
+            semaphore.release()
+        
+        new_status = DocumentStatus.REVISION if error else DocumentStatus.VALIDADO
+        operations.append(UpdateOne({"id": doc['id']}, {"$set": {"status": new_status}}))
+        if error:
+            errors.append({"filename": doc['filename'], "error": error})
+        if on_progress:
+            on_progress({
+                "processed": len(operations),
+                "total": total,
+                "filename": doc['filename'],
+                "status": new_status,
+                "error": error
+            })
+    
+    async for doc in cursor:
+        await semaphore.acquire()
+        task = asyncio.create_task(validate_one(doc))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
     
-    await log_action(user, "VALIDATE_FOLDER", f"Validados {validated} documentos en {tipo_documento}")
+    if operations:
+        await db.documents.bulk_write(operations, ordered=False)
     
     return {
         "success": True,
-        "validated": validated,
+        "validated": len(operations) - len(errors),
         "errors": len(errors),
         "error_details": errors[:5]  # Mostrar máximo 5 errores
     }
 
+async def validation_response(user: User, query: Dict[str, Any], label: str, stream: bool):
+    """Respuesta de validación masiva: JSON con el resumen o stream NDJSON de progreso."""
+    if not stream:
+        summary = await bulk_validate_documents(query)
+        await log_action(user, "VALIDATE_FOLDER", f"Validados {summary['validated']} documentos en {label}, {summary['errors']} con errores")
+        return summary
+    
+    queue: asyncio.Queue = asyncio.Queue()
+    
+    async def run():
+        try:
+            summary = await bulk_validate_documents(query, on_progress=queue.put_nowait)
+            await log_action(user, "VALIDATE_FOLDER", f"Validados {summary['validated']} documentos en {label}, {summary['errors']} con errores")
+            queue.put_nowait({"done": True, **summary})
+        except Exception as e:
+            queue.put_nowait({"done": True, "success": False, "error": str(e)})
+    
+    async def events():
+        worker = asyncio.create_task(run())
+        try:
+            while True:
+                event = await queue.get()
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+                if event.get("done"):
+                    break
+        finally:
+            await worker
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@api_router.post("/documents/validate-folder/{tipo_documento}")
+async def validate_folder(tipo_documento: str, authorization: str = Header(None), stream: bool = False):
+    """Valida todos los documentos de una carpeta/tipo"""
+    user = await get_current_user(authorization)
+    
+    query = {"tipo_documento": tipo_documento, "status": DocumentStatus.CARGADO}
+    if not await db.documents.count_documents(query, limit=1):
+        return {"success": True, "validated": 0, "message": "No hay documentos pendientes de validar"}
+    
+    return await validation_response(user, query, tipo_documento, stream)
+
+@api_router.post("/documents/validate-bulk")
+async def validate_bulk(
+    authorization: str = Header(None),
+    tipo_documento: Optional[List[str]] = Query(None),
+    stream: bool = False
+):
+    """
+    Valida en una sola llamada los documentos CARGADOS de varias carpetas
+    (todas si no se indica tipo_documento). Con stream=true devuelve el
+    progreso como NDJSON (una línea por documento y una final con el resumen).
+    """
+    user = await get_current_user(authorization)
+    
+    query = {"status": DocumentStatus.CARGADO}
+    if tipo_documento:
+        query["tipo_documento"] = {"$in": tipo_documento}
+    if not await db.documents.count_documents(query, limit=1):
+        return {"success": True, "validated": 0, "message": "No hay documentos pendientes de validar"}
+    
+    return await validation_response(user, query, ", ".join(tipo_documento or ["todas las carpetas"]), stream)
+
 @api_router.post("/documents/{doc_id}/analyze")
 async def analyze_document(doc_id: str, authorization: str = Header(None)):
     """
@@ -990,12 +1852,13 @@ async def analyze_document(doc_id: str, authorization: str = Header(None)):
     if is_pdf and not doc.get('parent_document_id') and not doc.get('split_into'):
         # Verificar número de páginas
         try:
-            reader = PdfReader(io.BytesIO(doc['file_data']))
-            num_pages = len(reader.pages)
+            num_pages = (doc.get('file_info') or {}).get('page_count')
+            if num_pages is None:
+                num_pages = await run_in_pool(count_pages, doc['file_data'])
             
             if num_pages > 1:
                 # Dividir automáticamente el PDF multipágina
-                pages_data = split_pdf_to_pages(doc['file_data'])
+                pages_data = await run_in_pool(split_pdf_to_pages, doc['file_data'])
                 created_docs = []
                 skipped_pages = []
                 
@@ -1026,7 +1889,6 @@ async def analyze_document(doc_id: str, authorization: str = Header(None)):
                             "mime_type": "application/pdf",
                             "status": DocumentStatus.ANALIZADO,  # Cambio: ahora es ANALIZADO
                             "uploaded_at": datetime.now(timezone.utc).isoformat(),
-                            "file_data": page_data,
                             "parent_document_id": doc_id,
                             "page_number": page_num,
                             "valor": analysis.get('valor'),
@@ -1040,7 +1902,9 @@ async def analyze_document(doc_id: str, authorization: str = Header(None)):
                             "analisis_completo": analysis
                         }
                         
-                        await db.documents.insert_one(new_doc)
+                        # La página queda como referencia al PDF padre (sin copiar bytes)
+                        await db.documents.insert_one(with_correlation_keys(new_doc))
+                        page_cache[(doc_id, page_num)] = page_data
                         created_docs.append({
                             "id": new_doc_id,
                             "filename": new_doc['filename'],
@@ -1057,9 +1921,13 @@ async def analyze_document(doc_id: str, authorization: str = Header(None)):
                     {"$set": {
                         "status": "dividido",
                         "split_into": [d['id'] for d in created_docs],
-                        "total_pages": num_pages
+                        "total_pages": num_pages,
+                        "thumbnail_key": None
                     }}
                 )
+                # Las páginas tienen sus propias miniaturas; la del original ya no se muestra
+                await prune_thumbnails([doc.get('thumbnail_key')])
+                schedule_file_metadata([d['id'] for d in created_docs])
                 
                 await log_action(user, "AUTO_SPLIT_ANALYZE", f"PDF {doc['filename']} dividido en {len(created_docs)} documentos")
                 
@@ -1075,9 +1943,13 @@ async def analyze_document(doc_id: str, authorization: str = Header(None)):
             logging.warning(f"Error checking PDF pages: {e}")
     
     # Análisis normal para documentos de una página
+    file_data = await load_document_bytes(doc)
+    if not file_data:
+        raise HTTPException(status_code=400, detail="El documento no tiene contenido")
+    
     temp_path = f"/tmp/{doc_id}_{doc['filename']}"
     with open(temp_path, "wb") as f:
-        f.write(doc['file_data'])
+        f.write(file_data)
     
     analysis = await analyze_document_with_gpt(temp_path, doc['mime_type'])
     
@@ -1103,7 +1975,7 @@ async def analyze_document(doc_id: str, authorization: str = Header(None)):
     if analysis.get("banco"):
         update_data["banco"] = analysis["banco"]
     
-    await db.documents.update_one({"id": doc_id}, {"$set": update_data})
+    await db.documents.update_one({"id": doc_id}, {"$set": with_correlation_keys(update_data)})
     
     try:
         os.remove(temp_path)
@@ -1114,10 +1986,8 @@ async def analyze_document(doc_id: str, authorization: str = Header(None)):
     
     return {"success": True, "analysis": analysis, "was_split": False}
 
-@api_router.post("/documents/analyze-all")
-async def analyze_all_documents(authorization: str = Header(None)):
-    """Analiza todos los documentos VALIDADOS con IA y busca correlaciones"""
-    user = await get_current_user(authorization)
+async def analyze_validated_documents(user: User, limit: int = 3) -> Dict[str, Any]:
+    """Analiza con IA hasta limit documentos VALIDADOS (una tanda de /documents/analyze-all)"""
     logging.info("=== INICIO analyze_all_documents ===")
     
     # Verificar que todas las carpetas tengan sus documentos validados
@@ -1132,7 +2002,7 @@ async def analyze_all_documents(authorization: str = Header(None)):
     docs = await db.documents.find(
         {"status": DocumentStatus.VALIDADO},
         {"_id": 0}
-    ).to_list(3)  # Solo 3 documentos por llamada para evitar timeout
+    ).to_list(limit)  # Solo 3 documentos por llamada para evitar timeout
     
     logging.info(f"Documentos a analizar: {len(docs)}")
     
@@ -1150,9 +2020,12 @@ async def analyze_all_documents(authorization: str = Header(None)):
         try:
             logging.info(f"Analizando: {doc['filename']}")
             # Guardar temporalmente para análisis
+            file_data = await load_document_bytes(doc)
+            if not file_data:
+                raise ValueError("El documento no tiene contenido")
             temp_path = f"/tmp/{doc['id']}_{doc['filename']}"
             with open(temp_path, "wb") as f:
-                f.write(doc['file_data'])
+                f.write(file_data)
             
             # Analizar con Gemini
             analysis = await analyze_document_with_gpt(temp_path, doc['mime_type'])
@@ -1181,7 +2054,7 @@ async def analyze_all_documents(authorization: str = Header(None)):
             if analysis.get("banco"):
                 update_data["banco"] = analysis["banco"]
             
-            await db.documents.update_one({"id": doc['id']}, {"$set": update_data})
+            await db.documents.update_one({"id": doc['id']}, {"$set": with_correlation_keys(update_data)})
             analyzed_count += 1
             
             # Limpiar archivo temporal
@@ -1203,6 +2076,113 @@ async def analyze_all_documents(authorization: str = Header(None)):
         "errors": errors if errors else None
     }
 
+# Último análisis en segundo plano (uno a la vez en todos los procesos): se guarda en
+# analysis_jobs con _id ANALYSIS_JOB_KEY, su progreso se publica en /events y se
+# consulta en /documents/analyze-all/status si el cliente pierde los eventos
+ANALYSIS_JOB_KEY = "analyze-all"
+# Un análisis sin avances en este tiempo (p. ej. el proceso se reinició) ya no está en curso
+ANALYSIS_JOB_STALE_SECONDS = 10 * 60
+
+async def run_analysis_job(job_id: str, user: User):
+    """Analiza tandas de documentos VALIDADOS hasta terminar, publicando job.progress por tanda."""
+    analyzed_total = 0
+    errors = []
+    try:
+        while True:
+            result = await analyze_validated_documents(user)
+            analyzed_total += result['analyzed']
+            errors.extend(result.get('errors') or [])
+            await db.analysis_jobs.update_one({"_id": ANALYSIS_JOB_KEY, "id": job_id}, {"$set": {
+                "analyzed": analyzed_total, "remaining": result['remaining'], "errors": len(errors),
+                "updated_at": datetime.now(timezone.utc)
+            }})
+            await publish_event("job.progress", {
+                "job_id": job_id, "kind": "analyze", "analyzed": analyzed_total,
+                "remaining": result['remaining'], "errors": len(errors)
+            })
+            # Igual que el cliente: si una tanda no avanza se detiene
+            if result['analyzed'] == 0 or result['remaining'] <= 0:
+                break
+    except Exception as e:
+        logging.error(f"Error en el análisis en segundo plano {job_id}: {str(e)}")
+        errors.append({"error": str(e)})
+    finally:
+        await db.analysis_jobs.update_one({"_id": ANALYSIS_JOB_KEY, "id": job_id}, {"$set": {
+            "running": False, "analyzed": analyzed_total, "errors": len(errors),
+            "updated_at": datetime.now(timezone.utc)
+        }})
+        await publish_event("job.progress", {
+            "job_id": job_id, "kind": "analyze", "done": True,
+            "analyzed": analyzed_total, "errors": len(errors)
+        })
+
+@api_router.post("/documents/analyze-all")
+async def analyze_all_documents(authorization: str = Header(None), background: bool = False):
+    """
+    Analiza todos los documentos VALIDADOS con IA y busca correlaciones.
+    Por defecto analiza una tanda y devuelve lo que falta; con background=true
+    analiza todo en segundo plano y publica el progreso en GET /events.
+    """
+    user = await get_current_user(authorization)
+    
+    if not background:
+        return await analyze_validated_documents(user)
+    
+    remaining = await db.documents.count_documents({"status": DocumentStatus.VALIDADO})
+    if not remaining:
+        return {"job_id": None, "remaining": 0}
+    
+    # Se reclama el único trabajo: si otro proceso ya lo tiene en curso se devuelve ese
+    now = datetime.now(timezone.utc)
+    job_id = str(uuid.uuid4())
+    try:
+        job = await db.analysis_jobs.find_one_and_update(
+            {
+                "_id": ANALYSIS_JOB_KEY,
+                "$or": [
+                    {"running": False},
+                    {"updated_at": {"$lt": now - timedelta(seconds=ANALYSIS_JOB_STALE_SECONDS)}}
+                ]
+            },
+            {"$set": {
+                "id": job_id, "running": True, "created_by": user.id, "analyzed": 0,
+                "remaining": remaining, "errors": 0, "updated_at": now
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        job = await db.analysis_jobs.find_one({"_id": ANALYSIS_JOB_KEY})
+    
+    if job['id'] == job_id:
+        spawn_background(run_analysis_job(job_id, user))
+    
+    return {"job_id": job['id'] if job.get('running') else None, "remaining": remaining}
+
+@api_router.get("/documents/analyze-all/status")
+async def analyze_all_status(job_id: Optional[str] = None, authorization: str = Header(None)):
+    """Estado del análisis en segundo plano (respaldo de los eventos job.progress)."""
+    await get_current_user(authorization)
+    
+    remaining = await db.documents.count_documents({"status": DocumentStatus.VALIDADO})
+    job = await db.analysis_jobs.find_one({"_id": ANALYSIS_JOB_KEY})
+    if not job or (job_id and job.get('id') != job_id):
+        # Trabajo desconocido (reemplazado por otro): ya no está en curso
+        return {"job_id": job_id, "running": False, "remaining": remaining}
+    
+    # Un trabajo sin avances recientes quedó huérfano (el proceso que lo ejecutaba terminó)
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=ANALYSIS_JOB_STALE_SECONDS)
+    running = bool(job.get('running')) and bool(
+        await db.analysis_jobs.count_documents({"_id": ANALYSIS_JOB_KEY, "updated_at": {"$gte": cutoff}})
+    )
+    return {
+        "job_id": job['id'],
+        "running": running,
+        "analyzed": job.get('analyzed', 0),
+        "errors": job.get('errors', 0),
+        "remaining": remaining,
+    }
+
 @api_router.post("/documents/{doc_id}/split-pages")
 async def split_multipage_document(doc_id: str, authorization: str = Header(None)):
     """
@@ -1224,7 +2204,7 @@ async def split_multipage_document(doc_id: str, authorization: str = Header(None
         raise HTTPException(status_code=400, detail="Solo se pueden dividir archivos PDF")
     
     # Dividir PDF en páginas
-    pages_data = split_pdf_to_pages(doc['file_data'])
+    pages_data = await run_in_pool(split_pdf_to_pages, doc['file_data'])
     
     if len(pages_data) <= 1:
         return {
@@ -1265,7 +2245,6 @@ async def split_multipage_document(doc_id: str, authorization: str = Header(None
                 "mime_type": "application/pdf",
                 "status": DocumentStatus.EN_PROCESO,
                 "uploaded_at": datetime.now(timezone.utc).isoformat(),
-                "file_data": page_data,
                 "parent_document_id": doc_id,
                 "page_number": page_num,
                 "valor": analysis.get('valor'),
@@ -1279,7 +2258,9 @@ async def split_multipage_document(doc_id: str, authorization: str = Header(None
                 "analisis_completo": analysis
             }
             
-            await db.documents.insert_one(new_doc)
+            # La página queda como referencia al PDF padre (sin copiar bytes)
+            await db.documents.insert_one(with_correlation_keys(new_doc))
+            page_cache[(doc_id, page_num)] = page_data
             
             created_docs.append({
                 "id": new_doc_id,
@@ -1302,9 +2283,13 @@ async def split_multipage_document(doc_id: str, authorization: str = Header(None
         {"$set": {
             "status": "dividido",
             "split_into": [d['id'] for d in created_docs],
-            "total_pages": len(pages_data)
+            "total_pages": len(pages_data),
+            "thumbnail_key": None
         }}
     )
+    # Las páginas tienen sus propias miniaturas; la del original ya no se muestra
+    await prune_thumbnails([doc.get('thumbnail_key')])
+    schedule_file_metadata([d['id'] for d in created_docs])
     
     await log_action(user, "SPLIT_DOCUMENT", f"Documento {doc['filename']} dividido en {len(created_docs)} páginas válidas de {len(pages_data)} totales")
     
@@ -1326,74 +2311,90 @@ async def auto_split_all_multipage(authorization: str = Header(None)):
     """
     user = await get_current_user(authorization)
     
-    # Buscar documentos PDF que tengan más de 1 página y no hayan sido divididos
-    docs = await db.documents.find(
-        {
-            "status": {"$in": [DocumentStatus.CARGADO, DocumentStatus.EN_PROCESO]},
-            "split_into": {"$exists": False},
-            "parent_document_id": {"$exists": False}  # No procesar páginas ya extraídas
-        },
-        {"_id": 0, "file_data": 0}
-    ).to_list(1000)
-    
-    results = []
-    
-    for doc in docs:
-        # Verificar si es PDF
-        if not doc.get('filename', '').lower().endswith('.pdf'):
-            continue
-        
-        # Obtener documento completo para verificar páginas
-        full_doc = await db.documents.find_one({"id": doc['id']}, {"_id": 0})
-        if not full_doc or not full_doc.get('file_data'):
-            continue
-        
-        # Verificar número de páginas
-        try:
-            reader = PdfReader(io.BytesIO(full_doc['file_data']))
-            num_pages = len(reader.pages)
-            
-            if num_pages > 1:
-                results.append({
-                    "id": doc['id'],
-                    "filename": doc['filename'],
-                    "pages": num_pages,
-                    "status": "pendiente_division"
-                })
-        except:
-            continue
+    candidates = {
+        "status": {"$in": [DocumentStatus.CARGADO, DocumentStatus.EN_PROCESO]},
+        "split_into": {"$exists": False},
+        "parent_document_id": {"$exists": False}  # No procesar páginas ya extraídas
+    }
+    
+    # Documentos cargados antes de file_info (o cuyo cálculo aún no termina): se calculan en
+    # segundo plano y aparecen en la siguiente consulta, sin demorar esta respuesta
+    pending = await db.documents.find(
+        {**candidates, "file_data": {"$exists": True}, "file_info.version": {"$ne": FILE_INFO_VERSION}},
+        {"_id": 0, "id": 1}
+    ).to_list(1000)
+    schedule_file_metadata([doc['id'] for doc in pending])
+    
+    # PDFs con más de 1 página que no han sido divididos: una consulta indexada
+    docs = await db.documents.find(
+        {**candidates, "file_info.page_count": {"$gt": 1}, "filename": {"$regex": r"\.pdf$", "$options": "i"}},
+        {"_id": 0, "id": 1, "filename": 1, "file_info.page_count": 1}
+    ).to_list(1000)
+    
+    results = [
+        {
+            "id": doc['id'],
+            "filename": doc['filename'],
+            "pages": doc['file_info']['page_count'],
+            "status": "pendiente_division"
+        }
+        for doc in docs
+    ]
+    
+    message = f"Se encontraron {len(results)} documentos multipágina para dividir"
+    if pending:
+        message += f"; {len(pending)} documentos aún se están analizando, vuelva a consultar en unos segundos"
     
     return {
         "multipage_documents": results,
         "total_found": len(results),
-        "message": f"Se encontraron {len(results)} documentos multipágina para dividir"
+        "pending_metadata": len(pending),
+        "message": message
     }
 
 # Batch Processing Endpoints
+# Motores locales de suggest-batches (engine)
+SUGGEST_ENGINES = ("basic", "clusters")
+
 @api_router.get("/documents/suggest-batches")
-async def suggest_batches(authorization: str = Header(None), use_ai: bool = True):
+async def suggest_batches(authorization: str = Header(None), use_ai: bool = True, engine: str = "basic"):
     """
     Sugiere lotes automáticamente basándose en correlaciones de documentos analizados.
     
     Si use_ai=True (default), usa Claude Sonnet 4.5 para correlación inteligente.
-    Si use_ai=False, usa el algoritmo básico de coincidencia por valor y tercero.
+    Si use_ai=False, una agregación en MongoDB (NIT + valor, ventanas de valor,
+    referencias) selecciona los candidatos y solo esos se cargan en Python.
+    Sin IA (o si Claude no responde) se usa el motor local indicado en engine:
+    - "basic" (default): algoritmo voraz de coincidencia por NIT, valor y tercero
+    - "clusters": union-find sobre NIT, valor, referencia, número de documento y fecha
     """
     user = await get_current_user(authorization)
     
+    if engine not in SUGGEST_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Motor inválido. Debe ser uno de: {list(SUGGEST_ENGINES)}")
+    
     logging.info("=== INICIO suggest_batches ===")
     logging.info(f"Usando IA: {use_ai}")
     
-    # Obtener documentos analizados (sin lote asignado)
-    docs = await db.documents.find(
-        {
-            "status": {"$in": ["en_proceso", "analizado", "validado"]},
-            "$or": [
-                {"batch_id": {"$exists": False}},
-                {"batch_id": None}
-            ]
-        },
-        {"_id": 0, "file_data": 0}
-    ).to_list(1000)
+    # Documentos analizados (sin lote asignado)
+    unbatched_query = {
+        "status": {"$in": ["en_proceso", "analizado", "validado"]},
+        "$or": [
+            {"batch_id": {"$exists": False}},
+            {"batch_id": None}
+        ]
+    }
+    projection = {"_id": 0, "file_data": 0, "analisis_completo": 0, "tercero_trigrams": 0}
+    
+    if use_ai:
+        docs = await db.documents.find(unbatched_query, projection).to_list(1000)
+    else:
+        # Primera pasada en MongoDB: solo vuelven los ids de grupos candidatos
+        groups = await db.documents.aggregate(
+            correlation_candidates_pipeline(unbatched_query), allowDiskUse=True
+        ).to_list(None)
+        candidate_ids = candidate_ids_from_groups(groups)
+        docs = await db.documents.find({"id": {"$in": list(candidate_ids)}}, projection).to_list(None)
     
     logging.info(f"Documentos encontrados: {len(docs)}")
     
@@ -1404,14 +2405,21 @@ async def suggest_batches(authorization: str = Header(None), use_ai: bool = True
     if not docs_with_data:
         return {"suggested_batches": [], "message": "No hay documentos analizados con datos extraídos", "total_suggestions": 0}
     
+    # SUMA DE FACTURAS: se resuelve localmente; al LLM solo llegan los casos ambiguos
+    suma_groups = find_suma_facturas_groups(docs_with_data)
+    grouped_ids = {doc_id for grupo in suma_groups for doc_id in grupo['document_ids']}
+    pending_docs = [d for d in docs_with_data if d['id'] not in grouped_ids]
+    logging.info(f"Sumas de facturas encontradas localmente: {len(suma_groups)}")
+    
     # USAR CLAUDE PARA CORRELACIÓN INTELIGENTE
-    if use_ai and len(docs_with_data) >= 2:
+    if use_ai and len(pending_docs) >= 2:
         logging.info("Usando Claude Sonnet 4.5 para correlación inteligente...")
         try:
-            correlations = await correlate_documents_with_claude(docs_with_data)
+            correlations = await correlate_documents_with_claude(pending_docs)
             
             if correlations:
-                await log_action(user, "SUGGEST_BATCHES_AI", f"Claude sugirió {len(correlations)} lotes")
+                correlations = suma_groups + correlations
+                await log_action(user, "SUGGEST_BATCHES_AI", f"Claude sugirió {len(correlations) - len(suma_groups)} lotes, {len(suma_groups)} por suma de facturas")
                 return {
                     "suggested_batches": correlations,
                     "total_suggestions": len(correlations),
@@ -1423,17 +2431,23 @@ async def suggest_batches(authorization: str = Header(None), use_ai: bool = True
         except Exception as e:
             logging.error(f"Error con Claude, usando fallback: {str(e)}")
     
-    # MÉTODO BÁSICO MEJORADO (fallback)
-    logging.info("Usando método básico mejorado...")
-    correlations = correlate_documents_basic(docs_with_data)
+    # MÉTODO LOCAL (fallback): clusters multi-criterio o básico mejorado
+    if engine == "clusters":
+        logging.info("Usando motor de clusters multi-criterio...")
+        correlations = suma_groups + correlate_documents_clusters(pending_docs)
+        method = "clusters"
+    else:
+        logging.info("Usando método básico mejorado...")
+        correlations = suma_groups + correlate_documents_basic(pending_docs, sumas=False)
+        method = "basic_improved"
     
     if correlations:
-        await log_action(user, "SUGGEST_BATCHES_BASIC", f"Método básico sugirió {len(correlations)} lotes")
+        await log_action(user, "SUGGEST_BATCHES_BASIC", f"Método {method} sugirió {len(correlations)} lotes")
         return {
             "suggested_batches": correlations,
             "total_suggestions": len(correlations),
             "message": f"Se encontraron {len(correlations)} grupos correlacionados",
-            "method": "basic_improved"
+            "method": method
         }
     
     return {
@@ -1471,12 +2485,17 @@ async def create_batch(
     return batch
 
 @api_router.get("/batches/list")
-async def list_batches(authorization: str = Header(None)):
+async def list_batches(request: Request, authorization: str = Header(None), fields: Optional[str] = None):
     user = await get_current_user(authorization)
     
-    batches = await db.batches.find({}, {"_id": 0}).to_list(1000)
+    etag = await list_etag(["batches"], "batches/list", fields)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
     
-    return {"batches": batches}
+    batches = await db.batches.find({}, list_fields(BATCH_LIST_FIELDS, fields)).to_list(1000)
+    
+    return versioned_json({"batches": batches}, etag)
 
 @api_router.delete("/batches/{batch_id}")
 async def delete_batch(batch_id: str, authorization: str = Header(None)):
@@ -1489,7 +2508,7 @@ async def delete_batch(batch_id: str, authorization: str = Header(None)):
     
     # Eliminar PDF consolidado si existe
     if batch.get('pdf_generado_id'):
-        await db.consolidated_pdfs.delete_one({"id": batch['pdf_generado_id']})
+        await delete_consolidated_pdf_record(batch['pdf_generado_id'])
     
     # Liberar documentos del lote (quitar batch_id)
     await db.documents.update_many(
@@ -1521,9 +2540,10 @@ async def delete_all_documents(authorization: str = Header(None)):
     # Eliminar documentos
     doc_result = await db.documents.delete_many({})
     
-    # Limpiar GridFS
+    # Limpiar GridFS y miniaturas
     await db.fs.files.delete_many({})
     await db.fs.chunks.delete_many({})
+    await db.thumbnails.delete_many({})
     
     await log_action(user, "DELETE_ALL", f"Eliminados {doc_result.deleted_count} documentos, {batch_result.deleted_count} lotes, {pdf_result.deleted_count} PDFs")
     
@@ -1547,7 +2567,9 @@ async def delete_document(doc_id: str, authorization: str = Header(None)):
     if doc.get('batch_id'):
         raise HTTPException(status_code=400, detail="No se puede eliminar un documento que está en un lote. Elimine el lote primero.")
     
-    await db.documents.delete_one({"id": doc_id})
+    # Las páginas virtuales de este documento necesitan sus propios bytes
+    await materialize_split_pages([doc_id])
+    await delete_documents({"id": doc_id})
     
     await log_action(user, "DELETE_DOCUMENT", f"Eliminado documento {doc['filename']}")
     
@@ -1570,13 +2592,16 @@ async def delete_folder_documents(tipo_documento: str, authorization: str = Head
     })
     
     # Eliminar documentos que NO están en un lote
-    result = await db.documents.delete_many({
+    delete_query = {
         "tipo_documento": tipo_documento,
         "$or": [
             {"batch_id": {"$exists": False}},
             {"batch_id": None}
         ]
-    })
+    }
+    doc_ids = [doc['id'] for doc in await db.documents.find(delete_query, {"_id": 0, "id": 1}).to_list(None)]
+    await materialize_split_pages(doc_ids)
+    result = await delete_documents(delete_query)
     
     await log_action(user, "DELETE_FOLDER", f"Eliminados {result.deleted_count} documentos de carpeta {tipo_documento}")
     
@@ -1609,6 +2634,9 @@ async def replace_document(
     if len(file_data) > MAX_FILE_SIZE:
         raise HTTPException(status_code=400, detail="El archivo excede el tamaño máximo de 10MB")
     
+    # Las páginas virtuales del documento anterior conservan su contenido
+    await materialize_split_pages([doc_id])
+    
     # Actualizar documento con nuevo archivo
     update_data = {
         "filename": file.filename,
@@ -1617,6 +2645,8 @@ async def replace_document(
         "mime_type": file.content_type or "application/octet-stream",
         "replaced_at": datetime.now(timezone.utc).isoformat(),
         "replaced_by": user.id,
+        "file_info": None,
+        "thumbnail_key": None,
         # Resetear análisis para que se pueda re-validar
         "status": DocumentStatus.CARGADO,
         "valor": None,
@@ -1630,13 +2660,15 @@ async def replace_document(
         "analisis_completo": None
     }
     
-    await db.documents.update_one({"id": doc_id}, {"$set": update_data})
+    await db.documents.update_one({"id": doc_id}, {"$set": with_correlation_keys(update_data)})
+    await prune_thumbnails([existing_doc.get('thumbnail_key')])
+    schedule_file_metadata([doc_id])
     
     # Si el documento está en un lote, marcar el lote como pendiente de regenerar PDF
     if existing_doc.get('batch_id'):
         await db.batches.update_one(
             {"id": existing_doc['batch_id']},
-            {"$set": {"needs_regeneration": True, "status": DocumentStatus.EN_PROCESO}}
+            {"$set": {"needs_regeneration": True, "needs_regeneration_at": datetime.now(timezone.utc), "status": DocumentStatus.EN_PROCESO}}
         )
     
     await log_action(user, "REPLACE_DOCUMENT", f"Reemplazado documento {existing_doc['filename']} por {file.filename}")
@@ -1717,12 +2749,13 @@ async def add_document_to_batch(
     }
     
     await db.documents.insert_one(doc_metadata)
+    schedule_file_metadata([doc_id])
     
     # Agregar documento al lote
     new_docs = batch.get('documentos', []) + [doc_id]
     await db.batches.update_one(
         {"id": batch_id},
-        {"$set": {"documentos": new_docs, "needs_regeneration": True, "status": DocumentStatus.EN_PROCESO}}
+        {"$set": {"documentos": new_docs, "needs_regeneration": True, "needs_regeneration_at": datetime.now(timezone.utc), "status": DocumentStatus.EN_PROCESO}}
     )
     
     await log_action(user, "ADD_TO_BATCH", f"Documento {file.filename} agregado al lote {batch_id}")
@@ -1755,7 +2788,7 @@ async def remove_document_from_batch(batch_id: str, doc_id: str, authorization:
     new_docs = [d for d in batch['documentos'] if d != doc_id]
     await db.batches.update_one(
         {"id": batch_id},
-        {"$set": {"documentos": new_docs, "needs_regeneration": True}}
+        {"$set": {"documentos": new_docs, "needs_regeneration": True, "needs_regeneration_at": datetime.now(timezone.utc)}}
     )
     
     # Quitar batch_id del documento (liberarlo)
@@ -1773,105 +2806,36 @@ async def remove_document_from_batch(batch_id: str, doc_id: str, authorization:
     }
 
 @api_router.post("/batches/{batch_id}/regenerate-pdf")
-async def regenerate_pdf(batch_id: str, authorization: str = Header(None)):
-    """Regenera el PDF consolidado de un lote (después de reemplazar documentos)"""
+async def regenerate_pdf(batch_id: str, authorization: str = Header(None), optimize: Optional[bool] = None):
+    """
+    Regenera el PDF consolidado de un lote (después de reemplazar documentos).
+    Solo se procesan los documentos reemplazados o agregados; el resto se copia del PDF anterior.
+    """
     user = await get_current_user(authorization)
     
     batch = await db.batches.find_one({"id": batch_id}, {"_id": 0})
     if not batch:
         raise HTTPException(status_code=404, detail="Lote no encontrado")
     
-    # Eliminar PDF anterior si existe
-    if batch.get('pdf_generado_id'):
-        await db.consolidated_pdfs.delete_one({"id": batch['pdf_generado_id']})
-    
-    # Generar nuevo consecutivo
-    current_year = datetime.now(timezone.utc).year
-    count = await db.consolidated_pdfs.count_documents({}) + 1
-    consecutive_number = f"{current_year}-{count:04d}"
-    
-    # Obtener documentos del lote
-    docs = await db.documents.find(
-        {"id": {"$in": batch['documentos']}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    # Ordenar documentos
-    order = [
-        DocumentType.COMPROBANTE_EGRESO,
-        DocumentType.CUENTA_POR_PAGAR,
-        DocumentType.SOPORTE_PAGO,
-        DocumentType.FACTURA
-    ]
-    sorted_docs = sorted(docs, key=lambda d: order.index(d['tipo_documento']) if d['tipo_documento'] in order else 999)
-    
-    # Crear PDF consolidado
-    merger = PdfMerger()
-    temp_files = []
-    
-    for doc in sorted_docs:
-        if doc.get('file_data'):
-            temp_path = f"/tmp/merge_{doc['id']}.pdf"
-            temp_files.append(temp_path)
-            
-            with open(temp_path, "wb") as f:
-                f.write(doc['file_data'])
-            
-            try:
-                merger.append(temp_path)
-            except Exception as e:
-                logging.warning(f"No se pudo agregar {doc['filename']}: {e}")
-    
-    output_path = f"/tmp/consolidated_{batch_id}.pdf"
-    merger.write(output_path)
-    merger.close()
-    
-    with open(output_path, "rb") as f:
-        pdf_data = f.read()
-    
-    # Limpiar archivos temporales
-    for temp_file in temp_files:
-        try:
-            os.remove(temp_file)
-        except:
-            pass
-    try:
-        os.remove(output_path)
-    except:
-        pass
-    
-    # Generar nombre del PDF basado en el comprobante de egreso
-    pdf_filename = generate_pdf_filename_from_batch(sorted_docs)
-    if not pdf_filename:
-        # Fallback a consecutivo si no hay comprobante de egreso válido
-        pdf_filename = f"Documentos_Consolidados_{consecutive_number}.pdf"
-    
-    consolidated = ConsolidatedPDF(
-        batch_id=batch_id,
-        filename=pdf_filename,
-        created_by=user.id,
-        file_size=len(pdf_data)
-    )
-    
-    consolidated_dict = consolidated.model_dump()
-    consolidated_dict['created_at'] = consolidated_dict['created_at'].isoformat()
-    consolidated_dict['pdf_data'] = pdf_data
-    
-    await db.consolidated_pdfs.insert_one(consolidated_dict)
+    # optimize (opcional) activa o desactiva la optimización del PDF para este lote
+    if optimize is not None:
+        batch['optimize_pdf'] = optimize
+        await db.batches.update_one({"id": batch_id}, {"$set": {"optimize_pdf": optimize}})
     
-    # Actualizar batch
-    await db.batches.update_one(
-        {"id": batch_id},
-        {"$set": {
-            "pdf_generado_id": consolidated.id, 
-            "status": DocumentStatus.TERMINADO,
-            "needs_regeneration": False
-        }}
-    )
+    consolidated = await generate_pdf_for_batch(batch, user)
     
-    await log_action(user, "REGENERATE_PDF", f"Regenerado PDF consolidado para lote {batch_id}")
+    await log_action(user, "REGENERATE_PDF", f"Regenerado PDF consolidado para lote {batch_id} ({consolidated['reused']} documentos reutilizados)")
     
-    return {"success": True, "pdf_id": consolidated.id, "filename": pdf_filename}
+    return {
+        "success": True,
+        "pdf_id": consolidated['id'],
+        "filename": consolidated['filename'],
+        "file_size": consolidated['file_size'],
+        "page_count": consolidated['page_count'],
+        "original_size": consolidated['original_size'],
+        "reused_documents": consolidated['reused'],
+        "failed_documents": consolidated['failed']
+    }
 
 @api_router.delete("/documents/bulk")
 async def delete_documents_bulk(
@@ -1890,18 +2854,24 @@ async def delete_documents_bulk(
     if docs_in_batch > 0:
         raise HTTPException(status_code=400, detail=f"{docs_in_batch} documento(s) están en lotes. Elimine los lotes primero.")
     
-    result = await db.documents.delete_many({"id": {"$in": document_ids}})
+    await materialize_split_pages(document_ids)
+    result = await delete_documents({"id": {"$in": document_ids}})
     
     await log_action(user, "DELETE_DOCUMENTS_BULK", f"Eliminados {result.deleted_count} documentos")
     
     return {"success": True, "deleted_count": result.deleted_count}
 
 @api_router.get("/documents/by-date")
-async def get_documents_by_date(authorization: str = Header(None)):
-    """Obtiene documentos agrupados por fecha de subida"""
+async def get_documents_by_date(request: Request, authorization: str = Header(None), fields: Optional[str] = None):
+    """Obtiene documentos agrupados por fecha de subida (mismos campos que /documents/list)"""
     user = await get_current_user(authorization)
     
-    docs = await db.documents.find({}, {"_id": 0, "file_data": 0}).to_list(10000)
+    etag = await list_etag(["documents"], "documents/by-date", fields)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    docs = await db.documents.find({}, list_fields(DOCUMENT_LIST_FIELDS, fields)).to_list(10000)
     
     # Agrupar por fecha
     by_date = {}
@@ -1933,7 +2903,7 @@ async def get_documents_by_date(authorization: str = Header(None)):
     # Convertir a lista ordenada por fecha (más reciente primero)
     result = sorted(by_date.values(), key=lambda x: x['date'], reverse=True)
     
-    return {"groups": result}
+    return versioned_json({"groups": result}, etag)
 
 @api_router.delete("/documents/by-date/{date}")
 async def delete_documents_by_date(date: str, authorization: str = Header(None)):
@@ -1968,7 +2938,8 @@ async def delete_documents_by_date(date: str, authorization: str = Header(None))
     if not docs_to_delete:
         return {"success": True, "deleted_count": 0, "message": "No hay documentos para eliminar en esta fecha"}
     
-    result = await db.documents.delete_many({"id": {"$in": docs_to_delete}})
+    await materialize_split_pages(docs_to_delete)
+    result = await delete_documents({"id": {"$in": docs_to_delete}})
     
     await log_action(user, "DELETE_BY_DATE", f"Eliminados {result.deleted_count} documentos de {date}")
     
@@ -1981,25 +2952,34 @@ async def reanalyze_group(document_ids: List[str], authorization: str = Header(N
     
     results = {"success": 0, "failed": 0, "errors": [], "new_matches": []}
     
-    # Primero, re-analizar los documentos existentes del grupo
+    # Primero, re-analizar los documentos existentes del grupo (en paralelo, con límite)
     group_terceros = set()
     group_valores = set()
+    semaphore = asyncio.Semaphore(REANALYZE_CONCURRENCY)
     
-    for doc_id in document_ids:
-        try:
+    async def reanalyze_one(doc_id: str):
+        async with semaphore:
             doc = await db.documents.find_one({"id": doc_id}, {"_id": 0})
             if not doc:
-                results["failed"] += 1
-                results["errors"].append(f"Documento {doc_id} no encontrado")
-                continue
+                # Documento no encontrado: se reporta como fallido al reunir los resultados
+                return None
             
             # Guardar temporalmente para análisis
+            file_data = await load_document_bytes(doc)
+            if not file_data:
+                raise ValueError(f"El documento {doc['filename']} no tiene contenido")
             temp_path = f"/tmp/{doc_id}_{doc['filename']}"
             with open(temp_path, "wb") as f:
-                f.write(doc['file_data'])
+                f.write(file_data)
             
-            # Re-analizar con IA
-            analysis = await analyze_document_with_gpt(temp_path, doc['mime_type'])
+            try:
+                # Re-analizar con IA
+                analysis = await analyze_document_with_gpt(temp_path, doc['mime_type'])
+            finally:
+                try:
+                    os.remove(temp_path)
+                except:
+                    pass
             
             update_data = {
                 "status": DocumentStatus.ANALIZADO,
@@ -2008,42 +2988,70 @@ async def reanalyze_group(document_ids: List[str], authorization: str = Header(N
             
             if analysis.get("valor") is not None:
                 update_data["valor"] = analysis["valor"]
-                group_valores.add(analysis["valor"])
             if analysis.get("fecha"):
                 update_data["fecha"] = analysis["fecha"]
             if analysis.get("concepto"):
                 update_data["concepto"] = analysis["concepto"]
             if analysis.get("tercero"):
                 update_data["tercero"] = analysis["tercero"]
-                group_terceros.add(analysis["tercero"].upper())
             if analysis.get("nit"):
                 update_data["nit"] = analysis["nit"]
             if analysis.get("numero_documento"):
                 update_data["numero_documento"] = analysis["numero_documento"]
             
-            await db.documents.update_one({"id": doc_id}, {"$set": update_data})
-            
-            try:
-                os.remove(temp_path)
-            except:
-                pass
-            
-            results["success"] += 1
-        except Exception as e:
-            results["failed"] += 1
-            results["errors"].append(f"Error en {doc_id}: {str(e)}")
+            await db.documents.update_one({"id": doc_id}, {"$set": with_correlation_keys(update_data)})
+            return analysis
     
-    # Segundo, buscar nuevos documentos que coincidan con el grupo
-    if group_terceros or group_valores:
+    outcomes = await asyncio.gather(*(reanalyze_one(doc_id) for doc_id in document_ids), return_exceptions=True)
+    
+    for doc_id, outcome in zip(document_ids, outcomes):
+        if outcome is None:
+            results["failed"] += 1
+            results["errors"].append(f"Documento {doc_id} no encontrado")
+        elif isinstance(outcome, Exception):
+            results["failed"] += 1
+            results["errors"].append(f"Error en {doc_id}: {str(outcome)}")
+        else:
+            results["success"] += 1
+            if outcome.get("valor") is not None:
+                group_valores.add(outcome["valor"])
+            if outcome.get("tercero"):
+                group_terceros.add(normalize_tercero(outcome["tercero"]))
+    
+    # Segundo, buscar nuevos documentos que coincidan con el grupo (tercero Y valor)
+    if group_terceros and any(group_valores):
+        # Candidatos desde el índice invertido de terceros: palabras en común,
+        # tercero del grupo contenido en el del documento (trigramas) o al revés (subcadenas)
+        group_tokens = set()
+        tercero_filters = [
+            # Documentos analizados antes de existir el índice
+            {"tercero_tokens": {"$exists": False}, "tercero": {"$nin": [None, ""]}}
+        ]
+        for gt in group_terceros:
+            group_tokens |= tercero_tokens(gt)
+            if len(gt) >= 3:
+                tercero_filters.append({"tercero_trigrams": {"$all": sorted(tercero_trigrams(gt))}})
+                tercero_filters.append({"tercero_norm": {"$in": tercero_substrings(gt)}})
+        if group_tokens:
+            tercero_filters.append({"tercero_tokens": {"$in": sorted(group_tokens)}})
+        
+        # Rangos de valor (tolerancia del 1%) resueltos con el índice de valor
+        valor_filters = [
+            {"valor": {"$gt": gv - 0.01 * max(gv, 1), "$lt": gv + 0.01 * max(gv, 1)}}
+            for gv in group_valores if gv
+        ]
+        
         # Buscar documentos analizados que no estén en un lote y que coincidan
         all_docs = await db.documents.find({
             "id": {"$nin": document_ids},  # No incluir los que ya están en el grupo
             "batch_id": {"$exists": False},  # No en un lote
-            "status": {"$in": [DocumentStatus.ANALIZADO, DocumentStatus.EN_PROCESO, DocumentStatus.VALIDADO]}
-        }, {"_id": 0, "file_data": 0}).to_list(1000)
+            "status": {"$in": [DocumentStatus.ANALIZADO, DocumentStatus.EN_PROCESO, DocumentStatus.VALIDADO]},
+            "$and": [{"$or": valor_filters}, {"$or": tercero_filters}]
+        }, {"_id": 0, "id": 1, "filename": 1, "tipo_documento": 1, "tercero": 1, "valor": 1}).to_list(1000)
         
         for doc in all_docs:
-            doc_tercero = (doc.get('tercero') or '').upper()
+            doc_tercero = normalize_tercero(doc.get('tercero'))
+            doc_tokens = tercero_tokens(doc_tercero)
             doc_valor = doc.get('valor')
             
             # Verificar coincidencia por tercero (coincidencia parcial)
@@ -2055,10 +3063,8 @@ async def reanalyze_group(document_ids: List[str], authorization: str = Header(N
                         if gt in doc_tercero or doc_tercero in gt:
                             tercero_match = True
                             break
-                        # Comparar palabras
-                        gt_words = set(gt.split())
-                        doc_words = set(doc_tercero.split())
-                        if gt_words & doc_words:  # Intersección de palabras
+                        # Comparar palabras significativas (sin SAS, LTDA, S.A.)
+                        if tercero_tokens(gt) & doc_tokens:
                             tercero_match = True
                             break
             
@@ -2085,99 +3091,187 @@ async def reanalyze_group(document_ids: List[str], authorization: str = Header(N
     return results
 
 @api_router.post("/batches/{batch_id}/generate-pdf")
-async def generate_consolidated_pdf(batch_id: str, authorization: str = Header(None)):
+async def generate_consolidated_pdf(
+    batch_id: str,
+    authorization: str = Header(None),
+    optimize: Optional[bool] = None,
+    lazy: Optional[bool] = None
+):
     user = await get_current_user(authorization)
     
     batch = await db.batches.find_one({"id": batch_id}, {"_id": 0})
     if not batch:
         raise HTTPException(status_code=404, detail="Lote no encontrado")
     
-    # Generar consecutivo automático
-    current_year = datetime.now(timezone.utc).year
-    count = await db.consolidated_pdfs.count_documents({}) + 1
-    consecutive_number = f"{current_year}-{count:04d}"  # Ej: 2025-0001
-    
-    # Obtener documentos del lote
-    docs = await db.documents.find(
-        {"id": {"$in": batch['documentos']}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    # Ordenar documentos según el orden especificado:
-    # 1. Comprobante de Egreso
-    # 2. Cuenta Por Pagar  
-    # 3. Soporte de Pago
-    # 4. Factura (si existe)
-    order = [
-        DocumentType.COMPROBANTE_EGRESO,
-        DocumentType.CUENTA_POR_PAGAR,
-        DocumentType.SOPORTE_PAGO,
-        DocumentType.FACTURA
-    ]
+    # optimize (opcional) activa o desactiva la optimización del PDF para este lote
+    if optimize is not None:
+        batch['optimize_pdf'] = optimize
+        await db.batches.update_one({"id": batch_id}, {"$set": {"optimize_pdf": optimize}})
     
-    sorted_docs = sorted(docs, key=lambda d: order.index(d['tipo_documento']) if d['tipo_documento'] in order else 999)
+    # lazy (opcional): registrar solo la composición y generar el PDF al descargarlo
+    if lazy is not None:
+        batch['lazy_pdf'] = lazy
+        await db.batches.update_one({"id": batch_id}, {"$set": {"lazy_pdf": lazy}})
     
-    # Crear PDF consolidado uniendo los documentos originales
-    pdf_writer = PdfWriter()
+    # Crear PDF consolidado uniendo los documentos originales: el worker lo escribe
+    # directamente en GridFS, sin pasar el archivo completo por memoria. Comparte el
+    # reclamo del lote con la regeneración manual, la masiva y la automática
+    consolidated = await generate_pdf_for_batch(batch, user)
     
-    for doc in sorted_docs:
-        try:
-            # Leer documento original
-            file_data = doc['file_data']
-            
-            # Si es PDF, agregar todas sus páginas
-            if doc['mime_type'] == 'application/pdf':
-                pdf_reader = PdfReader(io.BytesIO(file_data))
-                for page in pdf_reader.pages:
-                    pdf_writer.add_page(page)
-            # Si es imagen, convertir a PDF
-            elif 'image' in doc['mime_type']:
-                img = Image.open(io.BytesIO(file_data))
-                # Convertir imagen a RGB si es necesario
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                img_buffer = io.BytesIO()
-                img.save(img_buffer, format='PDF')
-                img_buffer.seek(0)
-                img_reader = PdfReader(img_buffer)
-                for page in img_reader.pages:
-                    pdf_writer.add_page(page)
-        except Exception as e:
-            logging.error(f"Error adding document {doc['filename']} to PDF: {str(e)}")
+    await log_action(user, "GENERATE_PDF", f"Generado PDF consolidado para lote {batch_id}")
     
-    # Guardar PDF consolidado
-    pdf_buffer = io.BytesIO()
-    pdf_writer.write(pdf_buffer)
-    pdf_data = pdf_buffer.getvalue()
+    return {
+        "success": True,
+        "pdf_id": consolidated['id'],
+        "filename": consolidated['filename'],
+        "file_size": consolidated['file_size'],
+        "page_count": consolidated['page_count'],
+        "original_size": consolidated['original_size'],
+        "failed_documents": consolidated['failed']
+    }
+
+# Lotes consolidados a la vez en la generación masiva
+BULK_PDF_CONCURRENCY = int(os.environ.get('BULK_PDF_CONCURRENCY', PDF_WORKERS))
+
+# Suscriptores en memoria del progreso de cada trabajo de generación masiva
+pdf_job_listeners: Dict[str, List[asyncio.Queue]] = {}
+
+async def publish_pdf_job_event(job_id: str, event: Dict[str, Any]):
+    for queue in pdf_job_listeners.get(job_id, []):
+        queue.put_nowait(event)
+    await publish_event("job.progress", {"job_id": job_id, "kind": "pdf", **event})
+
+async def run_bulk_pdf_job(job_id: str, batch_ids: List[str], user: User, optimize: Optional[bool]):
+    """
+    Ejecuta un trabajo de generación masiva: hasta BULK_PDF_CONCURRENCY lotes a
+    la vez en el pool de procesos. El error de un lote queda en su resultado y
+    no detiene a los demás. El progreso se guarda en pdf_jobs y se publica a
+    los suscriptores del stream.
+    """
+    semaphore = asyncio.Semaphore(BULK_PDF_CONCURRENCY)
     
-    # Generar nombre del PDF basado en el comprobante de egreso
-    pdf_filename = generate_pdf_filename_from_batch(sorted_docs)
-    if not pdf_filename:
-        # Fallback a consecutivo si no hay comprobante de egreso válido
-        pdf_filename = f"Documentos_Consolidados_{consecutive_number}.pdf"
+    async def generate_one(batch_id: str):
+        async with semaphore:
+            try:
+                batch = await db.batches.find_one({"id": batch_id}, {"_id": 0})
+                if not batch:
+                    raise LookupError("Lote no encontrado")
+                if optimize is not None:
+                    batch['optimize_pdf'] = optimize
+                    await db.batches.update_one({"id": batch_id}, {"$set": {"optimize_pdf": optimize}})
+                consolidated = await generate_pdf_for_batch(batch, user)
+                result = {
+                    "batch_id": batch_id,
+                    "success": True,
+                    "pdf_id": consolidated['id'],
+                    "filename": consolidated['filename'],
+                    "file_size": consolidated['file_size'],
+                    "page_count": consolidated['page_count'],
+                    "failed_documents": consolidated['failed']
+                }
+            except HTTPException as e:
+                result = {"batch_id": batch_id, "success": False, "error": e.detail}
+            except Exception as e:
+                logging.error(f"Error generando PDF del lote {batch_id}: {str(e)}")
+                result = {"batch_id": batch_id, "success": False, "error": str(e)}
+        
+        job = await db.pdf_jobs.find_one_and_update(
+            {"id": job_id},
+            {
+                "$push": {"results": result},
+                "$inc": {"processed": 1, "succeeded" if result['success'] else "failed": 1}
+            },
+            projection={"_id": 0, "processed": 1, "total": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        await publish_pdf_job_event(job_id, {"processed": job['processed'], "total": job['total'], **result})
     
-    consolidated = ConsolidatedPDF(
-        batch_id=batch_id,
-        filename=pdf_filename,
-        created_by=user.id,
-        file_size=len(pdf_data)
+    try:
+        await asyncio.gather(*(generate_one(batch_id) for batch_id in batch_ids))
+        status = "completado"
+    except Exception as e:
+        logging.error(f"Error en trabajo de generación masiva {job_id}: {str(e)}")
+        status = "error"
+    
+    job = await db.pdf_jobs.find_one_and_update(
+        {"id": job_id},
+        {"$set": {"status": status, "finished_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0, "results": 0},
+        return_document=ReturnDocument.AFTER
     )
+    await log_action(user, "GENERATE_PDF_BULK", f"Generación masiva {job_id}: {job['succeeded']} PDFs generados, {job['failed']} con errores")
+    await publish_pdf_job_event(job_id, {"done": True, **job})
+
+@api_router.post("/batches/generate-pdf-bulk")
+async def generate_pdfs_bulk(request: BulkPdfRequest, authorization: str = Header(None), stream: bool = False):
+    """
+    Genera en segundo plano los PDF consolidados de muchos lotes: los indicados
+    en batch_ids o todos los que tienen el estado status. Devuelve el id del
+    trabajo (consultar con GET /batches/generate-pdf-bulk/{job_id}); con
+    stream=true devuelve el progreso como NDJSON (una línea por lote y una
+    final con el resumen).
+    """
+    user = await get_current_user(authorization)
     
-    consolidated_dict = consolidated.model_dump()
-    consolidated_dict['created_at'] = consolidated_dict['created_at'].isoformat()
-    consolidated_dict['pdf_data'] = pdf_data
+    if request.batch_ids:
+        query = {"id": {"$in": request.batch_ids}}
+    elif request.status:
+        query = {"status": request.status}
+    else:
+        raise HTTPException(status_code=400, detail="Indique batch_ids o status")
+    
+    batch_ids = [batch['id'] for batch in await db.batches.find(query, {"_id": 0, "id": 1}).to_list(None)]
+    if not batch_ids:
+        return {"success": True, "job_id": None, "total": 0, "message": "No hay lotes para generar"}
+    
+    job_id = str(uuid.uuid4())
+    await db.pdf_jobs.insert_one({
+        "id": job_id,
+        "created_by": user.id,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "status": "en_proceso",
+        "total": len(batch_ids),
+        "processed": 0,
+        "succeeded": 0,
+        "failed": 0,
+        "results": []
+    })
     
-    await db.consolidated_pdfs.insert_one(consolidated_dict)
+    queue: asyncio.Queue = asyncio.Queue()
+    if stream:
+        pdf_job_listeners.setdefault(job_id, []).append(queue)
+    spawn_background(run_bulk_pdf_job(job_id, batch_ids, user, request.optimize))
     
-    # Actualizar batch
-    await db.batches.update_one(
-        {"id": batch_id},
-        {"$set": {"pdf_generado_id": consolidated.id, "status": DocumentStatus.TERMINADO}}
-    )
+    if not stream:
+        return {"success": True, "job_id": job_id, "total": len(batch_ids)}
     
-    await log_action(user, "GENERATE_PDF", f"Generado PDF consolidado para lote {batch_id}")
+    async def events():
+        try:
+            yield json.dumps({"job_id": job_id, "total": len(batch_ids)}, ensure_ascii=False) + "\n"
+            while True:
+                event = await queue.get()
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+                if event.get("done"):
+                    break
+        finally:
+            listeners = pdf_job_listeners.get(job_id, [])
+            if queue in listeners:
+                listeners.remove(queue)
+            if not listeners:
+                pdf_job_listeners.pop(job_id, None)
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@api_router.get("/batches/generate-pdf-bulk/{job_id}")
+async def get_bulk_pdf_job(job_id: str, authorization: str = Header(None)):
+    """Estado y resultados por lote de un trabajo de generación masiva"""
+    user = await get_current_user(authorization)
     
-    return {"success": True, "pdf_id": consolidated.id}
+    job = await db.pdf_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    
+    return job
 
 @api_router.get("/pdfs/{pdf_id}/download")
 async def download_pdf(pdf_id: str, authorization: str = Header(None)):
@@ -2187,21 +3281,111 @@ async def download_pdf(pdf_id: str, authorization: str = Header(None)):
     if not pdf:
         raise HTTPException(status_code=404, detail="PDF no encontrado")
     
+    # PDF diferido: se genera en la primera descarga (o tras ser desalojado de la caché)
+    if pdf.get('lazy'):
+        pdf = await ensure_pdf_built(pdf)
+    
     await log_action(user, "DOWNLOAD_PDF", f"Descargado PDF {pdf['filename']}")
     
+    headers = {"Content-Disposition": f"attachment; filename={pdf['filename']}"}
+    
+    # PDFs guardados en GridFS: se envían chunk por chunk
+    if pdf.get('gridfs_id'):
+        try:
+            grid_out = await fs_bucket.open_download_stream(ObjectId(pdf['gridfs_id']))
+        except Exception:
+            raise HTTPException(status_code=404, detail="Archivo del PDF no encontrado")
+        
+        async def iter_chunks():
+            with lazy_pdf_lease(pdf['id']):
+                while True:
+                    chunk = await grid_out.readchunk()
+                    if not chunk:
+                        break
+                    yield chunk
+        
+        headers["Content-Length"] = str(grid_out.length)
+        return StreamingResponse(iter_chunks(), media_type="application/pdf", headers=headers)
+    
     return StreamingResponse(
         io.BytesIO(pdf['pdf_data']),
         media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={pdf['filename']}"}
+        headers=headers
+    )
+
+@api_router.get("/pdfs/{pdf_id}/documents/{document_id}")
+async def download_pdf_section(pdf_id: str, document_id: str, authorization: str = Header(None)):
+    """
+    Devuelve solo las páginas de un documento dentro del PDF consolidado,
+    recortadas del archivo consolidado (sin volver a leer el documento fuente).
+    """
+    user = await get_current_user(authorization)
+    
+    pdf = await db.consolidated_pdfs.find_one({"id": pdf_id}, {"_id": 0})
+    if not pdf:
+        raise HTTPException(status_code=404, detail="PDF no encontrado")
+    if not pdf.get('composition'):
+        raise HTTPException(
+            status_code=409,
+            detail="Este PDF no tiene índice de páginas. Regenérelo para consultar documentos individuales"
+        )
+    
+    entry = next((item for item in pdf['composition'] if item['doc_id'] == document_id), None)
+    if not entry:
+        raise HTTPException(status_code=404, detail="El documento no forma parte de este PDF")
+    
+    if pdf.get('lazy'):
+        pdf = await ensure_pdf_built(pdf)
+        entry = next(item for item in pdf['composition'] if item['doc_id'] == document_id)
+    if not entry.get('page_count'):
+        raise HTTPException(status_code=404, detail="El documento no tiene páginas en este PDF")
+    
+    with lazy_pdf_lease(pdf['id']):
+        section = await run_in_pool(
+            extract_section,
+            pdf.get('gridfs_id'),
+            entry['start_page'],
+            entry['page_count'],
+            None if pdf.get('gridfs_id') else pdf.get('pdf_data')
+        )
+    
+    await log_action(user, "DOWNLOAD_PDF_SECTION", f"Descargada sección {entry.get('title') or document_id} de {pdf['filename']}")
+    
+    filename = f"{pdf['filename'].rsplit('.', 1)[0]}_p{entry['start_page'] + 1}-{entry['start_page'] + entry['page_count']}.pdf"
+    return StreamingResponse(
+        io.BytesIO(section),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"inline; filename={filename}"}
     )
 
+@api_router.get("/pdfs/{pdf_id}/thumbnail")
+async def get_pdf_thumbnail(pdf_id: str, request: Request, v: Optional[str] = None, authorization: str = Header(None)):
+    """Miniatura de la portada del PDF consolidado: es la primera página de su primer documento"""
+    user = await get_current_user(authorization)
+    
+    pdf = await db.consolidated_pdfs.find_one({"id": pdf_id}, {"_id": 0, "composition": 1})
+    if not pdf:
+        raise HTTPException(status_code=404, detail="PDF no encontrado")
+    
+    first = next((item for item in pdf.get('composition') or [] if item.get('page_count', 1)), None)
+    doc = await db.documents.find_one({"id": first['doc_id']}, {"_id": 0, "id": 1, "thumbnail_key": 1}) if first else None
+    if not doc:
+        raise HTTPException(status_code=404, detail="Miniatura no disponible")
+    
+    return await thumbnail_response(doc, v, request)
+
 @api_router.get("/pdfs/list")
-async def list_pdfs(authorization: str = Header(None)):
+async def list_pdfs(request: Request, authorization: str = Header(None), fields: Optional[str] = None):
     user = await get_current_user(authorization)
     
-    pdfs = await db.consolidated_pdfs.find({}, {"_id": 0, "pdf_data": 0}).to_list(1000)
+    etag = await list_etag(["consolidated_pdfs"], "pdfs/list", fields)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    pdfs = await db.consolidated_pdfs.find({}, list_fields(PDF_LIST_FIELDS, fields)).to_list(1000)
     
-    return {"pdfs": pdfs}
+    return versioned_json({"pdfs": pdfs}, etag)
 
 @api_router.delete("/pdfs/{pdf_id}")
 async def delete_consolidated_pdf(pdf_id: str, authorization: str = Header(None)):
@@ -2225,7 +3409,7 @@ async def delete_consolidated_pdf(pdf_id: str, authorization: str = Header(None)
         await db.batches.delete_one({"id": batch['id']})
     
     # Eliminar el PDF
-    await db.consolidated_pdfs.delete_one({"id": pdf_id})
+    await delete_consolidated_pdf_record(pdf_id)
     
     await log_action(user, "DELETE_PDF", f"Eliminado PDF consolidado {pdf['filename']}")
     
@@ -2255,6 +3439,17 @@ async def get_pdf_details(pdf_id: str, authorization: str = Header(None)):
         order = ['comprobante_egreso', 'cuenta_por_pagar', 'soporte_pago', 'factura']
         documents = sorted(docs, key=lambda d: order.index(d['tipo_documento']) if d['tipo_documento'] in order else 999)
     
+    # Rango de páginas (1-based) y posición en bytes de cada documento dentro del PDF
+    ranges = {item['doc_id']: item for item in pdf.get('composition') or []}
+    for doc in documents:
+        entry = ranges.get(doc['id'])
+        if entry and entry.get('page_count'):
+            doc['pdf_pages'] = {
+                "start": entry['start_page'] + 1,
+                "end": entry['start_page'] + entry['page_count'],
+                "byte_range": entry.get('byte_range')
+            }
+    
     # Calcular información resumida
     terceros = list(set(d.get('tercero') for d in documents if d.get('tercero')))
     valores = [d.get('valor') for d in documents if d.get('valor')]
@@ -2319,9 +3514,14 @@ async def get_audit_logs(authorization: str = Header(None), limit: int = 100):
 
 # Dashboard Stats
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(authorization: str = Header(None)):
+async def get_dashboard_stats(request: Request, authorization: str = Header(None)):
     user = await get_current_user(authorization)
     
+    etag = await list_etag(["documents", "batches", "consolidated_pdfs"], "dashboard/stats")
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
     total_docs = await db.documents.count_documents({})
     docs_cargados = await db.documents.count_documents({"status": DocumentStatus.CARGADO})
     docs_en_proceso = await db.documents.count_documents({"status": DocumentStatus.EN_PROCESO})
@@ -2331,7 +3531,7 @@ async def get_dashboard_stats(authorization: str = Header(None)):
     total_batches = await db.batches.count_documents({})
     pdfs_generados = await db.consolidated_pdfs.count_documents({})
     
-    return {
+    return versioned_json({
         "total_documentos": total_docs,
         "documentos_cargados": docs_cargados,
         "documentos_en_proceso": docs_en_proceso,
@@ -2339,10 +3539,102 @@ async def get_dashboard_stats(authorization: str = Header(None)):
         "documentos_revision": docs_revision,
         "total_lotes": total_batches,
         "pdfs_generados": pdfs_generados
-    }
+    }, etag)
+
+# Comentario periódico para que proxies y navegador mantengan abierta la conexión SSE
+EVENT_HEARTBEAT_SECONDS = 15
+
+# Tickets de /events: EventSource no envía encabezados y el token de sesión no debe ir en la URL
+# (queda en logs e historial), así que se canjea por un ticket de un solo uso y corta duración.
+# Se guardan en event_tickets (índice TTL en expires_at) para que sirvan en cualquier proceso
+EVENT_TICKET_SECONDS = 30
+
+@api_router.post("/events/ticket")
+async def create_event_ticket(authorization: str = Header(None)):
+    """Ticket de un solo uso para abrir GET /events?ticket=..."""
+    user = await get_current_user(authorization)
+    
+    ticket = secrets.token_urlsafe(32)
+    await db.event_tickets.insert_one({
+        "_id": ticket,
+        "user_id": user.id,
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=EVENT_TICKET_SECONDS)
+    })
+    return {"ticket": ticket, "expires_in": EVENT_TICKET_SECONDS}
+
+@api_router.get("/events")
+async def stream_events(
+    request: Request,
+    ticket: Optional[str] = None,
+    topics: Optional[str] = None,
+    last_event_id: Optional[str] = None,
+    authorization: str = Header(None)
+):
+    """
+    Server-Sent Events: cambios de estado de documentos, lotes y PDFs y
+    progreso de trabajos, filtrados por topics= (documents, batches, pdfs,
+    jobs; por defecto todos). Se autentica con un ticket de POST
+    /events/ticket (o el encabezado Authorization). Con Last-Event-ID (o
+    last_event_id= al reconectar con un ticket nuevo) se reenvían los
+    eventos perdidos.
+    """
+    if ticket:
+        # find_one_and_delete: el ticket se consume una sola vez (el índice TTL borra los vencidos con retraso)
+        claimed = await db.event_tickets.find_one_and_delete(
+            {"_id": ticket, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+        )
+        if claimed is None:
+            raise HTTPException(status_code=401, detail="Ticket inválido o vencido")
+    else:
+        await get_current_user(authorization)
+    
+    try:
+        selected = parse_topics(topics)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    last_event_id = request.headers.get('last-event-id') or last_event_id
+    queue = event_bus.subscribe(int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+    
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event_in_topics(event, selected):
+                    yield format_sse(event)
+        finally:
+            event_bus.unsubscribe(queue)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/metrics")
+async def get_metrics(authorization: str = Header(None)):
+    """Métricas del pool de procesos de PDF (cola, tareas en curso y latencias) y de compresión de respuestas (solo admin)"""
+    user = await get_current_user(authorization)
+    
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Solo administradores pueden ver las métricas")
+    
+    return {"pdf_pool": pool_metrics(), "compression": compression_metrics()}
 
 app.include_router(api_router)
 
+@app.exception_handler(PoolTaskError)
+async def pool_task_error_handler(request, exc: PoolTaskError):
+    return JSONResponse(status_code=504, content={"detail": f"Error procesando el PDF: {exc}"})
+
+# Compresión gzip/brotli de las respuestas JSON (omite PDFs, imágenes y streaming)
+app.add_middleware(CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -2357,6 +3649,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    # Índice invertido de terceros (multikey): token/trigrama -> documentos
+    await db.documents.create_index("tercero_tokens")
+    await db.documents.create_index("tercero_trigrams")
+    await db.documents.create_index("tercero_norm")
+    # Llaves de correlación precalculadas
+    await db.documents.create_index("nit_norm")
+    await db.documents.create_index("valor_bucket")
+    await db.documents.create_index("valor")
+    await db.documents.create_index("fecha_dt")
+    await db.documents.create_index("correlation_keys_version")
+    await db.documents.create_index([("status", 1), ("batch_id", 1)])
+    await db.documents.create_index("parent_document_id")
+    await db.batches.create_index([("needs_regeneration", 1), ("needs_regeneration_at", 1)])
+    await db.consolidated_pdfs.create_index([("lazy", 1), ("last_accessed_at", 1)])
+    await db.documents.create_index("file_info.page_count")
+    await db.documents.create_index("file_info.sha256")
+    await db.documents.create_index("file_info.version")
+    await db.documents.create_index("thumbnail_key")
+    await db.thumbnails.create_index("key", unique=True)
+    # Tickets de /events: Mongo borra los vencidos
+    await db.event_tickets.create_index("expires_at", expireAfterSeconds=0)
+    # Registro de eventos compartido entre procesos (colección capped)
+    await ensure_event_log(db)
+
+@app.on_event("startup")
+async def start_background_jobs():
+    # Se registra después de create_indexes: los trabajos encuentran índices y registro de eventos creados
+    spawn_background(backfill_correlation_keys())
+    spawn_background(compact_split_pages())
+    spawn_background(index_file_metadata_and_thumbnails({}))
+    spawn_background(regeneration_sweeper())
+    # Reparte a los clientes SSE de este proceso los eventos de todos los procesos
+    spawn_background(relay_events(db, event_bus))
+    # Workers del pool de PDF listos antes de la primera petición
+    await warm_pool()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    for task in list(background_tasks):
+        task.cancel()
+    client.close()
+    shutdown_pool()
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""
+Versión por colección para ETags de los listados.
+
+CollectionVersions es un CommandListener de pymongo: al terminar cada comando
+de escritura (insert, update, delete, findAndModify, ...) incrementa con $inc
+la versión de su colección en la colección collection_versions de Mongo, así
+que todos los procesos (workers de uvicorn y del pool de PDF) comparten los
+mismos contadores. Con las versiones se arma el ETag de un listado sin
+consultar los datos.
+
+- Las versiones se leen antes que los datos: una escritura que termina
+  después de la lectura cambia la versión y el ETag ya entregado deja de
+  coincidir.
+- Cada cliente de Mongo que escribe en las colecciones de los listados debe
+  registrar un CollectionVersions (version_store da la colección donde se
+  guardan los contadores); un escritor externo debe incrementar también
+  collection_versions.
+- Cada contador guarda un epoch aleatorio al crearse: si la colección se
+  borra, los ETags anteriores no vuelven a coincidir.
+- on_write permite reaccionar a las escrituras confirmadas (por ejemplo,
+  publicar eventos en /events).
+"""
+import hashlib
+import logging
+import threading
+import uuid
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+
+VERSIONS_COLLECTION = "collection_versions"
+# Colecciones con listados versionados (ETag)
+VERSIONED_COLLECTIONS = ("documents", "batches", "consolidated_pdfs")
+
+WRITE_COMMANDS = {
+    "insert", "update", "delete", "findAndModify", "findandmodify",
+    "drop", "renameCollection", "create", "aggregate",
+}
+
+
+def version_store(mongo_url: str, db_name: str):
+    """
+    Colección de los contadores, con un cliente propio: el listener no debe
+    usar el cliente que lo invoca.
+    """
+    return MongoClient(mongo_url)[db_name][VERSIONS_COLLECTION]
+
+
+class CollectionVersions(monitoring.CommandListener):
+    """
+    on_write(command_name, command) se llama al iniciar cada escritura (el
+    comando completo solo está disponible ahí) y puede devolver una función
+    que se ejecuta si el comando termina bien. Sin store (bind) solo se
+    ejecuta on_write. Con collections solo se siguen esas colecciones (las
+    de los listados); las demás escrituras no cuestan un $inc.
+    """
+    def __init__(self, on_write: Optional[Callable[[str, Dict[str, Any]], Optional[Callable[[], None]]]] = None,
+                 collections: Optional[Iterable[str]] = None):
+        self.on_write = on_write
+        self.collections = frozenset(collections) if collections is not None else None
+        self.store = None
+        self._pending: Dict[int, Tuple[str, Optional[Callable[[], None]]]] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, store):
+        """store: colección síncrona (pymongo) donde se incrementan los contadores."""
+        self.store = store
+
+    def _bump(self, collection: str):
+        if self.store is None or collection == self.store.name:
+            return
+        try:
+            self.store.update_one(
+                {"_id": collection},
+                {"$inc": {"version": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex}},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logging.error(f"No se pudo incrementar la versión de {collection}: {e}")
+
+    def started(self, event):
+        if event.command_name not in WRITE_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            return
+        if self.collections is not None and collection not in self.collections:
+            return
+        # aggregate solo escribe con $out/$merge
+        if event.command_name == "aggregate" and not any(
+            "$out" in stage or "$merge" in stage for stage in event.command.get("pipeline", [])
+        ):
+            return
+        on_success = self.on_write(event.command_name, event.command) if self.on_write else None
+        with self._lock:
+            self._pending[event.request_id] = (collection, on_success)
+
+    def _finished(self, event) -> Optional[Callable[[], None]]:
+        with self._lock:
+            collection, on_success = self._pending.pop(event.request_id, (None, None))
+        # También si falló: una escritura múltiple puede haber aplicado una parte
+        if collection:
+            self._bump(collection)
+        return on_success
+
+    def succeeded(self, event):
+        on_success = self._finished(event)
+        if on_success:
+            on_success()
+
+    def failed(self, event):
+        self._finished(event)
+
+
+def collection_etag(collections: Iterable[str], versions: Dict[str, Dict[str, Any]], *parts) -> str:
+    """
+    ETag de un listado: versiones de sus colecciones (documentos de
+    collection_versions por _id) más los parámetros de la consulta.
+    """
+    key = "|".join(
+        [
+            f"{name}:{versions.get(name, {}).get('epoch', '')}:{versions.get(name, {}).get('version', 0)}"
+            for name in collections
+        ]
+        + ["" if part is None else str(part) for part in parts]
+    )
+    return f'"{hashlib.sha1(key.encode()).hexdigest()[:24]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (la compresión vuelve débil el ETag: W/"...")."""
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or any(value.removeprefix("W/") == etag.removeprefix("W/") for value in candidates)
@@ -0,0 +1,193 @@
+"""
+Pool de procesos para el trabajo de CPU (PDF e imágenes).
+
+Las funciones que se envían al pool deben ser funciones de módulo
+importables (por ejemplo las de pdf_ops.py), nunca closures de server.py.
+
+- Los workers se inician al arrancar el servidor (warm_pool) con PyPDF2 y
+  PIL ya importados.
+- Los procesos se crean con forkserver (o spawn), no con fork: no heredan
+  los hilos, sockets ni el cliente de Mongo del servidor.
+- Cada proceso tiene un límite de memoria (RLIMIT_AS) y cada tarea un
+  tiempo máximo, contado desde que la tarea entra a un worker (no desde que
+  se encola); si una tarea se pasa, el pool se recicla.
+- pool_metrics() expone la profundidad de la cola y la latencia por tarea.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 2))
+PDF_TASK_TIMEOUT = float(os.environ.get('PDF_TASK_TIMEOUT', 120))
+PDF_WORKER_MEMORY_MB = int(os.environ.get('PDF_WORKER_MEMORY_MB', 2048))
+PDF_POOL_START_METHOD = os.environ.get(
+    'PDF_POOL_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+_executor = None
+# Una tarea solo se envía al pool cuando hay un worker libre, así el tiempo máximo no cuenta la espera en cola
+_slots = None
+
+
+class PoolTaskError(Exception):
+    """La tarea no terminó: tiempo agotado o el proceso del pool murió."""
+
+
+def _init_worker(memory_limit_mb: int):
+    """Inicializa cada proceso: límite de memoria y módulos pesados precargados."""
+    if memory_limit_mb > 0:
+        try:
+            import resource
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            logging.warning(f"No se pudo limitar la memoria del worker: {e}")
+    import pdf_ops  # noqa: F401  (precarga PyPDF2 y PIL)
+
+
+def _noop():
+    return os.getpid()
+
+
+def _timed_call(fn, args, kwargs):
+    """Se ejecuta en el worker: devuelve el resultado y el tiempo de CPU real de la tarea."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class _PoolMetrics:
+    def __init__(self):
+        self.in_flight = 0
+        self.tasks = {}
+
+    def task(self, name: str) -> dict:
+        return self.tasks.setdefault(name, {
+            "count": 0, "errors": 0, "timeouts": 0,
+            "latencies": deque(maxlen=500), "queue_waits": deque(maxlen=500)
+        })
+
+    def snapshot(self) -> dict:
+        def percentile(values, pct):
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 4) if ordered else None
+
+        return {
+            "workers": PDF_WORKERS,
+            "in_flight": self.in_flight,
+            "queue_depth": max(0, self.in_flight - PDF_WORKERS),
+            "tasks": {
+                name: {
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "timeouts": stats["timeouts"],
+                    "latency_p50": percentile(stats["latencies"], 0.5),
+                    "latency_p95": percentile(stats["latencies"], 0.95),
+                    "latency_max": percentile(stats["latencies"], 1.0),
+                    "queue_wait_p95": percentile(stats["queue_waits"], 0.95),
+                }
+                for name, stats in self.tasks.items()
+            }
+        }
+
+
+_metrics = _PoolMetrics()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        context = multiprocessing.get_context(PDF_POOL_START_METHOD)
+        if PDF_POOL_START_METHOD == 'forkserver':
+            context.set_forkserver_preload(['pdf_ops'])
+        _executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(PDF_WORKER_MEMORY_MB,)
+        )
+    return _executor
+
+
+def _recycle_pool(executor: ProcessPoolExecutor):
+    """
+    Termina los procesos de executor (por ejemplo uno colgado) y deja que se
+    cree un pool nuevo. Si executor ya fue reemplazado no hace nada: una tarea
+    que falla tarde no debe reciclar el pool nuevo.
+    """
+    global _executor
+    if executor is None or executor is not _executor:
+        return
+    _executor = None
+    # ProcessPoolExecutor no permite cancelar una tarea en ejecución: se matan los procesos
+    for process in list(getattr(executor, '_processes', {}).values()):
+        process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def warm_pool():
+    """Arranca todos los workers antes de la primera petición."""
+    await asyncio.gather(*(run_in_pool(_noop) for _ in range(PDF_WORKERS)))
+
+
+async def run_in_pool(fn, *args, timeout: float = None, **kwargs):
+    """
+    Ejecuta fn(*args, **kwargs) en el pool de procesos y espera el resultado.
+    Lanza PoolTaskError si supera el tiempo máximo o si el worker muere
+    (por ejemplo al pasar el límite de memoria).
+    """
+    global _slots
+    loop = asyncio.get_running_loop()
+    stats = _metrics.task(fn.__name__)
+    timeout = PDF_TASK_TIMEOUT if timeout is None else timeout
+    if _slots is None:
+        _slots = asyncio.Semaphore(PDF_WORKERS)
+
+    _metrics.in_flight += 1
+    start = time.perf_counter()
+    executor = None
+    try:
+        async with _slots:
+            executor = get_executor()
+            future = loop.run_in_executor(executor, partial(_timed_call, fn, args, kwargs))
+            result, run_time = await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        logging.error(f"Tarea {fn.__name__} superó {timeout}s; reciclando pool de procesos")
+        _recycle_pool(executor)
+        raise PoolTaskError(f"La operación {fn.__name__} superó el tiempo máximo de {timeout:.0f}s")
+    except BrokenProcessPool:
+        stats["errors"] += 1
+        logging.error(f"Worker del pool terminó inesperadamente durante {fn.__name__}")
+        _recycle_pool(executor)
+        raise PoolTaskError(f"La operación {fn.__name__} terminó el proceso (¿límite de memoria?)")
+    except Exception:
+        stats["errors"] += 1
+        raise
+    finally:
+        _metrics.in_flight -= 1
+
+    latency = time.perf_counter() - start
+    stats["count"] += 1
+    stats["latencies"].append(latency)
+    stats["queue_waits"].append(max(0.0, latency - run_time))
+    return result
+
+
+def pool_metrics() -> dict:
+    return _metrics.snapshot()
+
+
+def shutdown_pool():
+    global _executor, _slots
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _slots = None
@@ -0,0 +1,57 @@
+import { useEffect, useRef, useState } from 'react';
+import axios from 'axios';
+
+// URLs de miniaturas ya descargadas (por endpoint) para no pedirlas de nuevo al volver a renderizar
+const thumbnailUrls = new Map();
+
+// Miniatura autenticada: se descarga solo cuando la fila entra en pantalla
+export default function Thumbnail({ src, token, alt, fallback, className = '' }) {
+  const ref = useRef(null);
+  const [url, setUrl] = useState(() => thumbnailUrls.get(src) || null);
+  const [failed, setFailed] = useState(false);
+
+  useEffect(() => {
+    if (!src || thumbnailUrls.has(src)) {
+      setUrl(thumbnailUrls.get(src) || null);
+      return;
+    }
+
+    let cancelled = false;
+    const load = async () => {
+      try {
+        const response = await axios.get(src, {
+          headers: { Authorization: `Bearer ${token}` },
+          responseType: 'blob'
+        });
+        const objectUrl = window.URL.createObjectURL(response.data);
+        thumbnailUrls.set(src, objectUrl);
+        if (!cancelled) setUrl(objectUrl);
+      } catch (error) {
+        if (!cancelled) setFailed(true);
+      }
+    };
+
+    const observer = new IntersectionObserver((entries) => {
+      if (entries.some(entry => entry.isIntersecting)) {
+        observer.disconnect();
+        load();
+      }
+    }, { rootMargin: '200px' });
+    if (ref.current) observer.observe(ref.current);
+
+    return () => {
+      cancelled = true;
+      observer.disconnect();
+    };
+  }, [src, token]);
+
+  return (
+    <div ref={ref} className={`flex items-center justify-center overflow-hidden bg-zinc-100 rounded ${className}`}>
+      {url && !failed ? (
+        <img src={url} alt={alt} className="w-full h-full object-cover" />
+      ) : (
+        fallback
+      )}
+    </div>
+  );
+}
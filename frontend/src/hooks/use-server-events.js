@@ -0,0 +1,75 @@
+import { useEffect, useRef } from 'react';
+import axios from 'axios';
+import { useAuth } from '@/contexts/AuthContext';
+
+// Tipos de evento que publica GET /api/events
+const EVENT_TYPES = [
+  'document.created', 'document.status', 'document.updated', 'document.deleted', 'document.changed',
+  'batch.created', 'batch.status', 'batch.updated', 'batch.deleted', 'batch.changed',
+  'pdf.created', 'pdf.status', 'pdf.updated', 'pdf.deleted', 'pdf.changed',
+  'job.progress', 'resync',
+];
+
+const RECONNECT_DELAY_MS = 3000;
+
+// Suscripción a los eventos del servidor (SSE) de los temas indicados (documents, batches, pdfs, jobs).
+// onEvent(type, data) se llama por cada evento. EventSource no permite encabezados, así que cada
+// conexión usa un ticket de un solo uso (POST /events/ticket) en lugar del token de sesión; al
+// reconectar se pide otro ticket y se envía el último id recibido para recuperar los eventos perdidos.
+export function useServerEvents(topics, onEvent) {
+  const { token, API } = useAuth();
+  const handlerRef = useRef(onEvent);
+  handlerRef.current = onEvent;
+  const topicList = topics.join(',');
+
+  useEffect(() => {
+    if (!token) return undefined;
+
+    let source = null;
+    let closed = false;
+    let lastEventId = null;
+    let retryTimer = null;
+
+    const listener = (event) => {
+      if (event.lastEventId) lastEventId = event.lastEventId;
+      try {
+        handlerRef.current(event.type, JSON.parse(event.data));
+      } catch (error) {
+        console.error('Evento inválido:', error);
+      }
+    };
+
+    const reconnect = () => {
+      if (!closed) retryTimer = setTimeout(connect, RECONNECT_DELAY_MS);
+    };
+
+    const connect = async () => {
+      try {
+        const response = await axios.post(`${API}/events/ticket`, {}, {
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        if (closed) return;
+        const params = new URLSearchParams({ ticket: response.data.ticket, topics: topicList });
+        if (lastEventId) params.set('last_event_id', lastEventId);
+        source = new EventSource(`${API}/events?${params}`);
+        EVENT_TYPES.forEach(type => source.addEventListener(type, listener));
+        // El ticket ya se usó: la reconexión automática de EventSource fallaría, se reconecta con uno nuevo
+        source.onerror = () => {
+          source.close();
+          reconnect();
+        };
+      } catch (error) {
+        console.error('No se pudo conectar a los eventos del servidor:', error);
+        reconnect();
+      }
+    };
+
+    connect();
+
+    return () => {
+      closed = true;
+      clearTimeout(retryTimer);
+      if (source) source.close();
+    };
+  }, [token, API, topicList]);
+}
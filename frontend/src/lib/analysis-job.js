@@ -0,0 +1,46 @@
+import axios from 'axios';
+
+const POLL_INTERVAL_MS = 5000;
+const MAX_WAIT_MS = 15 * 60 * 1000;
+
+// Espera el fin de un análisis en segundo plano (POST /documents/analyze-all?background=true).
+// El evento job.progress final llega por /events y se entrega con waiterRef.current.resolve(data);
+// si ese evento se pierde (reconexión, cola llena) se consulta /documents/analyze-all/status
+// cada POLL_INTERVAL_MS, y tras MAX_WAIT_MS se deja de esperar con { timedOut: true }.
+export function waitForAnalysisJob(API, token, jobId, waiterRef) {
+  return new Promise(resolve => {
+    const startedAt = Date.now();
+    let timer = null;
+
+    const finish = (result) => {
+      clearTimeout(timer);
+      if (waiterRef.current?.jobId === jobId) {
+        waiterRef.current = null;
+        resolve(result);
+      }
+    };
+    waiterRef.current = { jobId, resolve: finish };
+
+    const poll = async () => {
+      if (waiterRef.current?.jobId !== jobId) return;
+      try {
+        const response = await axios.get(`${API}/documents/analyze-all/status`, {
+          headers: { Authorization: `Bearer ${token}` },
+          params: { job_id: jobId }
+        });
+        if (!response.data.running) {
+          finish({ ...response.data, done: true });
+          return;
+        }
+      } catch (error) {
+        console.error('Error consultando el análisis:', error);
+      }
+      if (Date.now() - startedAt >= MAX_WAIT_MS) {
+        finish({ job_id: jobId, done: true, timedOut: true });
+        return;
+      }
+      timer = setTimeout(poll, POLL_INTERVAL_MS);
+    };
+    timer = setTimeout(poll, POLL_INTERVAL_MS);
+  });
+}
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useAuth } from '@/contexts/AuthContext';
 import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
@@ -9,6 +9,8 @@ import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle, Di
 import { Checkbox } from '@/components/ui/checkbox';
 import { Progress } from '@/components/ui/progress';
 import { toast } from 'sonner';
+import { useServerEvents } from '@/hooks/use-server-events';
+import { waitForAnalysisJob } from '@/lib/analysis-job';
 import { FolderArchive, Download, Plus, FileText, Sparkles, Check, X, Loader2, Trash2, RefreshCw, Rocket } from 'lucide-react';
 
 const statusConfig = {
@@ -109,6 +111,28 @@ const Batches = () => {
     }
   };
 
+  // Trabajo de análisis en curso: se resuelve con el evento job.progress final de /events
+  // (o consultando su estado si el evento no llega)
+  const analysisWaiter = useRef(null);
+  const refreshTimer = useRef(null);
+
+  useServerEvents(['batches', 'pdfs', 'jobs'], (type, data) => {
+    if (type === 'job.progress' && data.kind === 'analyze' && analysisWaiter.current?.jobId === data.job_id) {
+      if (data.done) {
+        analysisWaiter.current.resolve(data);
+      } else {
+        toast.success(`+ Analizados: ${data.analyzed} (Restantes: ${data.remaining})`, { duration: 2000 });
+      }
+    } else if (type.startsWith('batch.') || type.startsWith('pdf.') || type === 'resync') {
+      // Los listados responden 304 si no cambiaron; se agrupan las ráfagas de eventos
+      clearTimeout(refreshTimer.current);
+      refreshTimer.current = setTimeout(() => {
+        fetchBatches();
+        fetchDocuments();
+      }, 1000);
+    }
+  });
+
   const reanalyzeAll = async () => {
     setReanalyzing(true);
     try {
@@ -123,50 +147,35 @@ const Batches = () => {
       // Documentos validados que necesitan análisis
       const needsAnalysis = allDocs.filter(doc => doc.status === 'validado');
       
-      // Paso 1.1: Validar documentos pendientes (por carpeta)
+      // Paso 1.1: Validar documentos pendientes (todas las carpetas en una sola llamada)
       if (needsValidation.length > 0) {
         toast.info(`Validando ${needsValidation.length} documentos pendientes...`);
-        const folders = [...new Set(needsValidation.map(d => d.tipo_documento))];
-        
-        for (const folder of folders) {
-          try {
-            await axios.post(`${API}/documents/validate-folder/${folder}`, {}, {
-              headers: { Authorization: `Bearer ${token}` }
-            });
-          } catch (error) {
-            console.error(`Error validating folder ${folder}:`, error);
-          }
+        try {
+          await axios.post(`${API}/documents/validate-bulk`, {}, {
+            headers: { Authorization: `Bearer ${token}` }
+          });
+        } catch (error) {
+          console.error('Error validating documents:', error);
         }
       }
       
-      // Paso 1.2: Analizar documentos validados (en lotes pequeños)
+      // Paso 1.2: Analizar documentos validados en segundo plano (progreso por /events)
       toast.info('Analizando documentos con IA...');
       let totalAnalyzed = 0;
-      let remaining = 1;
-      let iterations = 0;
-      const maxIterations = 50;
-      
-      while (remaining > 0 && iterations < maxIterations) {
-        iterations++;
-        try {
-          const response = await axios.post(`${API}/documents/analyze-all`, {}, {
-            headers: { Authorization: `Bearer ${token}` },
-            timeout: 120000
-          });
-          
-          totalAnalyzed += response.data.analyzed || 0;
-          remaining = response.data.remaining || 0;
-          
-          if (response.data.analyzed > 0) {
-            toast.success(`+${response.data.analyzed} analizados (Total: ${totalAnalyzed}, Restantes: ${remaining})`, { duration: 2000 });
+      try {
+        const response = await axios.post(`${API}/documents/analyze-all`, {}, {
+          headers: { Authorization: `Bearer ${token}` },
+          params: { background: true }
+        });
+        if (response.data.job_id) {
+          const result = await waitForAnalysisJob(API, token, response.data.job_id, analysisWaiter);
+          if (result.timedOut) {
+            toast.warning('El análisis sigue en curso; las sugerencias se actualizarán al terminar.');
           }
-          
-          if (response.data.analyzed === 0) break;
-          await new Promise(resolve => setTimeout(resolve, 500));
-        } catch (batchError) {
-          console.error('Error en lote de análisis:', batchError);
-          break;
+          totalAnalyzed = result.analyzed || 0;
         }
+      } catch (analysisError) {
+        console.error('Error en el análisis:', analysisError);
       }
       
       // Paso 2: Actualizar correlaciones
@@ -203,24 +212,64 @@ const Batches = () => {
     
     toast.info(`Iniciando creación de ${suggestions.length} lotes y PDFs...`);
 
+    // Paso 1: Crear los lotes
+    const batchIds = [];
     for (let i = 0; i < suggestions.length; i++) {
-      const suggestion = suggestions[i];
-      setCreatingAllProgress({ current: i + 1, total: suggestions.length });
-      
       try {
-        // Crear lote y generar PDF
-        await axios.post(
-          `${API}/batches/create-and-generate`,
-          suggestion.document_ids,
+        const response = await axios.post(
+          `${API}/batches/create`,
+          suggestions[i].document_ids,
           { headers: { Authorization: `Bearer ${token}` } }
         );
-        successCount++;
+        batchIds.push(response.data.id);
       } catch (error) {
         console.error(`Error en grupo ${i + 1}:`, error);
         errorCount++;
       }
     }
 
+    // Paso 2: Generar todos los PDFs en un solo trabajo masivo (progreso por lote como NDJSON)
+    if (batchIds.length > 0) {
+      try {
+        const response = await fetch(`${API}/batches/generate-pdf-bulk?stream=true`, {
+          method: 'POST',
+          headers: {
+            Authorization: `Bearer ${token}`,
+            'Content-Type': 'application/json'
+          },
+          body: JSON.stringify({ batch_ids: batchIds })
+        });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split('\n');
+          buffer = lines.pop();
+          for (const line of lines) {
+            if (!line.trim()) continue;
+            const event = JSON.parse(line);
+            if (event.batch_id) {
+              setCreatingAllProgress({ current: event.processed, total: event.total });
+              if (event.success) {
+                successCount++;
+              } else {
+                console.error(`Error generando PDF del lote ${event.batch_id}:`, event.error);
+                errorCount++;
+              }
+            }
+          }
+        }
+      } catch (error) {
+        console.error('Error en generación masiva de PDFs:', error);
+        errorCount += batchIds.length - successCount;
+      }
+    }
+
     setCreatingAll(false);
     setCreatingAllProgress({ current: 0, total: 0 });
     
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useAuth } from '@/contexts/AuthContext';
 import axios from 'axios';
 import { Button } from '@/components/ui/button';
@@ -6,8 +6,16 @@ import { Card, CardContent, CardHeader, CardTitle } from '@/components/ui/card';
 import { Badge } from '@/components/ui/badge';
 import { Dialog, DialogContent, DialogHeader, DialogTitle } from '@/components/ui/dialog';
 import { Progress } from '@/components/ui/progress';
+import Thumbnail from '@/components/Thumbnail';
+import { useServerEvents } from '@/hooks/use-server-events';
+import { waitForAnalysisJob } from '@/lib/analysis-job';
 import { toast } from 'sonner';
-import { FileText, Search, RefreshCw, Eye, CheckCircle, AlertTriangle, Loader2, Trash2, FolderOpen, Receipt, FileCheck, CreditCard, ShieldCheck, Sparkles } from 'lucide-react';
+import { FileText, Search, RefreshCw, Eye, CheckCircle, AlertTriangle, Loader2, Trash2, FolderOpen, Receipt, FileCheck, CreditCard, ShieldCheck, Sparkles, ChevronLeft, ChevronRight } from 'lucide-react';
+
+// PDFs de varias páginas por encima de este tamaño se ven página por página
+const PAGED_VIEW_MIN_BYTES = 5 * 1024 * 1024;
+// Máximo de ids por consulta a /documents/list (DOCUMENT_LIST_MAX_IDS en el servidor)
+const MAX_CHANGED_IDS = 100;
 
 // Configuración de colores por tipo de documento
 const folderConfig = {
@@ -74,6 +82,8 @@ const Documents = () => {
   const [viewingDoc, setViewingDoc] = useState(null);
   const [docUrl, setDocUrl] = useState(null);
   const [loadingDoc, setLoadingDoc] = useState(false);
+  const [viewerPage, setViewerPage] = useState(1);
+  const [viewerPageCount, setViewerPageCount] = useState(null);
 
   useEffect(() => {
     fetchDocuments();
@@ -92,6 +102,68 @@ const Documents = () => {
     }
   };
 
+  // Documentos cambiados según /events: se agrupan y se piden solo esas filas
+  const pendingIds = useRef(new Set());
+  const refreshTimer = useRef(null);
+  // Análisis en curso: se resuelve con el evento job.progress final (o consultando su estado)
+  const analysisJob = useRef(null);
+
+  const fetchChangedDocuments = async () => {
+    const ids = [...pendingIds.current];
+    pendingIds.current.clear();
+    refreshTimer.current = null;
+    // Con muchos cambios se recarga el listado completo (responde 304 si no cambió)
+    if (ids.includes('*') || ids.length > MAX_CHANGED_IDS) {
+      await fetchDocuments();
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/documents/list`, {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { ids: ids.join(',') }
+      });
+      const changed = new Map(response.data.documents.map(doc => [doc.id, doc]));
+      setDocuments(prev => {
+        const known = new Set(prev.map(doc => doc.id));
+        const updated = prev
+          .filter(doc => !ids.includes(doc.id) || changed.has(doc.id))
+          .map(doc => changed.get(doc.id) || doc);
+        return [...updated, ...response.data.documents.filter(doc => !known.has(doc.id))];
+      });
+    } catch (error) {
+      console.error('Error actualizando documentos:', error);
+    }
+  };
+
+  const scheduleRefresh = (ids) => {
+    (ids || ['*']).forEach(id => pendingIds.current.add(id));
+    if (!refreshTimer.current) {
+      refreshTimer.current = setTimeout(fetchChangedDocuments, 500);
+    }
+  };
+
+  useServerEvents(['documents', 'jobs'], (type, data) => {
+    if (type === 'job.progress' && data.job_id === analysisJob.current?.jobId) {
+      if (data.done) {
+        analysisJob.current.resolve(data);
+      } else {
+        toast.success(`+ Analizados: ${data.analyzed} (Restantes: ${data.remaining})`, { duration: 2000 });
+      }
+    } else if (type === 'resync' || type === 'document.changed') {
+      scheduleRefresh(null);
+    } else if (type === 'document.deleted' && data.ids) {
+      setDocuments(prev => prev.filter(doc => !data.ids.includes(doc.id)));
+    } else if (type === 'document.created') {
+      scheduleRefresh([data.id]);
+    } else if (type.startsWith('document.')) {
+      if (type === 'document.status' && data.ids) {
+        // El estado se muestra de inmediato; el resto de los campos llega con la recarga de esas filas
+        setDocuments(prev => prev.map(doc => data.ids.includes(doc.id) ? { ...doc, status: data.status } : doc));
+      }
+      scheduleRefresh(data.ids);
+    }
+  });
+
   // Validar un documento individual
   const validateDocument = async (docId) => {
     setValidating(prev => ({ ...prev, [docId]: true }));
@@ -134,59 +206,28 @@ const Documents = () => {
     }
   };
 
-  // Analizar todos los documentos validados con IA
+  // Analizar todos los documentos validados con IA: el servidor procesa en segundo plano
+  // y el progreso y los cambios de estado llegan por /events
   const analyzeAllWithAI = async () => {
     setAnalyzingAll(true);
     try {
-      toast.info('Iniciando análisis con IA (procesando de 5 en 5)...');
-      
-      let totalAnalyzed = 0;
-      let remaining = 1;
-      let iterations = 0;
-      const maxIterations = 50; // Máximo 250 documentos (50 * 5)
+      const response = await axios.post(`${API}/documents/analyze-all`, {}, {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { background: true }
+      });
       
-      // Procesar en lotes hasta que no queden más
-      while (remaining > 0 && iterations < maxIterations) {
-        iterations++;
-        try {
-          const response = await axios.post(`${API}/documents/analyze-all`, {}, {
-            headers: { Authorization: `Bearer ${token}` },
-            timeout: 120000 // 2 minutos de timeout
-          });
-          
-          totalAnalyzed += response.data.analyzed || 0;
-          remaining = response.data.remaining || 0;
-          
-          if (response.data.analyzed > 0) {
-            toast.success(`Lote ${iterations}: +${response.data.analyzed} analizados (Total: ${totalAnalyzed}, Restantes: ${remaining})`, { duration: 3000 });
-          }
-          
-          // Si no se analizó nada, salir del loop
-          if (response.data.analyzed === 0) {
-            break;
-          }
-          
-          // Pequeña pausa entre lotes
-          await new Promise(resolve => setTimeout(resolve, 1000));
-          
-        } catch (batchError) {
-          console.error('Error en lote:', batchError);
-          if (batchError.code === 'ECONNABORTED') {
-            toast.warning('El servidor tardó mucho. Reintentando...');
-            continue;
-          }
-          toast.error('Error al analizar. Intenta de nuevo.');
-          break;
-        }
+      if (!response.data.job_id) {
+        toast.info('No hay documentos pendientes de analizar');
+        return;
       }
-      
-      // Actualizar lista al final
-      await fetchDocuments();
-      
-      if (totalAnalyzed > 0) {
-        toast.success(`✅ ${totalAnalyzed} documentos analizados. Ve a Lotes para ver las correlaciones.`, { duration: 5000 });
+      toast.info(`Iniciando análisis con IA de ${response.data.remaining} documentos...`);
+      const result = await waitForAnalysisJob(API, token, response.data.job_id, analysisJob);
+      if (result.timedOut) {
+        toast.warning('El análisis sigue en curso en el servidor');
+      } else if (result.analyzed > 0) {
+        toast.success(`✅ ${result.analyzed} documentos analizados. Ve a Lotes para ver las correlaciones.`, { duration: 5000 });
       } else {
-        toast.info('No hay documentos pendientes de analizar');
+        toast.info('No se pudo analizar ningún documento');
       }
     } catch (error) {
       toast.error('Error al analizar documentos');
@@ -248,18 +289,34 @@ const Documents = () => {
     }
   };
 
+  const loadDocUrl = async (endpoint, type) => {
+    const response = await axios.get(endpoint, {
+      headers: { Authorization: `Bearer ${token}` },
+      responseType: 'blob'
+    });
+    const url = window.URL.createObjectURL(new Blob([response.data], { type }));
+    setDocUrl(prev => {
+      if (prev) window.URL.revokeObjectURL(prev);
+      return url;
+    });
+  };
+
   const viewDocument = async (doc) => {
     setViewingDoc(doc);
     setLoadingDoc(true);
     
+    // PDFs grandes de varias páginas: solo se descarga la página visible
+    const pageCount = doc.file_info?.page_count;
+    const paged = pageCount > 1 && doc.file_size > PAGED_VIEW_MIN_BYTES && !doc.mime_type?.includes('image');
+    setViewerPage(1);
+    setViewerPageCount(paged ? pageCount : null);
+    
     try {
-      const response = await axios.get(`${API}/documents/${doc.id}/view`, {
-        headers: { Authorization: `Bearer ${token}` },
-        responseType: 'blob'
-      });
-      
-      const url = window.URL.createObjectURL(new Blob([response.data], { type: doc.mime_type || 'application/pdf' }));
-      setDocUrl(url);
+      if (paged) {
+        await loadDocUrl(`${API}/documents/${doc.id}/pages/1`, 'application/pdf');
+      } else {
+        await loadDocUrl(`${API}/documents/${doc.id}/view`, doc.mime_type || 'application/pdf');
+      }
     } catch (error) {
       toast.error('Error al cargar documento');
       setViewingDoc(null);
@@ -268,12 +325,26 @@ const Documents = () => {
     }
   };
 
+  const goToViewerPage = async (page) => {
+    if (!viewingDoc || !viewerPageCount || page < 1 || page > viewerPageCount) return;
+    setLoadingDoc(true);
+    try {
+      await loadDocUrl(`${API}/documents/${viewingDoc.id}/pages/${page}`, 'application/pdf');
+      setViewerPage(page);
+    } catch (error) {
+      toast.error('Error al cargar la página');
+    } finally {
+      setLoadingDoc(false);
+    }
+  };
+
   const closeDocViewer = () => {
     if (docUrl) {
       window.URL.revokeObjectURL(docUrl);
     }
     setViewingDoc(null);
     setDocUrl(null);
+    setViewerPageCount(null);
   };
 
   // Agrupar documentos por tipo (excluir los que ya están en un lote)
@@ -478,7 +549,17 @@ const Documents = () => {
                       <div key={doc.id} className="p-3 hover:bg-zinc-50 transition-colors">
                         <div className="flex items-center justify-between gap-3">
                           <div className="flex items-center gap-3 min-w-0 flex-1">
-                            <FileText size={16} className="text-zinc-400 flex-shrink-0" />
+                            {doc.thumbnail_key ? (
+                              <Thumbnail
+                                src={`${API}/documents/${doc.id}/thumbnail?v=${doc.thumbnail_key}`}
+                                token={token}
+                                alt={doc.filename}
+                                className="w-8 h-10 flex-shrink-0"
+                                fallback={<FileText size={16} className="text-zinc-400" />}
+                              />
+                            ) : (
+                              <FileText size={16} className="text-zinc-400 flex-shrink-0" />
+                            )}
                             <div className="min-w-0">
                               <p className="text-sm font-medium text-zinc-800 truncate" title={doc.filename}>
                                 {doc.filename}
@@ -562,6 +643,29 @@ const Documents = () => {
                 {viewingDoc?.filename}
               </DialogTitle>
               <div className="flex items-center gap-2">
+                {viewerPageCount && (
+                  <div className="flex items-center gap-1">
+                    <Button
+                      size="sm"
+                      variant="outline"
+                      disabled={loadingDoc || viewerPage <= 1}
+                      onClick={() => goToViewerPage(viewerPage - 1)}
+                    >
+                      <ChevronLeft size={14} />
+                    </Button>
+                    <span className="text-xs text-zinc-600 px-1">
+                      Página {viewerPage} de {viewerPageCount}
+                    </span>
+                    <Button
+                      size="sm"
+                      variant="outline"
+                      disabled={loadingDoc || viewerPage >= viewerPageCount}
+                      onClick={() => goToViewerPage(viewerPage + 1)}
+                    >
+                      <ChevronRight size={14} />
+                    </Button>
+                  </div>
+                )}
                 {viewingDoc?.tercero && (
                   <Badge variant="outline">{viewingDoc.tercero}</Badge>
                 )}
@@ -5,6 +5,7 @@ import { Button } from '@/components/ui/button';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/components/ui/card';
 import { Badge } from '@/components/ui/badge';
 import { Dialog, DialogContent, DialogHeader, DialogTitle } from '@/components/ui/dialog';
+import Thumbnail from '@/components/Thumbnail';
 import { toast } from 'sonner';
 import { FileText, Download, Calendar, FolderArchive, Eye, Maximize2, Users, DollarSign, Loader2, Upload, RefreshCw, CheckCircle, AlertTriangle, Trash2 } from 'lucide-react';
 
@@ -59,7 +60,7 @@ const PDFs = () => {
         })
       ]);
 
-      const validPdfs = pdfsResponse.data.pdfs.filter(pdf => pdf.file_size > 1000);
+      const validPdfs = pdfsResponse.data.pdfs.filter(pdf => pdf.lazy || pdf.file_size > 1000);
       setPdfs(validPdfs);
       
       const batchMap = {};
@@ -340,8 +341,15 @@ const PDFs = () => {
             return (
               <Card key={pdf.id} className="border-zinc-200 hover:border-zinc-300 transition-all hover:shadow-md">
                 <CardHeader className="pb-3">
-                  <div className="flex items-start justify-between">
-                    <div className="flex-1">
+                  <div className="flex items-start justify-between gap-3">
+                    <Thumbnail
+                      src={`${API}/pdfs/${pdf.id}/thumbnail`}
+                      token={token}
+                      alt={pdf.filename}
+                      className="w-14 h-[72px] flex-shrink-0 border border-zinc-200"
+                      fallback={<FileText size={20} className="text-zinc-300" />}
+                    />
+                    <div className="flex-1 min-w-0">
                       <CardTitle className="text-lg flex items-center gap-2 mb-2">
                         <FileText size={20} className="text-emerald-600" />
                         <span className="truncate">{pdf.filename}</span>
@@ -352,7 +360,7 @@ const PDFs = () => {
                       </CardDescription>
                     </div>
                     <Badge className="bg-emerald-50 text-emerald-700 border-emerald-200">
-                      {formatFileSize(pdf.file_size)}
+                      {pdf.lazy && !pdf.file_size ? 'Se genera al descargar' : formatFileSize(pdf.file_size)}
                     </Badge>
                   </div>
                 </CardHeader>
@@ -519,6 +527,13 @@ const PDFs = () => {
                             </p>
                             <p className="text-xs text-zinc-500">
                               {typeLabels[doc.tipo_documento] || doc.tipo_documento}
+                              {doc.pdf_pages && (
+                                <span className="ml-1">
+                                  · {doc.pdf_pages.start === doc.pdf_pages.end
+                                    ? `pág. ${doc.pdf_pages.start}`
+                                    : `págs. ${doc.pdf_pages.start}-${doc.pdf_pages.end}`}
+                                </span>
+                              )}
                             </p>
                             {doc.valor && (
                               <p className="text-xs font-medium text-emerald-600 mt-1">
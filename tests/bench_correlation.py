@@ -0,0 +1,37 @@
+"""
+Benchmark de correlate_documents_basic y correlate_documents_clusters.
+
+Uso: python tests/bench_correlation.py
+La versión original (cuadrática) solo se mide hasta 10k documentos.
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from correlation import correlate_documents_basic, correlate_documents_clusters  # noqa: E402
+from correlation_fixtures import correlate_documents_legacy, make_documents  # noqa: E402
+
+LEGACY_MAX = 10_000
+
+
+def timed(fn, docs):
+    start = time.perf_counter()
+    result = fn(docs)
+    return time.perf_counter() - start, len(result)
+
+
+def main():
+    print(f"{'docs':>8} {'nuevo (s)':>10} {'grupos':>8} {'original (s)':>13} {'clusters (s)':>13} {'grupos':>8}")
+    for size in (1_000, 10_000, 100_000):
+        docs = make_documents(size, seed=42)
+        new_time, groups = timed(correlate_documents_basic, docs)
+        legacy = f"{timed(correlate_documents_legacy, docs)[0]:13.3f}" if size <= LEGACY_MAX else f"{'-':>13}"
+        cluster_time, clusters = timed(correlate_documents_clusters, docs)
+        print(f"{size:>8} {new_time:10.3f} {groups:>8} {legacy} {cluster_time:13.3f} {clusters:>8}")
+
+
+if __name__ == "__main__":
+    main()
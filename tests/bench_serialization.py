@@ -0,0 +1,84 @@
+"""
+Benchmark de serialización de /documents/list.
+
+Compara el camino anterior (documento completo, jsonable_encoder + json) con
+orjson sobre el documento completo y sobre la proyección de listado.
+
+Uso: python tests/bench_serialization.py
+"""
+import json
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import orjson  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+from correlation_fixtures import make_documents  # noqa: E402
+from projections import DOCUMENT_LIST_FIELDS, list_projection  # noqa: E402
+
+
+def full_document(doc):
+    """Documento como está en Mongo (sin file_data): análisis completo y claves de correlación."""
+    now = datetime.now(timezone.utc)
+    analysis = {
+        "tipo_documento": doc["tipo_documento"], "tercero": doc["tercero"], "nit": doc["nit"],
+        "valor": doc["valor"], "concepto": "Pago de servicios " * 8, "descripcion_pagina": "Factura electrónica " * 10,
+        "items": [{"descripcion": f"Item {i}", "valor": i * 1000} for i in range(10)],
+    }
+    return {
+        **doc, "status": "analizado", "mime_type": "application/pdf", "file_size": 250_000,
+        "uploaded_at": now.isoformat(), "created_at": now, "fecha": "2025-01-15", "fecha_dt": now,
+        "concepto": analysis["concepto"], "analisis_completo": analysis,
+        "tercero_tokens": doc["tercero"].split(), "tercero_trigrams": [doc["tercero"][i:i + 3] for i in range(len(doc["tercero"]))],
+        "file_info": {"sha256": "0" * 64, "page_count": 1, "width": 612, "height": 792, "version": 1},
+    }
+
+
+def project(doc, projection):
+    """Aplica en memoria una proyección de inclusión (como lo haría Mongo)."""
+    result = {}
+    for path in projection:
+        if path == "_id":
+            continue
+        head, _, tail = path.partition(".")
+        if head not in doc:
+            continue
+        if tail:
+            result.setdefault(head, {})[tail] = doc[head].get(tail)
+        else:
+            result[head] = doc[head]
+    return result
+
+
+def timed(fn, payload, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = len(fn(payload))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    docs = [full_document(doc) for doc in make_documents(10_000, seed=42)]
+    lean = [project(doc, list_projection(DOCUMENT_LIST_FIELDS)) for doc in docs]
+
+    cases = [
+        ("completo, jsonable_encoder + json", lambda p: json.dumps(jsonable_encoder(p)).encode(), docs),
+        ("completo, orjson", orjson.dumps, docs),
+        ("proyección de listado, orjson", orjson.dumps, lean),
+    ]
+    print(f"{'10k documentos':<36} {'tiempo (s)':>10} {'bytes':>12}")
+    for name, fn, payload in cases:
+        elapsed, size = timed(fn, {"documents": payload})
+        print(f"{name:<36} {elapsed:10.3f} {size:>12,}")
+
+
+if __name__ == "__main__":
+    main()
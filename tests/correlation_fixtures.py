@@ -0,0 +1,139 @@
+"""Generador de documentos sintéticos y versión original (cuadrática) de la correlación básica."""
+import random
+import uuid
+from typing import Dict, List
+
+TIPOS = ["comprobante_egreso", "cuenta_por_pagar", "factura", "soporte_pago"]
+PALABRAS = [
+    "AVIANCA", "HOTELBEDS", "MOVISTAR", "COLOMBIA", "TELECOMUNICACIONES", "ASSIST",
+    "UNO", "TRAVEL", "CIC", "COLOMBIANA", "ASISTENCIA", "BEDS", "ONLINE", "GRUPO",
+    "AEROVIAS", "NACIONAL", "SEGUROS", "BOLIVAR", "DE", "LA",
+]
+
+
+def make_documents(n: int, seed: int = 0) -> List[Dict]:
+    rng = random.Random(seed)
+    nits = [str(rng.randint(800000000, 999999999)) for _ in range(max(1, n // 3))]
+    valores = [round(rng.uniform(10_000, 50_000_000), -2) for _ in range(max(1, n // 2))]
+    docs = []
+    for _ in range(n):
+        valor = rng.choice(valores) * rng.uniform(0.96, 1.04) if rng.random() < 0.8 else rng.choice([None, 0])
+        nit = rng.choice(nits) if rng.random() < 0.5 else rng.choice(["", "123", f"{rng.randint(100, 999)}.{rng.randint(100, 999)}.{rng.randint(100, 999)}-1"])
+        docs.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "filename": "doc.pdf",
+            "tipo_documento": rng.choice(TIPOS),
+            "valor": round(valor, 2) if valor else valor,
+            "nit": nit,
+            "tercero": " ".join(rng.sample(PALABRAS, rng.randint(1, 3))) if rng.random() < 0.9 else "",
+        })
+    return docs
+
+
+def correlate_documents_legacy(documents: List[Dict]) -> List[Dict]:
+    """Implementación original O(n²) usada como referencia de equivalencia."""
+    if not documents:
+        return []
+
+    correlations = []
+    processed_ids = set()
+
+    by_nit = {}
+    for doc in documents:
+        nit = doc.get('nit', '').replace('-', '').replace('.', '').strip()
+        if nit and len(nit) >= 6:
+            by_nit.setdefault(nit, []).append(doc)
+
+    for nit, docs_nit in by_nit.items():
+        if len(docs_nit) >= 2:
+            sub_by_valor = {}
+            for doc in docs_nit:
+                if doc['id'] in processed_ids:
+                    continue
+                valor = doc.get('valor', 0)
+                valor_key = round(valor, -2) if valor else 0
+                sub_by_valor.setdefault(valor_key, []).append(doc)
+
+            for valor_key, grupo in sub_by_valor.items():
+                if len(grupo) >= 2:
+                    for d in grupo:
+                        processed_ids.add(d['id'])
+                    correlations.append({
+                        "tercero": grupo[0].get('tercero', ''),
+                        "nit": nit,
+                        "valor": valor_key,
+                        "num_documentos": len(grupo),
+                        "tipos_documentos": list(set(d.get('tipo_documento', '') for d in grupo)),
+                        "document_ids": [d['id'] for d in grupo],
+                        "tipo_correlacion": "mismo_nit",
+                        "confianza": "alta",
+                        "razon_correlacion": f"Mismo NIT: {nit}"
+                    })
+
+    for doc in documents:
+        if doc['id'] in processed_ids:
+            continue
+        valor = doc.get('valor')
+        tercero = doc.get('tercero', '').upper()
+        if not valor:
+            continue
+        matching = [doc]
+        for other in documents:
+            if other['id'] == doc['id'] or other['id'] in processed_ids:
+                continue
+            other_valor = other.get('valor')
+            if not other_valor:
+                continue
+            if abs(valor - other_valor) / valor <= 0.05:
+                matching.append(other)
+                processed_ids.add(other['id'])
+        if len(matching) >= 2:
+            processed_ids.add(doc['id'])
+            correlations.append({
+                "tercero": tercero,
+                "nit": doc.get('nit', ''),
+                "valor": valor,
+                "num_documentos": len(matching),
+                "tipos_documentos": list(set(d.get('tipo_documento', '') for d in matching)),
+                "document_ids": [d['id'] for d in matching],
+                "tipo_correlacion": "valor_exacto",
+                "confianza": "alta" if len(matching) >= 3 else "media",
+                "razon_correlacion": f"Valor similar: ${valor:,.2f}"
+            })
+
+    remaining = [d for d in documents if d['id'] not in processed_ids and d.get('tercero')]
+    for doc in remaining:
+        if doc['id'] in processed_ids:
+            continue
+        tercero = doc.get('tercero', '').upper()
+        tercero_words = set(w for w in tercero.split() if len(w) > 3)
+        if not tercero_words:
+            continue
+        matching = [doc]
+        for other in remaining:
+            if other['id'] == doc['id'] or other['id'] in processed_ids:
+                continue
+            other_words = set(w for w in other.get('tercero', '').upper().split() if len(w) > 3)
+            if len(tercero_words & other_words) >= 1:
+                matching.append(other)
+                processed_ids.add(other['id'])
+        if len(matching) >= 2:
+            processed_ids.add(doc['id'])
+            correlations.append({
+                "tercero": tercero,
+                "nit": doc.get('nit', ''),
+                "valor": doc.get('valor', 0),
+                "num_documentos": len(matching),
+                "tipos_documentos": list(set(d.get('tipo_documento', '') for d in matching)),
+                "document_ids": [d['id'] for d in matching],
+                "tipo_correlacion": "mismo_tercero",
+                "confianza": "media",
+                "razon_correlacion": f"Tercero similar: {tercero[:30]}"
+            })
+
+    return correlations
+
+
+def canonical(correlations: List[Dict]) -> List[Dict]:
+    """El orden de tipos_documentos depende del hash de strings; se compara ordenado."""
+    return [{**c, "tipos_documentos": sorted(c["tipos_documentos"])} for c in correlations]
@@ -0,0 +1,68 @@
+import asyncio
+import gzip
+
+import compression
+
+
+def make_app(body: bytes, content_type: bytes = b"application/json", chunks: int = 1):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]})
+        step = len(body) // chunks
+        for i in range(chunks):
+            last = i == chunks - 1
+            await send({"type": "http.response.body", "body": body[i * step:None if last else (i + 1) * step], "more_body": not last})
+    return app
+
+
+def call(app, path="/api/documents/list", accept=b"gzip, deflate"):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def receive():
+        return {"type": "http.request"}
+
+    scope = {"type": "http", "path": path, "headers": [(b"accept-encoding", accept)]}
+    asyncio.run(compression.CompressionMiddleware(app)(scope, receive, send))
+    headers = dict(messages[0]["headers"])
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return headers, body
+
+
+def test_large_json_is_gzipped_and_recorded():
+    payload = b'{"documents": [' + b'{"id": "abc", "status": "analizado"},' * 500 + b'{}]}'
+    before = compression.compression_metrics()["encodings"].get("gzip", {}).get("responses", 0)
+
+    headers, body = call(make_app(payload))
+
+    assert headers[b"content-encoding"] == b"gzip"
+    assert headers[b"vary"] == b"Accept-Encoding"
+    assert int(headers[b"content-length"]) == len(body)
+    assert gzip.decompress(body) == payload
+    stats = compression.compression_metrics()["encodings"]["gzip"]
+    assert stats["responses"] == before + 1
+    assert stats["ratio"] > 5
+
+
+def test_small_binary_streaming_and_unaccepted_responses_pass_through():
+    payload = b"x" * 5000
+    cases = [
+        (make_app(b'{"ok": true}'), "/api/documents/list", b"gzip"),
+        (make_app(payload, b"application/pdf"), "/api/batches/list", b"gzip"),
+        (make_app(payload), "/api/pdfs/abc/download", b"gzip"),
+        (make_app(payload), "/api/documents/abc/pages/3", b"gzip"),
+        (make_app(payload, b"application/x-ndjson", chunks=3), "/api/batches/generate-pdf-bulk", b"gzip"),
+        (make_app(payload), "/api/documents/list", b"gzip;q=0, identity"),
+    ]
+    for app, path, accept in cases:
+        headers, body = call(app, path, accept)
+        assert b"content-encoding" not in headers
+        assert body in (payload, b'{"ok": true}')
+
+
+def test_negotiate_encoding():
+    assert compression.negotiate_encoding("gzip, deflate") == "gzip"
+    assert compression.negotiate_encoding("identity") is None
+    assert compression.negotiate_encoding("br, gzip") == ("br" if compression.brotli else "gzip")
@@ -0,0 +1,177 @@
+import random
+
+import pytest
+
+from correlation import (
+    VENTANA_VALOR_LIMITES,
+    candidate_ids_from_groups,
+    correlate_documents_basic,
+    correlate_documents_clusters,
+    correlation_candidates_pipeline,
+    correlation_keys,
+    find_subset_sum,
+    find_suma_facturas_groups,
+    tercero_index_fields,
+    tercero_tokens,
+)
+from .correlation_fixtures import canonical, correlate_documents_legacy, make_documents
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 10, 150, 1000])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_basic_matches_legacy_groups(size, seed):
+    docs = make_documents(size, seed)
+    assert canonical(correlate_documents_basic(docs, sumas=False)) == canonical(correlate_documents_legacy(docs))
+
+
+def test_valor_tolerance_is_asymmetric_like_legacy():
+    # 100 no alcanza a 105.2 (5.2%), pero 105.2 sí alcanza a 100 (4.94%)
+    docs = [
+        {"id": "a", "tipo_documento": "factura", "valor": 100.0, "nit": "", "tercero": ""},
+        {"id": "b", "tipo_documento": "factura", "valor": 105.2, "nit": "", "tercero": ""},
+    ]
+    assert canonical(correlate_documents_basic(docs, sumas=False)) == canonical(correlate_documents_legacy(docs))
+    assert correlate_documents_basic(docs, sumas=False)[0]["document_ids"] == ["b", "a"]
+
+
+def test_negative_valor_matches_everything_like_legacy():
+    docs = [
+        {"id": "a", "tipo_documento": "factura", "valor": 500.0, "nit": "", "tercero": ""},
+        {"id": "b", "tipo_documento": "factura", "valor": -10.0, "nit": "", "tercero": ""},
+        {"id": "c", "tipo_documento": "factura", "valor": 9000.0, "nit": "", "tercero": ""},
+    ]
+    assert canonical(correlate_documents_basic(docs, sumas=False)) == canonical(correlate_documents_legacy(docs))
+
+
+def test_tercero_tokens_skip_company_suffixes():
+    assert tercero_tokens("Hotelbeds S.A.S.") == {"HOTELBEDS"}
+    assert tercero_tokens("ASSIST UNO LTDA.") == {"ASSIST"}
+    assert tercero_tokens("AVIANCA S.A.") == {"AVIANCA"}
+    assert tercero_tokens(None) == frozenset()
+
+
+def test_tercero_index_fields():
+    fields = tercero_index_fields("  cic   travel sas ")
+    assert fields["tercero_norm"] == "CIC TRAVEL SAS"
+    assert fields["tercero_tokens"] == ["TRAVEL"]
+    assert "TRA" in fields["tercero_trigrams"] and "C T" in fields["tercero_trigrams"]
+    assert tercero_index_fields(None) == {"tercero_norm": None, "tercero_tokens": [], "tercero_trigrams": []}
+
+
+def test_company_suffix_alone_does_not_group_terceros():
+    docs = [
+        {"id": "a", "tipo_documento": "factura", "valor": None, "nit": "", "tercero": "MOVISTAR LTDA"},
+        {"id": "b", "tipo_documento": "factura", "valor": None, "nit": "", "tercero": "AVIANCA LTDA"},
+        {"id": "c", "tipo_documento": "soporte_pago", "valor": None, "nit": "", "tercero": "MOVISTAR"},
+    ]
+    groups = correlate_documents_basic(docs)
+    assert [g["document_ids"] for g in groups] == [["a", "c"]]
+
+
+def test_find_subset_sum_prefers_smallest_subset():
+    valores = [78_894, 45_655, 68_459, 12_000, 193_000 - 50_000, 50_000]
+    assert find_subset_sum(valores, 193_000) == [4, 5]
+    assert find_subset_sum([10, 20, 30], 1_000) is None
+
+
+def test_find_subset_sum_respects_size_limit():
+    assert find_subset_sum([1.0] * 10, 8.0, max_size=6) is None
+    assert len(find_subset_sum([1.0] * 10, 6.0, max_size=6)) == 6
+
+
+def test_suma_facturas_groups_payment_with_invoices():
+    docs = [
+        {"id": "ce", "tipo_documento": "comprobante_egreso", "valor": 193_000.0, "nit": "901244056-1", "tercero": "ASSIST UNO"},
+        {"id": "cxp", "tipo_documento": "cuenta_por_pagar", "valor": 193_000.0, "nit": "901.244.056-1", "tercero": "ASSIST UNO"},
+        {"id": "f1", "tipo_documento": "factura", "valor": 78_894.0, "nit": "9012440561", "tercero": "ASSIST UNO"},
+        {"id": "f2", "tipo_documento": "factura", "valor": 45_655.0, "nit": "9012440561", "tercero": "ASSIST UNO"},
+        {"id": "f3", "tipo_documento": "factura", "valor": 68_459.0, "nit": "9012440561", "tercero": "ASSIST UNO"},
+        {"id": "otro", "tipo_documento": "factura", "valor": 68_459.0, "nit": "800123456", "tercero": "AVIANCA"},
+    ]
+    groups = find_suma_facturas_groups(docs)
+    assert len(groups) == 1
+    assert groups[0]["tipo_correlacion"] == "suma_facturas"
+    assert groups[0]["document_ids"] == ["ce", "cxp", "f1", "f2", "f3"]
+
+    basic = correlate_documents_basic(docs)
+    assert basic[0]["document_ids"] == ["ce", "cxp", "f1", "f2", "f3"]
+
+
+def test_clusters_do_not_depend_on_input_order():
+    docs = make_documents(500, seed=7)
+    shuffled = docs[:]
+    random.Random(3).shuffle(shuffled)
+    expected = {frozenset(g["document_ids"]) for g in correlate_documents_clusters(docs)}
+    assert expected == {frozenset(g["document_ids"]) for g in correlate_documents_clusters(shuffled)}
+
+
+def test_clusters_combine_criteria_and_cap_size():
+    docs = [
+        {"id": "ce", "tipo_documento": "comprobante_egreso", "valor": 1_000_000.0, "nit": "890903407", "tercero": "AVIANCA S.A.", "fecha": "2025-03-01"},
+        {"id": "cxp", "tipo_documento": "cuenta_por_pagar", "valor": 1_004_000.0, "nit": "890903407", "tercero": "AVIANCA", "fecha": "2025-03-02"},
+        {"id": "sp", "tipo_documento": "soporte_pago", "valor": 1_000_000.0, "tercero": "AVIANCA", "referencia_bancaria": "REF-99881"},
+        {"id": "sp2", "tipo_documento": "soporte_pago", "valor": 3_000.0, "referencia_bancaria": "ref 99881"},
+        {"id": "solo", "tipo_documento": "factura", "valor": 1_020_000.0, "tercero": "MOVISTAR"},
+    ]
+    groups = correlate_documents_clusters(docs)
+    assert [sorted(g["document_ids"]) for g in groups] == [["ce", "cxp", "sp", "sp2"]]
+    assert groups[0]["tipo_correlacion"] == "mismo_nit"
+    assert groups[0]["nit"] == "890903407"
+
+    same_nit = [
+        {"id": f"d{i}", "tipo_documento": "factura", "valor": 5_000.0, "nit": "800123456", "tercero": "GRUPO"}
+        for i in range(20)
+    ]
+    sizes = [g["num_documentos"] for g in correlate_documents_clusters(same_nit, max_cluster=8)]
+    assert sizes == [8, 8, 4]
+
+
+def test_correlation_keys_only_cover_written_fields():
+    keys = correlation_keys({"nit": "890.903.407-1", "valor": 193_049.5, "fecha": "2025-03-01T10:00"})
+    assert keys["nit_norm"] == "8909034071"
+    assert keys["valor_bucket"] == 193_000.0
+    assert keys["fecha_dt"].isoformat() == "2025-03-01T00:00:00+00:00"
+    assert "tercero_tokens" not in keys
+    assert correlation_keys({"nit": None, "valor": None, "fecha": "sin fecha"}) == {
+        "nit_norm": None, "valor_bucket": None, "fecha_dt": None
+    }
+
+
+def test_precomputed_keys_give_same_groups():
+    docs = make_documents(300, seed=5)
+    with_keys = [{**d, **correlation_keys(d)} for d in docs]
+    assert canonical(correlate_documents_basic(with_keys)) == canonical(correlate_documents_basic(docs))
+    assert canonical(correlate_documents_clusters(with_keys)) == canonical(correlate_documents_clusters(docs))
+
+
+def test_candidates_pipeline_streams_one_document_per_group():
+    match = {"status": "validado"}
+    pipeline = correlation_candidates_pipeline(match)
+    branches = [stage["$unionWith"]["pipeline"] for stage in pipeline if "$unionWith" in stage]
+    branches.insert(0, [stage for stage in pipeline if "$unionWith" not in stage])
+
+    # Sin $facet: ningún documento del cursor junta los ids de todos los grupos
+    assert not any("$facet" in stage for branch in branches for stage in branch)
+    assert [branch[-1]["$project"]["criterio"] for branch in branches] == [
+        "por_nit_valor", "por_bloque", "por_referencia", "por_numero", "por_valor"
+    ]
+    assert all(branch[0] == {"$match": match} for branch in branches)
+    # Las ventanas de valor se filtran en el servidor (2+ documentos en la ventana o en un par contiguo)
+    assert {"$match": {"ids.1": {"$exists": True}}} in branches[-1]
+
+
+def test_candidate_ids_from_groups():
+    groups = [
+        {"criterio": "por_nit_valor", "ids": ["a", "b"]},
+        {"criterio": "por_valor", "ids": ["b", "c"]},
+    ]
+    assert candidate_ids_from_groups(groups) == {"a", "b", "c"}
+
+
+def test_values_within_tolerance_share_or_touch_a_window():
+    from bisect import bisect_right
+    for valor in (1_000.0, 193_000.0, 48_750_000.0):
+        for otro in (valor * 0.95, valor * 1.05):
+            a = bisect_right(VENTANA_VALOR_LIMITES, valor)
+            b = bisect_right(VENTANA_VALOR_LIMITES, otro)
+            assert abs(a - b) <= 1
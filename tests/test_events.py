@@ -0,0 +1,123 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import events
+
+
+def test_events_from_write_commands():
+    insert = {"insert": "documents", "documents": [{"id": "a", "filename": "a.pdf", "status": "cargado", "file_data": b"x"}]}
+    assert list(events.events_from_command("insert", insert)) == [
+        ("document.created", {"id": "a", "filename": "a.pdf", "status": "cargado"})
+    ]
+
+    update = {"update": "documents", "updates": [
+        {"q": {"id": "a"}, "u": {"$set": {"status": "analizado", "tercero": "X"}}},
+        {"q": {"id": {"$in": ["b", "c"]}}, "u": {"$unset": {"batch_id": ""}}},
+        {"q": {"status": "validado"}, "u": {"$set": {"valor": 1}}},
+    ]}
+    assert list(events.events_from_command("update", update)) == [
+        ("document.status", {"ids": ["a"], "fields": ["status", "tercero"], "status": "analizado"}),
+        ("document.updated", {"ids": ["b", "c"], "fields": ["batch_id"]}),
+        ("document.changed", {"ids": None, "fields": ["valor"]}),
+    ]
+
+    delete = {"delete": "consolidated_pdfs", "deletes": [{"q": {"id": "p"}}]}
+    assert list(events.events_from_command("delete", delete)) == [("pdf.deleted", {"ids": ["p"]})]
+    assert list(events.events_from_command("insert", {"insert": "audit_logs", "documents": [{}]})) == []
+
+
+def make_event(event_id, event_type, data):
+    return {"id": event_id, "type": event_type, "data": data}
+
+
+def test_bus_replays_missed_events_and_formats_sse():
+    async def run():
+        bus = events.EventBus()
+        bus.deliver(make_event(1, "document.status", {"ids": ["a"], "status": "validado"}))
+        bus.deliver(make_event(2, "job.progress", {"job_id": "j", "analyzed": 3}))
+
+        live = bus.subscribe()
+        replay = bus.subscribe(last_event_id=1)
+        bus.deliver(make_event(3, "pdf.created", {"id": "p"}))
+
+        assert (await live.get())["type"] == "pdf.created"
+        assert [(await replay.get())["id"] for _ in range(2)] == [2, 3]
+        bus.unsubscribe(live)
+        assert bus.subscriber_count == 1
+
+    asyncio.run(run())
+    assert events.format_sse({"id": 4, "type": "pdf.created", "data": {"id": "p"}}) == \
+        'id: 4\nevent: pdf.created\ndata: {"id": "p"}\n\n'
+
+
+def test_bus_ignores_events_already_delivered():
+    async def run():
+        bus = events.EventBus()
+        queue = bus.subscribe()
+        # El relay relee un margen del registro al reabrir el cursor
+        for event_id in (1, 2, 1, 2, 3):
+            bus.deliver(make_event(event_id, "document.created", {"id": str(event_id)}))
+        return [queue.get_nowait()["id"] for _ in range(queue.qsize())]
+
+    assert asyncio.run(run()) == [1, 2, 3]
+
+
+def test_full_queue_gets_resync_without_blocking_other_subscribers(monkeypatch):
+    monkeypatch.setattr(events, "EVENT_QUEUE_SIZE", 2)
+
+    async def run():
+        bus = events.EventBus()
+        slow = bus.subscribe()
+        bus.deliver(make_event(1, "document.created", {"id": "a"}))
+        bus.deliver(make_event(2, "document.created", {"id": "b"}))
+        fast = bus.subscribe()
+
+        bus.deliver(make_event(3, "document.created", {"id": "c"}))
+
+        assert slow.qsize() == 1
+        assert (await slow.get())["type"] == "resync"
+        assert (await fast.get())["data"] == {"id": "c"}
+
+    asyncio.run(run())
+
+
+class FakeLogDb:
+    """counters y events en memoria: lo que usa EventLog.append."""
+    def __init__(self):
+        self.seq = 0
+        self.logged = []
+        self.counters = SimpleNamespace(find_one_and_update=self._increment)
+
+    def _increment(self, query, update, **kwargs):
+        self.seq += update["$inc"]["seq"]
+        return {"_id": query["_id"], "seq": self.seq}
+
+    def __getitem__(self, name):
+        assert name == events.EVENT_LOG_COLLECTION
+        return SimpleNamespace(insert_many=self.logged.extend)
+
+
+def test_event_log_assigns_consecutive_ids_across_appends():
+    db = FakeLogDb()
+    log = events.EventLog(db)
+    log.append([("document.created", {"id": "a"}), ("batch.status", {"ids": ["l"], "status": "terminado"})])
+    log.append([("job.progress", {"job_id": "j"})])
+    log.append([])
+
+    assert [(doc["_id"], doc["type"]) for doc in db.logged] == [
+        (1, "document.created"), (2, "batch.status"), (3, "job.progress")
+    ]
+
+
+def test_topics_filter_events_and_always_pass_resync():
+    topics = events.parse_topics("documents, jobs")
+    assert events.event_in_topics({"type": "document.status"}, topics)
+    assert events.event_in_topics({"type": "job.progress"}, topics)
+    assert events.event_in_topics({"type": "resync"}, topics)
+    assert not events.event_in_topics({"type": "batch.updated"}, topics)
+
+    assert events.parse_topics(None) == frozenset(events.EVENT_TOPICS)
+    with pytest.raises(ValueError):
+        events.parse_topics("documents,usuarios")
@@ -0,0 +1,226 @@
+import asyncio
+import io
+import time
+
+import pytest
+from PIL import Image
+from PyPDF2 import PdfWriter
+
+import pdf_ops
+import workers
+
+
+def make_pdf(pages: int) -> bytes:
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=100, height=100)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def make_png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def write_pdf(writer: PdfWriter) -> bytes:
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def build_pdf(sources) -> bytes:
+    """PDF con las fuentes (mime_type, file_data[, page_number]) agregadas con add_source_pages."""
+    writer = PdfWriter()
+    readers = pdf_ops.ReaderCache()
+    for mime_type, file_data, *page in sources:
+        pdf_ops.add_source_pages(writer, readers, mime_type, file_data, page[0] if page else None)
+    return write_pdf(writer)
+
+
+def image_pdf(file_data: bytes) -> bytes:
+    writer = PdfWriter()
+    pdf_ops.add_image_page(writer, file_data)
+    return write_pdf(writer)
+
+
+def test_split_and_count_pages():
+    pdf = make_pdf(3)
+    assert pdf_ops.count_pages(pdf) == 3
+    pages = pdf_ops.split_pdf_to_pages(pdf)
+    assert [pdf_ops.count_pages(page) for page in pages] == [1, 1, 1]
+
+
+def test_add_source_pages_counts_pages_and_rejects_unreadable_sources():
+    writer = PdfWriter()
+    readers = pdf_ops.ReaderCache()
+    assert pdf_ops.add_source_pages(writer, readers, "application/pdf", make_pdf(2)) == 2
+    assert pdf_ops.add_source_pages(writer, readers, "image/png", make_png()) == 1
+    assert pdf_ops.add_source_pages(writer, readers, "text/plain", b"texto") == 0
+    with pytest.raises(Exception):
+        pdf_ops.add_source_pages(writer, readers, "application/pdf", b"no es un pdf")
+    assert pdf_ops.count_pages(write_pdf(writer)) == 3
+
+
+def test_run_in_pool_records_metrics():
+    async def run():
+        try:
+            return await workers.run_in_pool(pdf_ops.count_pages, make_pdf(2))
+        finally:
+            workers.shutdown_pool()
+
+    assert asyncio.run(run()) == 2
+    stats = workers.pool_metrics()["tasks"]["count_pages"]
+    assert stats["count"] >= 1
+    assert stats["latency_p50"] is not None
+
+
+def test_pool_timeout_counts_only_execution(monkeypatch):
+    monkeypatch.setattr(workers, "PDF_WORKERS", 1)
+
+    async def run():
+        try:
+            await workers.warm_pool()
+            # Con un solo worker la segunda tarea espera a la primera; esa espera no cuenta para el tiempo máximo
+            return await asyncio.gather(*(workers.run_in_pool(time.sleep, 0.6, timeout=1.0) for _ in range(2)))
+        finally:
+            workers.shutdown_pool()
+
+    assert asyncio.run(run()) == [None, None]
+
+
+def test_stale_failure_does_not_recycle_current_pool(monkeypatch):
+    current, stale = object(), object()
+    monkeypatch.setattr(workers, "_executor", current)
+    workers._recycle_pool(stale)
+    assert workers._executor is current
+
+
+def test_virtual_pages_copy_from_parent_reader():
+    parent = make_pdf(4)
+    page = pdf_ops.extract_page(parent, 3)
+    assert pdf_ops.count_pages(page) == 1
+
+    merged = build_pdf([
+        ("application/pdf", parent, 2),
+        ("application/pdf", parent, 4),
+        ("image/png", make_png()),
+    ])
+    assert pdf_ops.count_pages(merged) == 3
+
+
+def test_extract_file_metadata():
+    pdf = make_pdf(3)
+    info = pdf_ops.extract_file_metadata(pdf, "a.pdf", "application/pdf")
+    assert info["page_count"] == 3
+    assert (info["width"], info["height"]) == (100, 100)
+    assert info["has_text_layer"] is False
+    assert info["encrypted"] is False
+    assert info["validation_error"] is None
+    assert len(info["sha256"]) == 64
+
+    image = pdf_ops.extract_file_metadata(make_png(), "b.png", "image/png")
+    assert (image["page_count"], image["width"], image["height"]) == (1, 40, 30)
+
+    broken = pdf_ops.extract_file_metadata(b"no es un pdf", "c.pdf", "application/pdf")
+    assert broken["validation_error"].startswith("PDF inválido")
+    assert broken["page_count"] is None
+
+
+def make_jpeg(size, dpi=None, orientation=None, mode="RGB") -> bytes:
+    img = Image.new(mode, size, 128)
+    exif = img.getexif()
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    options = {"dpi": (dpi, dpi)} if dpi else {}
+    img.save(buffer, format="JPEG", quality=90, exif=exif, **options)
+    return buffer.getvalue()
+
+
+def test_jpeg_is_embedded_without_reencoding():
+    jpeg = make_jpeg((1600, 1200), dpi=150, orientation=6)
+    page = pdf_ops.PdfReader(io.BytesIO(image_pdf(jpeg))).pages[0]
+
+    image = page["/Resources"]["/XObject"]["/Im0"].get_object()
+    assert image["/Filter"] == "/DCTDecode"
+    assert image._data == jpeg
+    assert page["/Rotate"] == 90
+    assert [float(v) for v in page.mediabox[2:]] == [768, 576]
+
+
+def test_oversized_scan_is_downsampled_to_target_dpi():
+    scan = make_jpeg((2400, 3000), dpi=600, mode="L")
+    page = pdf_ops.PdfReader(io.BytesIO(image_pdf(scan))).pages[0]
+
+    image = page["/Resources"]["/XObject"]["/Im0"].get_object()
+    factor = pdf_ops.IMAGE_TARGET_DPI / 600
+    assert (image["/Width"], image["/Height"]) == (round(2400 * factor), round(3000 * factor))
+    assert image["/ColorSpace"] == "/DeviceGray"
+    # El tamaño físico de la página no cambia
+    assert [float(v) for v in page.mediabox[2:]] == [288, 360]
+
+
+def test_optimize_pdf_writer_deduplicates_shared_images():
+    single = image_pdf(make_jpeg((800, 600)))
+    # Copias distintas del mismo archivo, como tres documentos con el mismo logo
+    copies = [bytes(bytearray(single)) for _ in range(3)]
+    writer = PdfWriter()
+    readers = pdf_ops.ReaderCache()
+    for data in copies:
+        pdf_ops.add_source_pages(writer, readers, "application/pdf", data)
+
+    before = write_pdf(writer)
+    optimized, removed = pdf_ops.optimize_pdf_writer(writer)
+    after = write_pdf(optimized)
+
+    assert removed == 2
+    assert len(after) < len(before) / 2
+    reader = pdf_ops.PdfReader(io.BytesIO(after))
+    assert [len(page.images) for page in reader.pages] == [1, 1, 1]
+
+
+def test_optimized_pdf_opens_and_renders_every_page():
+    logo = make_jpeg((400, 300))
+    writer = PdfWriter()
+    readers = pdf_ops.ReaderCache()
+    for mime_type, data in [("application/pdf", image_pdf(logo)), ("application/pdf", make_pdf(1)),
+                            ("image/png", make_png()), ("application/pdf", image_pdf(logo))]:
+        pdf_ops.add_source_pages(writer, readers, mime_type, data)
+
+    optimized, removed = pdf_ops.optimize_pdf_writer(writer)
+    data = write_pdf(optimized)
+
+    assert removed == 1
+    reader = pdf_ops.PdfReader(io.BytesIO(data))
+    assert len(reader.pages) == 4
+    for number, page in enumerate(reader.pages, 1):
+        page.extract_text()
+        for image in page.images:
+            Image.open(io.BytesIO(image.data)).load()
+        if page.images:
+            assert pdf_ops._render_pdf_page(data, number) is not None
+    assert [len(page.images) for page in reader.pages] == [1, 0, 1, 1]
+
+
+def test_render_thumbnail_from_image_and_scanned_pdf():
+    scan = make_jpeg((1600, 1200), dpi=150)
+    for data, filename, mime in [(scan, "a.jpg", "image/jpeg"),
+                                 (image_pdf(scan), "a.pdf", "application/pdf")]:
+        thumbnail = pdf_ops.render_thumbnail(data, filename, mime)
+        assert thumbnail["mime_type"] == "image/webp"
+        assert max(thumbnail["width"], thumbnail["height"]) == pdf_ops.THUMBNAIL_MAX_PX
+        assert Image.open(io.BytesIO(thumbnail["data"])).format == "WEBP"
+
+    # Página 2 (imagen) de un PDF cuya página 1 está en blanco
+    merged = build_pdf([("application/pdf", make_pdf(1)), ("image/jpeg", scan)])
+    thumbnail = pdf_ops.render_thumbnail(merged, "c.pdf", "application/pdf", page_number=2)
+    assert (thumbnail["width"], thumbnail["height"]) == (320, 240)
+
+
+def test_render_thumbnail_drafts_jpeg_before_applying_orientation():
+    rotated = make_jpeg((1600, 1200), orientation=6)
+    thumbnail = pdf_ops.render_thumbnail(rotated, "a.jpg", "image/jpeg")
+    assert (thumbnail["width"], thumbnail["height"]) == (240, 320)
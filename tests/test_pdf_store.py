@@ -0,0 +1,148 @@
+import io
+
+import pytest
+
+import pdf_ops
+import pdf_store
+
+from .test_pdf_ops import make_pdf, make_png
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = {doc["id"]: doc for doc in docs}
+        self.reads = []
+
+    def find_one(self, query, projection=None):
+        self.reads.append(query["id"])
+        return self.docs.get(query["id"])
+
+
+class FakeDb:
+    def __init__(self, docs):
+        self.documents = FakeCollection(docs)
+
+
+def test_consolidate_loads_each_parent_once():
+    parent = make_pdf(3)
+    db = FakeDb([
+        {"id": "padre", "filename": "padre.pdf", "mime_type": "application/pdf", "file_data": parent},
+        {"id": "p1", "filename": "p1.pdf", "mime_type": "application/pdf", "parent_document_id": "padre", "page_number": 1},
+        {"id": "p3", "filename": "p3.pdf", "mime_type": "application/pdf", "parent_document_id": "padre", "page_number": 3},
+        {"id": "img", "filename": "img.png", "mime_type": "image/png", "file_data": make_png()},
+    ])
+
+    items = [{"doc_id": doc_id, "fingerprint": None} for doc_id in ("p1", "p3", "img", "no-existe")]
+    result = pdf_store.consolidate(db, items)
+
+    assert [(e["title"], e["page_count"]) for e in result["composition"]] == [("p1.pdf", 1), ("p3.pdf", 1), ("img.png", 1)]
+    assert [f["doc_id"] for f in result["failed"]] == ["no-existe"]
+    assert db.documents.reads.count("padre") == 1
+
+
+def test_counting_stream_writes_valid_pdf():
+    result = pdf_store.consolidate(FakeDb([
+        {"id": "a", "filename": "a.pdf", "mime_type": "application/pdf", "file_data": make_pdf(2)},
+    ]), [{"doc_id": "a", "fingerprint": None}])
+    target = io.BytesIO()
+    stream = pdf_store._CountingStream(target)
+    result["writer"].write(stream)
+
+    assert result["failed"] == []
+    assert stream.tell() == len(target.getvalue())
+    assert pdf_ops.count_pages(target.getvalue()) == 2
+
+
+def test_consolidate_reuses_unchanged_page_ranges():
+    first, second, image = make_pdf(2), make_pdf(3), make_png()
+    db = FakeDb([
+        {"id": "a", "filename": "a.pdf", "mime_type": "application/pdf", "file_data": first},
+        {"id": "b", "filename": "b.pdf", "mime_type": "application/pdf", "file_data": second},
+        {"id": "c", "filename": "c.png", "mime_type": "image/png", "file_data": image},
+    ])
+    items = [{"doc_id": "a", "fingerprint": None}, {"doc_id": "b", "fingerprint": None}]
+    result = pdf_store.consolidate(db, items)
+    assert [(e["start_page"], e["page_count"]) for e in result["composition"]] == [(0, 2), (2, 3)]
+    assert result["composition"][0]["fingerprint"] == pdf_store.source_fingerprint(first)
+
+    buffer = io.BytesIO()
+    result["writer"].write(buffer)
+    previous_reader = pdf_ops.PdfReader(io.BytesIO(buffer.getvalue()))
+
+    # "a" fue reemplazado (huella distinta), "b" no cambió y se agrega la imagen "c"
+    db.documents.reads.clear()
+    items = [
+        {"doc_id": "b", "fingerprint": result["composition"][1]["fingerprint"]},
+        {"doc_id": "a", "fingerprint": "reemplazado"},
+        {"doc_id": "c", "fingerprint": None},
+    ]
+    regenerated = pdf_store.consolidate(db, items, previous_reader, result["composition"])
+
+    assert regenerated["reused"] == 1
+    assert regenerated["failed"] == []
+    assert "b" not in db.documents.reads
+    assert [(e["doc_id"], e["start_page"], e["page_count"]) for e in regenerated["composition"]] == [
+        ("b", 0, 3), ("a", 3, 2), ("c", 5, 1)
+    ]
+
+
+def test_consolidate_reports_failures_by_document():
+    db = FakeDb([
+        {"id": "a", "filename": "a.pdf", "mime_type": "application/pdf", "file_data": make_pdf(1)},
+        {"id": "roto", "filename": "roto.pdf", "mime_type": "application/pdf", "file_data": b"no es un pdf"},
+    ])
+    items = [{"doc_id": doc_id, "fingerprint": None} for doc_id in ("a", "roto", "no-existe")]
+    result = pdf_store.consolidate(db, items)
+
+    assert [e["doc_id"] for e in result["composition"]] == ["a"]
+    assert [(f["doc_id"], f["filename"]) for f in result["failed"]] == [("roto", "roto.pdf"), ("no-existe", None)]
+    assert all(f["reason"] for f in result["failed"])
+
+
+def test_consolidate_writes_outline_byte_ranges_and_sections():
+    db = FakeDb([
+        {"id": "a", "filename": "a.pdf", "mime_type": "application/pdf", "file_data": make_pdf(2)},
+        {"id": "b", "filename": "b.pdf", "mime_type": "application/pdf", "file_data": make_pdf(3)},
+    ])
+    items = [{"doc_id": "a", "fingerprint": None, "title": "Factura: a.pdf"}, {"doc_id": "b", "fingerprint": None}]
+    result = pdf_store.consolidate(db, items)
+
+    target = io.BytesIO()
+    stream = pdf_store._CountingStream(target)
+    result["writer"].write(stream)
+    data = target.getvalue()
+    reader = pdf_ops.PdfReader(io.BytesIO(data))
+    pdf_store.record_byte_ranges(result["writer"], result["composition"], pdf_store.object_offsets(reader))
+
+    assert [(item.title, reader.get_destination_page_number(item)) for item in reader.outline] == [
+        ("Factura: a.pdf", 0), ("b.pdf", 2)
+    ]
+    for entry in result["composition"]:
+        start, end = entry["byte_range"]
+        assert data[start:].startswith(b"%d 0 obj" % reader.pages[entry["start_page"]].indirect_reference.idnum)
+        assert start <= end
+
+    section = pdf_store.extract_section(None, 2, 3, pdf_data=data)
+    assert pdf_ops.count_pages(section) == 3
+
+
+def test_consolidate_enforces_memory_cap_and_releases_readers(monkeypatch):
+    parent, single = make_pdf(3), make_pdf(2)
+    db = FakeDb([
+        {"id": "padre", "filename": "padre.pdf", "mime_type": "application/pdf", "file_data": parent},
+        {"id": "p1", "filename": "p1.pdf", "mime_type": "application/pdf", "parent_document_id": "padre", "page_number": 1},
+        {"id": "p2", "filename": "p2.pdf", "mime_type": "application/pdf", "parent_document_id": "padre", "page_number": 2},
+        {"id": "a", "filename": "a.pdf", "mime_type": "application/pdf", "file_data": single},
+    ])
+    released = []
+    release = pdf_ops.ReaderCache.release
+    monkeypatch.setattr(pdf_ops.ReaderCache, "release", lambda self, data: released.append(data) or release(self, data))
+    items = [{"doc_id": doc_id, "fingerprint": None} for doc_id in ("p1", "p2", "a")]
+
+    # El padre cuenta una vez aunque aporte dos páginas
+    result = pdf_store.consolidate(db, items, max_bytes=len(parent) + len(single))
+    assert [e["page_count"] for e in result["composition"]] == [1, 1, 2]
+    assert released == [single]
+
+    with pytest.raises(pdf_store.ConsolidationTooLarge):
+        pdf_store.consolidate(db, items, max_bytes=len(parent) + len(single) - 1)
@@ -0,0 +1,24 @@
+import pytest
+
+from projections import DOCUMENT_LIST_FIELDS, list_projection
+
+
+def test_list_projection_excludes_detail_fields_by_default():
+    projection = list_projection(DOCUMENT_LIST_FIELDS)
+    assert projection["_id"] == 0
+    assert projection["file_info.page_count"] == 1
+    assert "analisis_completo" not in projection
+    assert "file_data" not in projection
+
+
+def test_list_projection_adds_requested_fields_without_path_collisions():
+    projection = list_projection(DOCUMENT_LIST_FIELDS, "analisis_completo, file_info ,concepto")
+    assert projection["analisis_completo"] == projection["concepto"] == projection["file_info"] == 1
+    assert "file_info.page_count" not in projection
+
+
+def test_list_projection_full_and_forbidden_fields():
+    assert list_projection(DOCUMENT_LIST_FIELDS, "*") == {"_id": 0, "file_data": 0, "pdf_data": 0}
+    for field in ("file_data", "pdf_data.x", "$where"):
+        with pytest.raises(ValueError):
+            list_projection(DOCUMENT_LIST_FIELDS, field)
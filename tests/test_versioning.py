@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+from versioning import CollectionVersions, collection_etag, etag_matches
+
+
+class FakeStore:
+    """Colección collection_versions en memoria: solo update_one con $inc y upsert."""
+    name = "collection_versions"
+
+    def __init__(self):
+        self.docs = {}
+
+    def update_one(self, query, update, upsert=False):
+        doc = self.docs.setdefault(query["_id"], {"_id": query["_id"], **update.get("$setOnInsert", {})})
+        doc["version"] = doc.get("version", 0) + update["$inc"]["version"]
+
+    def version(self, name):
+        return self.docs.get(name, {}).get("version", 0)
+
+
+def event(name, command, request_id=1):
+    return SimpleNamespace(command_name=name, command={name: command.pop("coll", None), **command}, request_id=request_id)
+
+
+def test_finished_writes_bump_the_shared_version():
+    store = FakeStore()
+    versions = CollectionVersions()
+    versions.bind(store)
+
+    versions.started(event("find", {"coll": "documents"}))
+    versions.started(event("aggregate", {"coll": "documents", "pipeline": [{"$match": {}}]}))
+    versions.started(event("update", {"coll": "documents"}, request_id=7))
+    assert store.version("documents") == 0
+
+    versions.succeeded(SimpleNamespace(request_id=7))
+    assert store.version("documents") == 1
+    assert store.version("batches") == 0
+
+    # Otro proceso con su propio listener incrementa el mismo contador
+    other = CollectionVersions()
+    other.bind(store)
+    other.started(event("insert", {"coll": "documents"}, request_id=1))
+    other.failed(SimpleNamespace(request_id=1))
+    assert store.version("documents") == 2
+
+    # Las escrituras en collection_versions no se cuentan a sí mismas
+    versions.started(event("update", {"coll": "collection_versions"}, request_id=8))
+    versions.succeeded(SimpleNamespace(request_id=8))
+    assert "collection_versions" not in store.docs
+
+
+def test_collection_etag_changes_with_version_epoch_and_parts():
+    versions = {"documents": {"epoch": "a", "version": 3}}
+    etag = collection_etag(["documents"], versions, "documents/list", None)
+    assert etag == collection_etag(["documents"], versions, "documents/list", None)
+    assert etag != collection_etag(["documents"], versions, "documents/list", "analizado")
+    assert etag != collection_etag(["documents"], {"documents": {"epoch": "a", "version": 4}}, "documents/list", None)
+    assert etag != collection_etag(["documents"], {"documents": {"epoch": "b", "version": 3}}, "documents/list", None)
+    assert etag != collection_etag(["documents"], {}, "documents/list", None)
+
+
+def test_etag_matches_weak_and_lists():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches(None, '"abc"')
+    assert not etag_matches('"abd"', '"abc"')
+
+
+def test_on_write_runs_only_after_success():
+    committed = []
+    versions = CollectionVersions(on_write=lambda name, command: lambda: committed.append(command[name]))
+
+    versions.started(event("insert", {"coll": "batches"}, request_id=1))
+    versions.started(event("delete", {"coll": "documents"}, request_id=2))
+    assert committed == []
+    versions.failed(SimpleNamespace(request_id=1))
+    versions.succeeded(SimpleNamespace(request_id=2))
+    assert committed == ["documents"]
+
+
+def test_untracked_collections_cost_no_increment():
+    store = FakeStore()
+    versions = CollectionVersions(collections=["documents"])
+    versions.bind(store)
+    versions.started(event("insert", {"coll": "audit_logs"}, request_id=1))
+    versions.succeeded(SimpleNamespace(request_id=1))
+    versions.started(event("insert", {"coll": "documents"}, request_id=2))
+    versions.succeeded(SimpleNamespace(request_id=2))
+    assert store.docs.keys() == {"documents"}